@@ -1,35 +1,142 @@
-from fastapi import APIRouter, Query
-from app.services.ia.semantic_search import search_context
-from app.services.ia.generative_answer import generate_answer_openrouter
-from app.services.db.history import get_history, save_history
+import hashlib
+import json
+from contextlib import aclosing
+from datetime import datetime
+
+from fastapi import APIRouter, Header, HTTPException, Query, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from app.services import metrics
+from app.services.ia import semantic_search
+from app.models.ask import BatchAskRequest
+from app.services.ia.generative_answer import get_generation_backend
+from app.services.ia.ask_pipeline import (
+    answer_batch, answer_cache, answer_question, context_packer, single_flight, stream_answer
+)
+from app.services.db.history import (
+    get_history, get_history_version, save_history, save_history_many, search_history, history_writer
+)
 
 router = APIRouter()
 
 
 @router.get("/ask_rule")
-def ask_rule(question: str = Query(..., min_length=5)):
+async def ask_rule(
+    question: str = Query(..., min_length=5),
+    no_cache: bool = Query(False, description="Ignorar la caché semántica de respuestas")
+):
     """
     API endpoint to answer MTG rule questions using semantic search and generation.
 
+    Near-duplicates of already answered questions are served from the semantic
+    answer cache (`cached: true` in the response) unless `no_cache` is set.
+
     Args:
         question (str): User's question.
+        no_cache (bool): Bypass the answer cache for this request.
 
     Returns:
         dict: Contains the question, the source context, and the AI-generated answer.
     """
-    context = search_context(question)
-    answer = generate_answer_openrouter(question, context)
+    if not semantic_search.is_ready():
+        raise HTTPException(status_code=503, detail="El índice de reglas aún se está cargando.")
 
-    # Guardar en historial
-    print(f"📚 Guardando pregunta en historial: '{question}'")
-    save_history(question, context, answer)
-    print("✅ Pregunta guardada en historial.")
+    result = await answer_question(question, use_cache=not no_cache)
 
-    return {
-        "question": question,
-        "context_used": context,
-        "answer": answer
-    }
+    # Guardar en historial también las peticiones agrupadas (coalesced): una fila por petición
+    with metrics.stage("history"):
+        save_history(question, result["context_used"], result["answer"], result["index_version"])
+
+    return result
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@router.get("/ask_rule/stream")
+async def ask_rule_stream(
+    question: str = Query(..., min_length=5),
+    no_cache: bool = Query(False, description="Ignorar la caché semántica de respuestas")
+):
+    """
+    Streaming variant of /ask_rule (server-sent events).
+
+    Events, in order:
+    - `context`: retrieved context, sent before generation starts.
+    - `token`: answer text deltas as the model produces them.
+    - `done`: the complete answer; the question is saved to history now.
+    - `error`: generation failed; the error is saved to history like in /ask_rule.
+
+    If the client disconnects before `done`, the upstream generation request
+    is closed and nothing is saved to history or to the answer cache.
+
+    Args:
+        question (str): User's question.
+        no_cache (bool): Bypass the answer cache for this request.
+
+    Returns:
+        StreamingResponse: `text/event-stream` response.
+    """
+    if not semantic_search.is_ready():
+        raise HTTPException(status_code=503, detail="El índice de reglas aún se está cargando.")
+
+    async def events():
+        context: list[str] = []
+        index_version = None
+        # Si el cliente se desconecta, Starlette cancela este generador en el
+        # siguiente await: no se llega a guardar nada.
+        async for event, data in stream_answer(question, use_cache=not no_cache):
+            if event == "context":
+                context, index_version = data["context_used"], data["index_version"]
+            elif event in ("done", "error"):
+                with metrics.stage("history"):
+                    save_history(question, context, data["answer"], index_version)
+            yield _sse(event, data)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.post("/ask_rule/batch")
+async def ask_rule_batch(request: BatchAskRequest):
+    """
+    API endpoint to answer many MTG rule questions in one request.
+
+    Retrieval is vectorized over the whole list and answers are generated
+    concurrently (up to `concurrency` calls). Each answer is streamed back as
+    one NDJSON line as soon as it is ready, so lines arrive in completion
+    order; `index` gives the position of the question in the request.
+
+    All answered questions are saved to history in a single transaction when
+    the batch ends (also if the client disconnects early: answers already
+    generated are kept).
+
+    Args:
+        request (BatchAskRequest): Questions, top_k, no_cache and concurrency.
+
+    Returns:
+        StreamingResponse: `application/x-ndjson` response, one result per line.
+    """
+    if not semantic_search.is_ready():
+        raise HTTPException(status_code=503, detail="El índice de reglas aún se está cargando.")
+
+    async def lines():
+        entries = []
+        # aclosing: si el cliente se va, cancelar ya las generaciones pendientes
+        results = answer_batch(request.questions, request.top_k, not request.no_cache, request.concurrency)
+        try:
+            async with aclosing(results):
+                async for result in results:
+                    entries.append((result["question"], result["context_used"], result["answer"], result["index_version"]))
+                    yield json.dumps(result, ensure_ascii=False) + "\n"
+        finally:
+            with metrics.stage("history"):
+                save_history_many(entries)
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
 
 @router.get("/get_history")
@@ -58,3 +165,132 @@ def get_history_endpoint(limit: int = 10):
             for row in rows
         ]
     }
+
+
+@router.get("/history/search")
+def search_history_endpoint(
+    q: str | None = Query(None, description="Texto a buscar en preguntas y respuestas"),
+    before_id: int | None = Query(None, ge=1, description="Cursor: next_before_id de la página anterior"),
+    since: datetime | None = Query(None, description="Desde (ISO 8601, UTC si no lleva zona)"),
+    until: datetime | None = Query(None, description="Hasta, excluido"),
+    limit: int = Query(20, ge=1, le=200),
+    count: bool = Query(False, description="Incluir el total de coincidencias"),
+    if_none_match: str | None = Header(None)
+):
+    """
+    API endpoint to search the question history.
+
+    Full-text search over questions and answers, newest first, paginated with
+    a cursor (`before_id`) instead of offsets. Responses carry an ETag built
+    from the last history id and the query, so pollers sending
+    `If-None-Match` get a 304 while nothing new has been written.
+
+    Args:
+        q (str | None): Words that must appear in the question or the answer.
+        before_id (int | None): Return rows older than this id.
+        since (datetime | None): Start of the time range.
+        until (datetime | None): End of the time range (exclusive).
+        limit (int): Page size (max 200).
+        count (bool): Also return the total number of matches.
+
+    Returns:
+        dict: items, next_before_id (None on the last page) and total.
+    """
+    params = f"{q}|{before_id}|{since}|{until}|{limit}|{count}"
+    etag = f'W/"{get_history_version()}-{hashlib.sha1(params.encode("utf-8")).hexdigest()[:12]}"'
+    if if_none_match == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    result = search_history(q, before_id, since, until, limit, with_count=count)
+    return JSONResponse(content=result, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+
+@router.get("/health")
+def health():
+    """
+    Liveness probe: the process is up and serving requests.
+    """
+    return {"status": "ok"}
+
+
+@router.get("/stats")
+def stats():
+    """
+    Returns runtime counters of the retrieval caches.
+    """
+    return {
+        "embedding_cache": semantic_search.embedding_cache.stats(),
+        "answer_cache": answer_cache.stats(),
+        "single_flight": single_flight.stats(),
+        "context_packing": context_packer.stats(),
+        "generation": get_generation_backend().stats(),
+        "query_batcher": semantic_search.query_batcher.stats(),
+        "rule_lookup": semantic_search.rule_lookup.stats() if semantic_search.rule_lookup else None,
+        "retrieval": semantic_search.retrieval_stats,
+        "reranker": semantic_search.reranker.stats() if semantic_search.reranker else None,
+        "history_writer": history_writer.stats()
+    }
+
+
+def _service_metrics():
+    """
+    Exports the counters kept by the services (read at scrape time only).
+    """
+    caches = [("embedding", semantic_search.embedding_cache.stats()), ("answer", answer_cache.stats())]
+    if semantic_search.reranker is not None:
+        caches.append(("rerank_scores", semantic_search.reranker.scores.stats()))
+    yield ("aethermind_cache_hits_total", "counter", "Cache hits", ("cache",),
+           [((name, ), stats["hits"]) for name, stats in caches])
+    yield ("aethermind_cache_misses_total", "counter", "Cache misses", ("cache",),
+           [((name, ), stats["misses"]) for name, stats in caches])
+    yield ("aethermind_cache_entries", "gauge", "Entries currently cached", ("cache",),
+           [((name, ), stats["size"]) for name, stats in caches])
+
+    yield ("aethermind_retrieval_path_total", "counter", "Questions served by each retrieval path", ("path",),
+           [((path, ), count) for path, count in semantic_search.retrieval_stats.items()])
+
+    flights = single_flight.stats()
+    yield ("aethermind_coalesced_requests_total", "counter", "Requests served by another in-flight request", (),
+           [((), flights["coalesced"])])
+
+    packing = context_packer.stats()
+    yield ("aethermind_context_tokens_saved_total", "counter", "Estimated prompt tokens removed by context packing", (),
+           [((), packing["tokens_saved"])])
+
+    writer = history_writer.stats()
+    yield ("aethermind_history_rows_written_total", "counter", "History rows committed", (), [((), writer["written"])])
+    yield ("aethermind_history_rows_dropped_total", "counter", "History rows dropped after retries", (), [((), writer["errors"])])
+    yield ("aethermind_history_queue_depth", "gauge", "History rows waiting to be written", (), [((), writer["queued"])])
+
+    yield ("aethermind_retrieval_ready", "gauge", "1 once the retrieval resources are loaded", (),
+           [((), int(semantic_search.is_ready()))])
+
+
+metrics.register_collector(_service_metrics)
+
+
+@router.get("/metrics")
+def prometheus_metrics():
+    """
+    Prometheus scrape endpoint (text exposition format).
+
+    Per-stage latency histograms (`aethermind_stage_seconds`), request
+    latency and status counters, generation tokens and errors, and the
+    cache, retrieval and history counters kept by the services.
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@router.get("/ready")
+def ready():
+    """
+    Readiness probe: returns 503 until the retrieval resources are loaded.
+    """
+    if semantic_search.is_ready():
+        return {"status": "ready", "index_version": semantic_search.get_index_version()}
+
+    error = semantic_search.get_load_error()
+    return JSONResponse(
+        status_code=503,
+        content={"status": "error" if error else "loading", "detail": error}
+    )
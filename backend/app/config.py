@@ -27,18 +27,114 @@ PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..
 # General data directory (for embeddings, training data, etc.)
 DATA_DIR = os.path.join(PROJECT_ROOT, 'data')
 EMBEDDINGS_DIR = os.path.join(DATA_DIR, 'embeddings')
+# Legacy pickled chunk list (only read by 'python -m app.services.ia.chunk_store --convert')
 CHUNKS_PATH = os.path.join(EMBEDDINGS_DIR, 'chunks.pkl')
 FAISS_INDEX_PATH = os.path.join(EMBEDDINGS_DIR, 'faiss.index')
+INDEX_META_PATH = os.path.join(EMBEDDINGS_DIR, 'index_meta.json')
+RULE_LOOKUP_PATH = os.path.join(EMBEDDINGS_DIR, 'rule_lookup.json')
+BM25_INDEX_PATH = os.path.join(EMBEDDINGS_DIR, 'bm25.npz')
+RULES_PATH = os.path.join(DATA_DIR, 'rules_raw', 'MagicCompRules.txt')
+
+# Retrieval resources
+EMBEDDING_MODEL_ID = os.getenv("EMBEDDING_MODEL_ID", "all-MiniLM-L6-v2")
+# Open faiss.index memory-mapped so workers share the page cache instead of private copies
+FAISS_MMAP = os.getenv("FAISS_MMAP", "1") == "1"
+# Load model/index in the master process before forking workers (gunicorn --preload)
+RETRIEVAL_PRELOAD = os.getenv("RETRIEVAL_PRELOAD", "0") == "1"
+
+# Answer questions citing a rule number or glossary term from the exact lookup (no embedding)
+RULE_LOOKUP_FAST_PATH = os.getenv("RULE_LOOKUP_FAST_PATH", "1") == "1"
+
+# Retrieval mode: "vector", "hybrid" (BM25 + vector, RRF) or "lexical_first"
+# (hybrid, but skip the vector stage when the BM25 hit is confident)
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "lexical_first")
+RRF_K = int(os.getenv("RRF_K", "60"))
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))  # profundidad de cada ranking antes de fusionar
+# Confident lexical hit: keyword-style query (few known terms) fully covered by the best chunk
+BM25_CONFIDENT_MAX_TERMS = int(os.getenv("BM25_CONFIDENT_MAX_TERMS", "2"))
+
+# Optional cross-encoder rerank of a wider candidate set (CPU)
+RERANK_ENABLED = os.getenv("RERANK_ENABLED", "0") == "1"
+# Multilingüe: las preguntas llegan en castellano y las reglas están en inglés
+RERANK_MODEL_ID = os.getenv("RERANK_MODEL_ID", "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1")
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "50"))  # candidatos de FAISS/BM25 a reordenar
+RERANK_TOP_K = int(os.getenv("RERANK_TOP_K", "4"))  # chunks finales que llegan a la generación
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", "32"))
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", "50000"))  # puntuaciones (pregunta, chunk)
+RERANK_CACHE_TTL = float(os.getenv("RERANK_CACHE_TTL", "86400"))
+
+# Query-embedding cache (entries, seconds)
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "4096"))
+EMBEDDING_CACHE_TTL = float(os.getenv("EMBEDDING_CACHE_TTL", "3600"))
+
+# Micro-batching of concurrent retrieval queries
+QUERY_BATCHING_ENABLED = os.getenv("QUERY_BATCHING_ENABLED", "1") == "1"
+QUERY_BATCH_MAX_SIZE = int(os.getenv("QUERY_BATCH_MAX_SIZE", "32"))
+QUERY_BATCH_MAX_WAIT_MS = float(os.getenv("QUERY_BATCH_MAX_WAIT_MS", "2"))
+
+# Semantic answer cache: reuse past answers for near-duplicate questions
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "1") == "1"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.93"))  # similitud coseno mínima
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "10000"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", str(7 * 24 * 3600)))
+ANSWER_CACHE_WARM_ROWS = int(os.getenv("ANSWER_CACHE_WARM_ROWS", "2000"))  # filas de history al arrancar
+
+# Context packing before generation: dedupe near-identical chunks, trim to a token budget
+CONTEXT_PACKING_ENABLED = os.getenv("CONTEXT_PACKING_ENABLED", "1") == "1"
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1200"))  # tokens estimados (0 = sin límite)
+CONTEXT_DEDUP_THRESHOLD = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", "0.8"))  # Jaccard de shingles
+
+# Coalesce concurrent identical /ask_rule questions into one retrieval + generation
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "1") == "1"
+
+# Prometheus /metrics, per-stage histograms and the Server-Timing header
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
 
 # App runtime data (for history.db, logs, etc.)
 APP_DATA_DIR = os.path.join(PROJECT_ROOT, 'backend', 'app', 'data')
 APP_HISTORY_DIR = os.path.join(APP_DATA_DIR, 'history')
 HISTORY_DB_PATH = os.path.join(APP_HISTORY_DIR, 'history.db')
+# Write-behind history: rows per transaction / max seconds a row waits in the queue
+HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", "64"))
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "0.5"))
 
 # Training data
 TRAINING_DATA_DIR = os.path.join(DATA_DIR, "training_data")
 TRAINING_DATA_PATH = os.path.join(TRAINING_DATA_DIR, "training_data.jsonl")
 
+# Generation backend: "openrouter", "openai" (any OpenAI-compatible server), "onnx" (local CPU) or "fake"
+GENERATION_BACKEND = os.getenv("GENERATION_BACKEND", "openrouter")
+GENERATION_MAX_TOKENS = int(os.getenv("GENERATION_MAX_TOKENS", "500"))
+GENERATION_TEMPERATURE = float(os.getenv("GENERATION_TEMPERATURE", "0.7"))
+
+# OpenRouter. Overridable via environment variables.
+GENERATION_API_URL = os.getenv("GENERATION_API_URL", "https://openrouter.ai/api/v1/chat/completions")
+GENERATION_MODEL = os.getenv("GENERATION_MODEL", "openai/gpt-3.5-turbo")
+GENERATION_CONNECT_TIMEOUT = float(os.getenv("GENERATION_CONNECT_TIMEOUT", "5"))
+GENERATION_READ_TIMEOUT = float(os.getenv("GENERATION_READ_TIMEOUT", "60"))
+GENERATION_MAX_CONNECTIONS = int(os.getenv("GENERATION_MAX_CONNECTIONS", "200"))
+GENERATION_MAX_KEEPALIVE = int(os.getenv("GENERATION_MAX_KEEPALIVE", "50"))
+
+# OpenAI-compatible server (llama.cpp server, vLLM, Ollama, fake_llm_server...)
+OPENAI_COMPAT_API_URL = os.getenv("OPENAI_COMPAT_API_URL", "http://127.0.0.1:8080/v1/chat/completions")
+OPENAI_COMPAT_MODEL = os.getenv("OPENAI_COMPAT_MODEL", "local")
+OPENAI_COMPAT_API_KEY = os.getenv("OPENAI_COMPAT_API_KEY")
+
+# Local ONNX model directory (exported with optimum-cli)
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", os.path.join(PROJECT_ROOT, "models", "onnx"))
+
+# Deterministic fake backend latency
+FAKE_FIRST_TOKEN_MS = float(os.getenv("FAKE_FIRST_TOKEN_MS", "300"))
+FAKE_TOKEN_MS = float(os.getenv("FAKE_TOKEN_MS", "20"))
+FAKE_TOKENS = int(os.getenv("FAKE_TOKENS", "60"))
+
+# Batch endpoint (/ask_rule/batch): max questions per request / concurrent generation calls
+BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", "1000"))
+BATCH_GENERATION_CONCURRENCY = int(os.getenv("BATCH_GENERATION_CONCURRENCY", "16"))
+
+# Threads used for CPU-bound embedding / FAISS work off the event loop
+EMBEDDING_EXECUTOR_WORKERS = int(os.getenv("EMBEDDING_EXECUTOR_WORKERS", str(min(4, os.cpu_count() or 1))))
+
 # Optional: Print paths for debug (you can comment these out later)
 if __name__ == "__main__":
     print("=== Project Paths ===")
@@ -47,8 +143,11 @@ if __name__ == "__main__":
     print(f"EMBEDDINGS_DIR    : {EMBEDDINGS_DIR}")
     print(f"CHUNKS_PATH       : {CHUNKS_PATH}")
     print(f"FAISS_INDEX_PATH  : {FAISS_INDEX_PATH}")
+    print(f"RULES_PATH        : {RULES_PATH}")
     print(f"TRAINING_DATA_DIR : {TRAINING_DATA_DIR}")
     print(f"TRAINING_DATA_PATH: {TRAINING_DATA_PATH}")
     print(f"APP_DATA_DIR      : {APP_DATA_DIR}")
     print(f"APP_HISTORY_DIR   : {APP_HISTORY_DIR}")
     print(f"HISTORY_DB_PATH   : {HISTORY_DB_PATH}")
+    print(f"GENERATION_BACKEND: {GENERATION_BACKEND}")
+    print(f"GENERATION_API_URL: {GENERATION_API_URL}")
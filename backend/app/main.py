@@ -1,5 +1,64 @@
+import asyncio
+import gc
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from app.api.routes import router as api_router
+from app.config import RETRIEVAL_PRELOAD
+from app.services.db.history import init_db, history_writer
+from app.services.ia.generative_answer import start_generation_backend, close_generation_backend
+from app.services.ia import semantic_search
+from app.services.ia.ask_pipeline import warm_answer_cache
+from app.services.metrics import ServerTimingMiddleware
+
+# Modo preload (gunicorn --preload): cargar modelo e índice en el proceso maestro
+# antes del fork para que los workers compartan las mismas páginas (copy-on-write).
+if RETRIEVAL_PRELOAD:
+    semantic_search.load_resources()
+    # Evita que el GC toque los objetos precargados y rompa el copy-on-write
+    gc.freeze()
+
+
+def _load_retrieval_resources():
+    try:
+        semantic_search.load_resources()
+    except Exception:
+        return  # El error queda en get_load_error() y /ready lo expone
+
+    try:
+        warm_answer_cache()
+    except Exception as e:
+        print(f"⚠️ No se pudo precargar la caché de respuestas: {e}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Creates shared resources at startup and releases them at shutdown.
+
+    Retrieval resources load in the background so the process starts serving
+    /health immediately; /ready reports 503 until loading finishes.
+    """
+    init_db()
+    history_writer.start()
+    await start_generation_backend()
+    semantic_search.get_executor()
+    await semantic_search.start_query_batcher()
+
+    # Con preload los recursos ya están cargados y solo se precarga la caché
+    loading = asyncio.create_task(asyncio.to_thread(_load_retrieval_resources))
+
+    yield
+
+    if not loading.done():
+        loading.cancel()
+    await semantic_search.stop_query_batcher()
+    await close_generation_backend()
+    semantic_search.shutdown_executor()
+    # Vaciar la cola de historial antes de salir
+    await asyncio.to_thread(history_writer.stop)
+
 
-app = FastAPI(title="Aethermind API")
+app = FastAPI(title="Aethermind API", lifespan=lifespan)
+app.add_middleware(ServerTimingMiddleware)
 app.include_router(api_router)
@@ -0,0 +1,18 @@
+from typing import Annotated
+
+from pydantic import BaseModel, Field
+
+from app.config import BATCH_MAX_QUESTIONS, BATCH_GENERATION_CONCURRENCY
+
+
+class BatchAskRequest(BaseModel):
+    """
+    Body of POST /ask_rule/batch.
+    """
+    questions: list[Annotated[str, Field(min_length=5)]] = Field(..., min_length=1, max_length=BATCH_MAX_QUESTIONS)
+    top_k: int = Field(8, ge=1, le=50)
+    no_cache: bool = Field(False, description="Ignorar la caché semántica de respuestas")
+    concurrency: int = Field(
+        BATCH_GENERATION_CONCURRENCY, ge=1, le=BATCH_GENERATION_CONCURRENCY,
+        description="Llamadas de generación simultáneas"
+    )
@@ -1,39 +1,406 @@
 import sqlite3
 import json
+import hashlib
 import os
+import queue
+import re
+import threading
+import time
 
-from datetime import datetime
-from app.config import HISTORY_DB_PATH
+from datetime import datetime, timezone
+from app.config import HISTORY_DB_PATH, HISTORY_BATCH_SIZE, HISTORY_FLUSH_INTERVAL
+from app.services.metrics import stage
+
+
+def connect(db_path: str = HISTORY_DB_PATH, readonly: bool = False) -> sqlite3.Connection:
+    """
+    Opens a connection to the history database.
+
+    The database runs in WAL mode, so readers (API, export scripts) and the
+    single writer do not block each other.
+
+    Args:
+        db_path (str): Path to the SQLite file.
+        readonly (bool): Open with mode=ro (export jobs, dashboards).
+
+    Returns:
+        sqlite3.Connection: Connection with a busy timeout configured.
+    """
+    if readonly:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=30)
+    else:
+        conn = sqlite3.connect(db_path, timeout=30)
+    conn.execute("PRAGMA busy_timeout=30000")
+    return conn
+
+
+SCHEMA_VERSION = 3
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS context_chunks (
+        id INTEGER PRIMARY KEY,
+        hash TEXT NOT NULL UNIQUE,
+        text TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        timestamp TEXT NOT NULL,
+        question TEXT NOT NULL,
+        answer TEXT NOT NULL,
+        index_version TEXT,
+        context_ids TEXT NOT NULL DEFAULT '[]'
+    );
+    CREATE INDEX IF NOT EXISTS idx_history_timestamp ON history(timestamp);
+    CREATE INDEX IF NOT EXISTS idx_history_index_version ON history(index_version, id);
+'''
+
+# Índice full-text (external content: el texto solo vive en `history`). Los
+# triggers lo mantienen al día con cada INSERT/DELETE/UPDATE, también los del writer.
+FTS_SCHEMA = '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(
+        question, answer,
+        content='history', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    );
+    CREATE TRIGGER IF NOT EXISTS history_fts_ai AFTER INSERT ON history BEGIN
+        INSERT INTO history_fts (rowid, question, answer) VALUES (new.id, new.question, new.answer);
+    END;
+    CREATE TRIGGER IF NOT EXISTS history_fts_ad AFTER DELETE ON history BEGIN
+        INSERT INTO history_fts (history_fts, rowid, question, answer) VALUES ('delete', old.id, old.question, old.answer);
+    END;
+    CREATE TRIGGER IF NOT EXISTS history_fts_au AFTER UPDATE OF question, answer ON history BEGIN
+        INSERT INTO history_fts (history_fts, rowid, question, answer) VALUES ('delete', old.id, old.question, old.answer);
+        INSERT INTO history_fts (rowid, question, answer) VALUES (new.id, new.question, new.answer);
+    END;
+'''
+
+FTS_TERM_RE = re.compile(r"\w+")
+
+def _chunk_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _history_row(question: str, context_used: list[str], answer: str, index_version: str | None) -> tuple:
+    timestamp = datetime.utcnow().isoformat()
+    return (timestamp, question, list(context_used), answer, index_version)
+
+
+def _resolve_chunk_ids(conn: sqlite3.Connection, texts: list[str], known: dict[str, int], new: dict[str, int]) -> list[int]:
+    """
+    Maps context texts to ids in the deduplicated `context_chunks` table,
+    inserting the ones not stored yet. `known` caches hash → id (read only);
+    ids resolved in this transaction go to `new`.
+    """
+    ids = []
+    for text in texts:
+        digest = _chunk_hash(text)
+        chunk_id = known.get(digest) or new.get(digest)
+        if chunk_id is None:
+            conn.execute("INSERT OR IGNORE INTO context_chunks (hash, text) VALUES (?, ?)", (digest, text))
+            chunk_id = conn.execute("SELECT id FROM context_chunks WHERE hash = ?", (digest,)).fetchone()[0]
+            new[digest] = chunk_id
+        ids.append(chunk_id)
+    return ids
+
+
+def _insert_rows(conn: sqlite3.Connection, rows: list[tuple], chunk_cache: dict[str, int] | None = None) -> None:
+    """
+    Inserts history rows in a single transaction. Context texts are stored once
+    in `context_chunks`; each row keeps only the list of chunk ids.
+    """
+    known = chunk_cache if chunk_cache is not None else {}
+    resolved: dict[str, int] = {}
+    with conn:  # una sola transacción por lote
+        for timestamp, question, context_used, answer, index_version in rows:
+            context_ids = _resolve_chunk_ids(conn, context_used, known, resolved)
+            conn.execute('''
+                INSERT INTO history (timestamp, question, answer, index_version, context_ids)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (timestamp, question, answer, index_version, json.dumps(context_ids, separators=(",", ":"))))
+
+    # Solo tras el commit: un rollback no debe dejar ids inexistentes en la caché
+    if chunk_cache is not None:
+        chunk_cache.update(resolved)
+
+
+def load_contexts(conn: sqlite3.Connection, context_ids_json: list[str]) -> list[list[str]]:
+    """
+    Rebuilds the context texts of several history rows from their chunk ids.
+
+    Args:
+        conn (sqlite3.Connection): Open connection.
+        context_ids_json (list[str]): The `context_ids` column of each row.
+
+    Returns:
+        list[list[str]]: Context texts per row, in retrieval order.
+    """
+    id_lists = [json.loads(value or "[]") for value in context_ids_json]
+    wanted = sorted({chunk_id for ids in id_lists for chunk_id in ids})
+
+    texts: dict[int, str] = {}
+    for start in range(0, len(wanted), 500):
+        batch = wanted[start:start + 500]
+        placeholders = ",".join("?" * len(batch))
+        texts.update(conn.execute(f"SELECT id, text FROM context_chunks WHERE id IN ({placeholders})", batch))
+
+    return [[texts[chunk_id] for chunk_id in ids if chunk_id in texts] for ids in id_lists]
+
+
+class HistoryWriter:
+    """
+    Write-behind history persistence.
+
+    Requests only enqueue rows; a background thread owns one long-lived WAL
+    connection and flushes the queue in batched transactions when
+    `batch_size` rows are waiting or `flush_interval` seconds have passed
+    since the first pending row. `stop()` drains the queue before returning.
+
+    Args:
+        db_path (str): Path to the SQLite file.
+        batch_size (int): Rows per transaction.
+        flush_interval (float): Maximum seconds a row waits before being written.
+    """
+
+    _STOP = object()
+
+    def __init__(self, db_path: str = HISTORY_DB_PATH, batch_size: int = 64, flush_interval: float = 0.5):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: queue.Queue = queue.Queue()
+        self._thread: threading.Thread | None = None
+        self._chunk_cache: dict[str, int] = {}
+        self.written = 0
+        self.batches = 0
+        self.errors = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        """
+        Starts the writer thread.
+        """
+        if self.running:
+            return
+        self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """
+        Flushes every queued row and stops the writer thread.
+        """
+        if not self.running:
+            self._thread = None
+            return
+        self._queue.put(self._STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def submit(self, row: tuple) -> None:
+        """
+        Queues a history row (non-blocking).
+        """
+        self._queue.put(row)
+
+    def submit_many(self, rows: list[tuple]) -> None:
+        """
+        Queues several rows as one unit: they are written in the same transaction.
+        """
+        if rows:
+            self._queue.put(list(rows))
+
+    @staticmethod
+    def _rows(item) -> list[tuple]:
+        # Un lote de submit_many llega como lista y nunca se parte entre transacciones
+        return list(item) if isinstance(item, list) else [item]
+
+    @property
+    def started(self) -> bool:
+        """
+        True between `start()` and `stop()`, even if the thread died.
+        """
+        return self._thread is not None
+
+    def discard(self, rows: list[tuple], reason: str) -> None:
+        """
+        Counts rows that could not be written as errors and logs them.
+        """
+        self.errors += len(rows)
+        print(f"❌ Se descartan {len(rows)} filas de historial: {reason}")
+
+    def _flush(self, conn: sqlite3.Connection, rows: list[tuple]) -> None:
+        # Nunca propaga: una excepción aquí mataría el hilo y con él la cola
+        for attempt in range(3):
+            try:
+                if len(self._chunk_cache) > 100_000:
+                    self._chunk_cache.clear()
+                with stage("history_write"):
+                    _insert_rows(conn, rows, self._chunk_cache)
+                self.written += len(rows)
+                self.batches += 1
+                return
+            except sqlite3.Error as e:
+                print(f"⚠️ Error guardando historial (intento {attempt + 1}): {e!r}")
+                time.sleep(0.2 * (attempt + 1))
+            except Exception as e:
+                # Filas mal formadas (p. ej. contexto no serializable): reintentar no
+                # sirve; se escriben una a una para descartar solo las erróneas
+                if len(rows) > 1:
+                    for row in rows:
+                        self._flush(conn, [row])
+                else:
+                    self.discard(rows, repr(e))
+                return
+        self.discard(rows, "reintentos agotados")
+
+    def _run(self) -> None:
+        conn = connect(self.db_path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")  # en WAL: sin fsync por commit
+
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is self._STOP:
+                break
+
+            rows = self._rows(item)
+            deadline = time.monotonic() + self.flush_interval
+            while len(rows) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stopping = True
+                    break
+                rows.extend(self._rows(item))
+            self._flush(conn, rows)
+
+        # Vaciar lo que quede en cola antes de cerrar
+        rows = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not self._STOP:
+                rows.extend(self._rows(item))
+        if rows:
+            self._flush(conn, rows)
+
+        conn.close()
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "batches": self.batches,
+            "errors": self.errors,
+        }
+
+
+history_writer = HistoryWriter(batch_size=HISTORY_BATCH_SIZE, flush_interval=HISTORY_FLUSH_INTERVAL)
+
+
+def _migrate_legacy(conn: sqlite3.Connection) -> None:
+    """
+    Migrates the original schema (full pretty-printed context JSON in
+    `history.context_used`) to chunk-id references plus `context_chunks`.
+    """
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(history)")]
+    version_expr = "index_version" if "index_version" in columns else "NULL"
+    total = conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+    print(f"🔧 Migrando {total} filas de historial al esquema v{SCHEMA_VERSION}...")
+
+    # BEGIN explícito: sqlite3 no abre transacción para DDL y la migración debe ser atómica
+    conn.execute("BEGIN")
+    try:
+        conn.execute("ALTER TABLE history RENAME TO history_legacy")
+        for statement in SCHEMA.split(";"):
+            if statement.strip() and "CREATE INDEX" not in statement:
+                conn.execute(statement)
+
+        known: dict[str, int] = {}
+        cursor = conn.execute(
+            f"SELECT id, timestamp, question, context_used, answer, {version_expr} FROM history_legacy ORDER BY id"
+        )
+        for row_id, timestamp, question, context_json, answer, index_version in cursor:
+            try:
+                context = json.loads(context_json)
+                if not isinstance(context, list):
+                    context = []
+            except (TypeError, ValueError):
+                context = []
+            context_ids = _resolve_chunk_ids(conn, [str(c) for c in context], {}, known)
+            conn.execute('''
+                INSERT INTO history (id, timestamp, question, answer, index_version, context_ids)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (row_id, timestamp, question, answer, index_version, json.dumps(context_ids, separators=(",", ":"))))
+
+        conn.execute("DROP TABLE history_legacy")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    print(f"✅ Migración completada ({len(known)} chunks de contexto únicos).")
+
+
+def rebuild_fts(conn: sqlite3.Connection) -> None:
+    """
+    Rebuilds the full-text index from the `history` table.
+    """
+    with conn:
+        conn.execute("INSERT INTO history_fts (history_fts) VALUES ('rebuild')")
 
 
 def init_db():
     """
-    Initializes the SQLite database.
+    Initializes the SQLite database, migrating older schemas in place.
+
+    Schema v2: `history` keeps the question, answer, rules index version and
+    a compact list of ids into the deduplicated `context_chunks` table,
+    instead of the full context text of every row.
+    Schema v3: adds the `history_fts` full-text index over questions and
+    answers, kept in sync by triggers.
     """
     print(f"USANDO HISTORY_DB_PATH: {HISTORY_DB_PATH}")  # Para depuración
 
     # Crear carpeta si no existe
     os.makedirs(os.path.dirname(HISTORY_DB_PATH), exist_ok=True)
 
-    conn = sqlite3.connect(HISTORY_DB_PATH)
-    cursor = conn.cursor()
+    conn = connect()
+    conn.execute("PRAGMA journal_mode=WAL")  # persistente en el fichero
 
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp TEXT NOT NULL,
-            question TEXT NOT NULL,
-            context_used TEXT NOT NULL,
-            answer TEXT NOT NULL
-        )
-    ''')
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(history)")]
+
+    if version < SCHEMA_VERSION:
+        migrated = False
+        if version < 2 and "context_used" in columns:
+            _migrate_legacy(conn)
+            migrated = True
+        conn.executescript(SCHEMA)
+        conn.executescript(FTS_SCHEMA)
+        if version < 3:
+            rebuild_fts(conn)  # indexar las filas anteriores a los triggers
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.commit()
+        if migrated:
+            conn.execute("VACUUM")  # recuperar el espacio del contexto duplicado
 
-    conn.commit()
     conn.close()
     print("✅ Tabla 'history' creada o ya existente.")
 
 
-def save_history(question: str, context_used: list[str], answer: str):
+def save_history(question: str, context_used: list[str], answer: str, index_version: str | None = None):
     """
     Saves a question and its answer to the history database.
 
@@ -41,21 +408,50 @@ def save_history(question: str, context_used: list[str], answer: str):
         question (str): The user's question.
         context_used (list[str]): List of context chunks used for generating the answer.
         answer (str): The generated answer.
+        index_version (str | None): Version of the rules index used for retrieval.
 
-    The function inserts a new record into the `history` table with a UTC timestamp.
+    The row gets a UTC timestamp. When the background writer is running the
+    row is only queued (no I/O on the request path). If the writer was started
+    but its thread died the row is logged and dropped rather than written
+    synchronously from the event loop; without a writer (scripts) it is
+    inserted synchronously.
     """
-    conn = sqlite3.connect(HISTORY_DB_PATH)
-    cursor = conn.cursor()
+    row = _history_row(question, context_used, answer, index_version)
 
-    timestamp = datetime.utcnow().isoformat()
-    context_json = json.dumps(context_used, ensure_ascii=False, indent=2)
+    if history_writer.running:
+        history_writer.submit(row)
+        return
+    if history_writer.started:
+        history_writer.discard([row], "el hilo de escritura no está activo")
+        return
 
-    cursor.execute('''
-        INSERT INTO history (timestamp, question, context_used, answer)
-        VALUES (?, ?, ?, ?)
-    ''', (timestamp, question, context_json, answer))
+    conn = connect()
+    _insert_rows(conn, [row])
+    conn.close()
 
-    conn.commit()
+def save_history_many(entries: list[tuple[str, list[str], str, str | None]]):
+    """
+    Saves several question/answer pairs in a single transaction.
+
+    Args:
+        entries (list[tuple]): (question, context_used, answer, index_version) tuples.
+
+    Like `save_history`, the rows are only queued when the background writer
+    is running; it writes them together in one transaction.
+    """
+    rows = [_history_row(*entry) for entry in entries]
+    if not rows:
+        return
+
+    if history_writer.running:
+        history_writer.submit_many(rows)
+        return
+    if history_writer.started:
+        history_writer.discard(rows, "el hilo de escritura no está activo")
+        return
+
+    conn = connect()
+    _insert_rows(conn, rows)
     conn.close()
 
 def get_history(limit: int = 10):
@@ -68,7 +464,7 @@ def get_history(limit: int = 10):
     Returns:
         list[tuple]: List of tuples, each containing (timestamp, question, answer).
     """
-    conn = sqlite3.connect(HISTORY_DB_PATH)
+    conn = connect()
     cursor = conn.cursor()
 
     cursor.execute('''
@@ -82,14 +478,150 @@ def get_history(limit: int = 10):
 
     return rows
 
+def _fts_query(text: str) -> str | None:
+    """
+    Turns free text into a safe FTS5 query: every word is quoted (no FTS
+    operators from user input) and all of them must match.
+    """
+    terms = FTS_TERM_RE.findall(text)
+    return " ".join(f'"{term}"' for term in terms) or None
+
+
+def _to_db_timestamp(value: datetime) -> str:
+    # Los timestamps se guardan como ISO UTC sin zona
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.isoformat()
+
+
+def get_history_version() -> int:
+    """
+    Returns the id of the newest history row (0 when empty). Ids only grow,
+    so it changes whenever a row is written.
+    """
+    conn = connect(readonly=True)
+    last_id = conn.execute("SELECT MAX(id) FROM history").fetchone()[0]
+    conn.close()
+    return last_id or 0
+
+
+def search_history(
+    q: str | None = None,
+    before_id: int | None = None,
+    since: datetime | None = None,
+    until: datetime | None = None,
+    limit: int = 20,
+    with_count: bool = False,
+) -> dict:
+    """
+    Searches the history, newest first, with keyset pagination.
+
+    Pages are cut on the row id (`id < before_id`) instead of OFFSET, so every
+    page costs the same regardless of depth. The time range filters on the
+    timestamp column (indexed) rather than on ids: timestamps are set when a
+    row is queued, so ids and timestamps can be out of order across
+    concurrent requests.
+
+    Args:
+        q (str | None): Full-text query over questions and answers (all words must match).
+        before_id (int | None): Cursor: only rows with a smaller id (`next_before_id` of the previous page).
+        since (datetime | None): Only rows at or after this time.
+        until (datetime | None): Only rows before this time.
+        limit (int): Page size.
+        with_count (bool): Also count every row matching the filters (ignores the cursor).
+
+    Returns:
+        dict: {"items": [...], "next_before_id": int | None, "total": int | None}.
+    """
+    conn = connect(readonly=True)
+
+    conditions, params = [], []
+    if since is not None:
+        conditions.append("h.timestamp >= ?")
+        params.append(_to_db_timestamp(since))
+    if until is not None:
+        conditions.append("h.timestamp < ?")
+        params.append(_to_db_timestamp(until))
+
+    match = _fts_query(q) if q else None
+    if q and match is None:
+        conn.close()
+        return {"items": [], "next_before_id": None, "total": 0 if with_count else None}
+
+    if match:
+        source = "history_fts JOIN history h ON h.id = history_fts.rowid"
+        conditions.insert(0, "history_fts MATCH ?")
+        params.insert(0, match)
+    else:
+        source = "history h"
+
+    total = None
+    if with_count:
+        where = " AND ".join(conditions) or "1"
+        total = conn.execute(f"SELECT COUNT(*) FROM {source} WHERE {where}", params).fetchone()[0]
+
+    if before_id is not None:
+        conditions.append("h.id < ?")
+        params.append(before_id)
+    where = " AND ".join(conditions) or "1"
+
+    rows = conn.execute(f'''
+        SELECT h.id, h.timestamp, h.question, h.answer, h.index_version
+        FROM {source}
+        WHERE {where}
+        ORDER BY h.id DESC
+        LIMIT ?
+    ''', (*params, limit)).fetchall()
+    conn.close()
+
+    items = [
+        {"id": row[0], "timestamp": row[1], "question": row[2], "answer": row[3], "index_version": row[4]}
+        for row in rows
+    ]
+    return {
+        "items": items,
+        "next_before_id": items[-1]["id"] if len(items) == limit else None,
+        "total": total,
+    }
+
+def get_recent_answers(limit: int, index_version: str):
+    """
+    Retrieves the latest successful answers produced with a given rules index.
+
+    Used to warm the semantic answer cache at startup.
+
+    Args:
+        limit (int): Maximum number of records.
+        index_version (str): Rules index version the answers must come from.
+
+    Returns:
+        list[tuple]: List of (question, context_used, answer) tuples, newest first.
+    """
+    conn = connect()
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        SELECT question, context_ids, answer FROM history
+        WHERE index_version = ? AND answer NOT LIKE 'Error:%'
+        ORDER BY id DESC
+        LIMIT ?
+    ''', (index_version, limit))
+
+    rows = cursor.fetchall()
+    contexts = load_contexts(conn, [row[1] for row in rows])
+    conn.close()
+
+    return [(question, context, answer) for (question, _, answer), context in zip(rows, contexts)]
+
 def clear_history():
     """
     Clears all entries from the history table.
     """
-    conn = sqlite3.connect(HISTORY_DB_PATH)
+    conn = connect()
     cursor = conn.cursor()
 
     cursor.execute('DELETE FROM history')
+    cursor.execute('DELETE FROM context_chunks')
 
     conn.commit()
     conn.close()
@@ -0,0 +1,163 @@
+"""
+answer_cache.py
+
+Semantic answer cache for /ask_rule.
+
+Keeps a small in-memory FAISS inner-product index over the (L2-normalized)
+embeddings of previously answered questions. A new question whose cosine
+similarity with a cached one reaches the threshold, and that was answered
+with the same rules index version, reuses the stored answer instead of
+calling the LLM again.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import faiss
+import numpy as np
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    answer: str
+    context: list[str]
+    index_version: str
+    created_at: float
+
+
+class AnswerCache:
+    """
+    Vector index of past questions mapped to their answers.
+
+    Args:
+        threshold (float): Minimum cosine similarity to reuse an answer.
+        maxsize (int): Maximum number of cached answers (least recently used are evicted).
+        ttl (float): Seconds an answer stays reusable (0 = no expiry).
+        candidates (int): Nearest neighbours inspected per lookup.
+    """
+
+    def __init__(self, threshold: float = 0.93, maxsize: int = 10000, ttl: float = 0, candidates: int = 4):
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.candidates = candidates
+        self._index: faiss.IndexIDMap2 | None = None
+        self._entries: OrderedDict[int, CachedAnswer] = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _normalize(embedding: np.ndarray) -> np.ndarray:
+        vector = np.array(embedding, dtype=np.float32).reshape(1, -1)
+        faiss.normalize_L2(vector)
+        return vector
+
+    def _remove(self, ids: list[int]) -> None:
+        for entry_id in ids:
+            self._entries.pop(entry_id, None)
+        self._index.remove_ids(np.array(ids, dtype=np.int64))
+
+    def lookup(self, embedding: np.ndarray, index_version: str) -> tuple[CachedAnswer, float] | None:
+        """
+        Finds a cached answer for a question embedding.
+
+        Args:
+            embedding (np.ndarray): Embedding of the new question.
+            index_version (str): Rules index version currently in use.
+
+        Returns:
+            tuple[CachedAnswer, float] | None: The cached answer and its similarity, or None.
+        """
+        with self._lock:
+            if self._index is None or self._index.ntotal == 0:
+                self.misses += 1
+                return None
+
+            scores, ids = self._index.search(self._normalize(embedding), min(self.candidates, self._index.ntotal))
+            now = time.time()
+            expired = []
+            found = None
+
+            for score, entry_id in zip(scores[0], ids[0]):
+                if entry_id < 0 or score < self.threshold:
+                    break  # resultados ordenados por similitud descendente
+                entry = self._entries.get(int(entry_id))
+                if entry is None:
+                    continue
+                if self.ttl and now - entry.created_at > self.ttl:
+                    expired.append(int(entry_id))
+                    continue
+                if entry.index_version == index_version:
+                    self._entries.move_to_end(int(entry_id))
+                    found = (entry, float(score))
+                    break
+
+            if expired:
+                self._remove(expired)
+                self.evictions += len(expired)
+
+            if found is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return found
+
+    def add(self, question: str, embedding: np.ndarray, answer: str, context: list[str], index_version: str) -> None:
+        """
+        Stores an answer so near-duplicate questions can reuse it.
+
+        Args:
+            question (str): The answered question.
+            embedding (np.ndarray): Embedding of the question.
+            answer (str): The generated answer.
+            context (list[str]): Context chunks used to produce the answer.
+            index_version (str): Rules index version used for retrieval.
+        """
+        if self.maxsize <= 0:
+            return
+
+        vector = self._normalize(embedding)
+        with self._lock:
+            if self._index is None:
+                self._index = faiss.IndexIDMap2(faiss.IndexFlatIP(vector.shape[1]))
+
+            entry_id = self._next_id
+            self._next_id += 1
+            self._index.add_with_ids(vector, np.array([entry_id], dtype=np.int64))
+            self._entries[entry_id] = CachedAnswer(question, answer, context, index_version, time.time())
+
+            overflow = len(self._entries) - self.maxsize
+            if overflow > 0:
+                oldest = [entry_id for entry_id, _ in zip(self._entries, range(overflow))]
+                self._remove(oldest)
+                self.evictions += overflow
+
+    def clear(self) -> None:
+        """
+        Removes every cached answer.
+        """
+        with self._lock:
+            self._entries.clear()
+            if self._index is not None:
+                self._index.reset()
+
+    def stats(self) -> dict:
+        """
+        Returns size and hit/miss counters.
+        """
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
@@ -0,0 +1,328 @@
+"""
+ask_pipeline.py
+
+Question answering pipeline behind /ask_rule, /ask_rule/stream and /ask_rule/batch:
+
+    retrieval → semantic answer cache → context packing → generation
+
+Questions served by the rule lookup or by confident BM25 skip the answer
+cache: they never reach the embedding model.
+
+History persistence stays in the API layer so every request is recorded,
+whether or not its answer came from the cache.
+"""
+
+import asyncio
+from typing import AsyncIterator
+
+import numpy as np
+
+from app.config import (
+    ANSWER_CACHE_ENABLED,
+    ANSWER_CACHE_THRESHOLD,
+    ANSWER_CACHE_SIZE,
+    ANSWER_CACHE_TTL,
+    ANSWER_CACHE_WARM_ROWS,
+    BATCH_GENERATION_CONCURRENCY,
+    CONTEXT_DEDUP_THRESHOLD,
+    CONTEXT_PACKING_ENABLED,
+    CONTEXT_TOKEN_BUDGET,
+    SINGLE_FLIGHT_ENABLED,
+)
+from app.services.db.history import get_recent_answers
+from app.services.ia import semantic_search
+from app.services.ia.answer_cache import AnswerCache
+from app.services.ia.context_packing import ContextPacker
+from app.services.ia.embedding_cache import normalize_question
+from app.services.ia.generative_answer import (
+    GenerationError,
+    generate_answer_async,
+    stream_answer_tokens,
+)
+from app.services.ia.single_flight import SingleFlight
+from app.services.metrics import stage
+
+answer_cache = AnswerCache(
+    threshold=ANSWER_CACHE_THRESHOLD,
+    maxsize=ANSWER_CACHE_SIZE if ANSWER_CACHE_ENABLED else 0,
+    ttl=ANSWER_CACHE_TTL,
+)
+
+# Preguntas idénticas en vuelo comparten una única búsqueda y generación
+single_flight = SingleFlight()
+
+context_packer = ContextPacker(token_budget=CONTEXT_TOKEN_BUDGET, dedup_threshold=CONTEXT_DEDUP_THRESHOLD)
+
+
+def _pack(context: list[str]) -> tuple[list[str], dict | None]:
+    """
+    Packs the retrieved context for the prompt; returns the chunks to send
+    and the estimated context tokens before/after (None when disabled).
+    """
+    if not CONTEXT_PACKING_ENABLED:
+        return context, None
+    with stage("context"):
+        packed = context_packer.pack(context)
+    return packed.chunks, {"before": packed.tokens_before, "after": packed.tokens_after}
+
+
+async def _cache_embedding(question: str, path: str) -> np.ndarray | None:
+    """
+    Embedding for the answer cache, or None when the cache does not apply:
+    rule-number and confident BM25 questions are answered without the model,
+    so they skip the embedding and the cache. On the vector paths the
+    question was already embedded by the search, so this is a cache hit.
+    """
+    if not ANSWER_CACHE_ENABLED or path not in semantic_search.VECTOR_PATHS:
+        return None
+    return (await semantic_search.embed_questions_async([question]))[0]
+
+
+def warm_answer_cache(limit: int = ANSWER_CACHE_WARM_ROWS) -> int:
+    """
+    Fills the answer cache with recent answers from the history table that
+    were produced with the currently loaded rules index.
+
+    Args:
+        limit (int): Maximum number of history rows to load.
+
+    Returns:
+        int: Number of answers added to the cache.
+    """
+    index_version = semantic_search.get_index_version()
+    if not ANSWER_CACHE_ENABLED or limit <= 0 or index_version is None:
+        return 0
+
+    rows = get_recent_answers(limit, index_version)
+    if not rows:
+        return 0
+
+    # Más antiguas primero para que las recientes sean las últimas en expulsarse
+    rows = rows[::-1]
+    embeddings = semantic_search.embed_questions([row[0] for row in rows])
+    for (question, context, answer), embedding in zip(rows, embeddings):
+        answer_cache.add(question, embedding, answer, context, index_version)
+
+    print(f"♻️ Caché de respuestas precargada con {len(rows)} entradas del historial.")
+    return len(rows)
+
+
+async def answer_question(question: str, top_k: int = 8, use_cache: bool = True) -> dict:
+    """
+    Answers a rules question, reusing a cached answer for near-duplicates.
+
+    Concurrent requests with the same normalized question (and options) are
+    coalesced: one retrieval and one generation serve all of them. Each caller
+    gets its own copy of the result, with its own question text.
+
+    Args:
+        question (str): User's question.
+        top_k (int): Number of context chunks to retrieve.
+        use_cache (bool): Set to False to bypass the answer cache for this request.
+
+    Returns:
+        dict: question, context_used (the packed context sent to the model),
+        answer, index_version, an `error` flag (generation failed; such
+        answers are never cached), a `cached` marker (plus `cache_similarity` and
+        `cached_question` on cache hits, `context_tokens` before/after packing
+        otherwise) and a `coalesced` marker.
+    """
+    if not SINGLE_FLIGHT_ENABLED:
+        return {**await _answer_question(question, top_k, use_cache), "coalesced": False}
+
+    key = (normalize_question(question), top_k, use_cache, semantic_search.get_index_version())
+    result, coalesced = await single_flight.do(key, lambda: _answer_question(question, top_k, use_cache))
+    return {**result, "question": question, "coalesced": coalesced}
+
+
+async def _answer_question(question: str, top_k: int, use_cache: bool) -> dict:
+    index_version = semantic_search.get_index_version()
+
+    # Búsqueda primero: pasa por el micro-batcher y deja el embedding en caché,
+    # así la consulta a la caché de respuestas no vuelve a pasar por el modelo.
+    with stage("retrieval"):
+        context, path = await semantic_search.search_context_async(question, top_k)
+        embedding = await _cache_embedding(question, path)
+
+    if use_cache and embedding is not None:
+        with stage("answer_cache"):
+            hit = answer_cache.lookup(embedding, index_version)
+        if hit is not None:
+            entry, similarity = hit
+            return {
+                "question": question,
+                "context_used": entry.context,
+                "answer": entry.answer,
+                "index_version": index_version,
+                "error": False,
+                "cached": True,
+                "cache_similarity": round(similarity, 4),
+                "cached_question": entry.question,
+            }
+
+    context, context_tokens = _pack(context)
+    with stage("generation"):
+        answer, ok = await generate_answer_async(question, context)
+
+    if embedding is not None and ok:
+        answer_cache.add(question, embedding, answer, context, index_version)
+
+    return {
+        "question": question,
+        "context_used": context,
+        "answer": answer,
+        "index_version": index_version,
+        "error": not ok,
+        "cached": False,
+        "context_tokens": context_tokens,
+    }
+
+
+async def stream_answer(question: str, top_k: int = 8, use_cache: bool = True) -> AsyncIterator[tuple[str, dict]]:
+    """
+    Streaming variant of `answer_question`.
+
+    Yields `(event, data)` pairs: one "context" event as soon as retrieval is
+    done, "token" events while the model generates, and a final "done" event
+    with the complete answer (or "error" if generation failed). A cache hit
+    is sent as a single token. If the consumer stops early nothing is added
+    to the answer cache and the upstream request is closed.
+
+    Args:
+        question (str): User's question.
+        top_k (int): Number of context chunks to retrieve.
+        use_cache (bool): Set to False to bypass the answer cache for this request.
+
+    Yields:
+        tuple[str, dict]: Event name and its JSON-serializable payload.
+    """
+    index_version = semantic_search.get_index_version()
+
+    with stage("retrieval"):
+        context, path = await semantic_search.search_context_async(question, top_k)
+        embedding = await _cache_embedding(question, path)
+
+    if use_cache and embedding is not None:
+        with stage("answer_cache"):
+            hit = answer_cache.lookup(embedding, index_version)
+        if hit is not None:
+            entry, similarity = hit
+            yield "context", {"context_used": entry.context, "index_version": index_version, "cached": True}
+            yield "token", {"text": entry.answer}
+            yield "done", {
+                "answer": entry.answer,
+                "cached": True,
+                "cache_similarity": round(similarity, 4),
+                "cached_question": entry.question,
+            }
+            return
+
+    context, context_tokens = _pack(context)
+    yield "context", {
+        "context_used": context,
+        "index_version": index_version,
+        "cached": False,
+        "context_tokens": context_tokens,
+    }
+
+    parts: list[str] = []
+    try:
+        with stage("generation"):
+            async for delta in stream_answer_tokens(question, context):
+                parts.append(delta)
+                yield "token", {"text": delta}
+    except GenerationError as e:
+        yield "error", {"answer": str(e), "partial": "".join(parts)}
+        return
+
+    answer = "".join(parts).strip()
+    if embedding is not None and answer:
+        answer_cache.add(question, embedding, answer, context, index_version)
+
+    yield "done", {"answer": answer, "cached": False}
+
+
+async def answer_batch(
+    questions: list[str],
+    top_k: int = 8,
+    use_cache: bool = True,
+    concurrency: int = BATCH_GENERATION_CONCURRENCY,
+) -> AsyncIterator[dict]:
+    """
+    Answers many questions at once.
+
+    Retrieval runs once for the whole list (one `encode` call and one
+    multi-query index search); generation then runs concurrently, at most
+    `concurrency` provider calls at a time. Results are yielded in completion
+    order, each with the position of its question in the request. If the
+    consumer stops early the pending generation calls are cancelled.
+
+    Args:
+        questions (list[str]): User questions.
+        top_k (int): Number of context chunks to retrieve per question.
+        use_cache (bool): Set to False to bypass the answer cache.
+        concurrency (int): Maximum concurrent generation calls.
+
+    Yields:
+        dict: The `answer_question` result plus `index` (position in `questions`).
+    """
+    index_version = semantic_search.get_index_version()
+    with stage("retrieval"):
+        results = await semantic_search.search_context_batch_async(questions, top_k)
+        contexts = [context for context, _ in results]
+        # Solo las preguntas de la ruta vectorial usan la caché de respuestas
+        embeddings: list[np.ndarray | None] = [None] * len(questions)
+        vector_ids = [i for i, (_, path) in enumerate(results) if path in semantic_search.VECTOR_PATHS]
+        if ANSWER_CACHE_ENABLED and vector_ids:
+            vectors = await semantic_search.embed_questions_async([questions[i] for i in vector_ids])
+            for i, vector in zip(vector_ids, vectors):
+                embeddings[i] = vector
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def generate(i: int) -> dict:
+        context, context_tokens = _pack(contexts[i])
+        async with semaphore:
+            with stage("generation"):
+                answer, ok = await generate_answer_async(questions[i], context)
+        if embeddings[i] is not None and ok:
+            answer_cache.add(questions[i], embeddings[i], answer, context, index_version)
+        return {
+            "index": i,
+            "question": questions[i],
+            "context_used": context,
+            "answer": answer,
+            "index_version": index_version,
+            "error": not ok,
+            "cached": False,
+            "context_tokens": context_tokens,
+        }
+
+    # Consultar la caché y lanzar todas las generaciones antes del primer yield:
+    # si el consumidor se detiene, el finally cancela todas las tareas
+    hits, tasks = [], []
+    for i in range(len(questions)):
+        hit = answer_cache.lookup(embeddings[i], index_version) if use_cache and embeddings[i] is not None else None
+        if hit is not None:
+            hits.append((i, *hit))
+        else:
+            tasks.append(asyncio.create_task(generate(i)))
+
+    try:
+        for i, entry, similarity in hits:
+            yield {
+                "index": i,
+                "question": questions[i],
+                "context_used": entry.context,
+                "answer": entry.answer,
+                "index_version": index_version,
+                "error": False,
+                "cached": True,
+                "cache_similarity": round(similarity, 4),
+                "cached_question": entry.question,
+            }
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
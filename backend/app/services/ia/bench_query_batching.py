@@ -0,0 +1,122 @@
+"""
+bench_query_batching.py
+
+Benchmarks retrieval with and without the micro-batching scheduler.
+
+For each concurrency level, N clients issue queries back to back for a fixed
+number of requests; the script reports throughput and latency percentiles for
+the direct path (one encode + search per query) and the batched path.
+The embedding cache, the rule lookup and BM25 are disabled so every query
+takes the vector path and pays the forward pass (the generated questions
+name glossary keywords, which the rule lookup would otherwise answer).
+
+Usage:
+    python -m app.services.ia.bench_query_batching --requests 512 --concurrency 1 8 32 64
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from app.services.ia import semantic_search
+from app.services.ia.load_test import QUESTION_TEMPLATES, KEYWORDS
+from app.services.ia.query_batcher import QueryBatcher
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def _make_questions(n: int, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    questions = []
+    for i in range(n):
+        template = rng.choice(QUESTION_TEMPLATES)
+        words = [rng.choice(KEYWORDS) for _ in range(template.count("{}"))]
+        questions.append(f"{template.format(*words)} ({i})")  # único: evita aciertos de caché
+    return questions
+
+
+async def _run_clients(search, questions: list[str], concurrency: int) -> dict:
+    latencies = []
+    queue = list(questions)
+
+    async def client():
+        while queue:
+            question = queue.pop()
+            start = time.perf_counter()
+            await search(question)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "throughput_qps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(_percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(_percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(_percentile(latencies, 99) * 1000, 2),
+    }
+
+
+async def _direct_search(question: str) -> list[str]:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(semantic_search.get_executor(), semantic_search.search_context, question, 8)
+
+
+async def main_async(args) -> list[dict]:
+    results = []
+    batcher = QueryBatcher(
+        semantic_search.search_context_batch,
+        semantic_search.get_executor,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+        max_concurrent_batches=args.concurrent_batches,
+    )
+    await batcher.start()
+
+    for concurrency in args.concurrency:
+        for mode, search in (("direct", _direct_search), ("batched", batcher.search)):
+            questions = _make_questions(args.requests, seed=concurrency)
+            vector_before = semantic_search.retrieval_stats["vector"]
+            stats = await _run_clients(search, questions, concurrency)
+            vector_queries = semantic_search.retrieval_stats["vector"] - vector_before
+            if vector_queries != len(questions):
+                raise RuntimeError(f"{mode}: solo {vector_queries}/{len(questions)} consultas usaron la ruta vectorial")
+            stats.update({"mode": mode, "concurrency": concurrency})
+            results.append(stats)
+            print(f"  {mode:8s} c={concurrency:<3d} {stats}")
+
+    await batcher.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark retrieval micro-batching")
+    parser.add_argument("--requests", type=int, default=512)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32, 64])
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-wait-ms", type=float, default=2.0)
+    parser.add_argument("--concurrent-batches", type=int, default=2)
+    args = parser.parse_args()
+
+    print("📦 Cargando recursos de búsqueda...")
+    semantic_search.load_resources()
+    semantic_search.embedding_cache.maxsize = 0  # medir siempre el forward pass
+    # Sin rutas que eviten el modelo: búsqueda exacta y BM25 desactivadas
+    semantic_search.rule_lookup = None
+    semantic_search.bm25 = None
+    semantic_search.search_context("warmup question")
+
+    print("⏱️ Ejecutando benchmark...")
+    results = asyncio.run(main_async(args))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
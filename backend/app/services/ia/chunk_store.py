@@ -0,0 +1,215 @@
+"""
+chunk_store.py
+
+Compact, memory-mapped store for the rule chunks.
+
+Layout (inside the embeddings directory):
+- chunks.bin               UTF-8 texts concatenated
+- chunks.offsets.npy       uint64 array of n+1 byte offsets into chunks.bin
+- chunks.meta.bin          optional per-chunk metadata, one JSON object per chunk
+- chunks.meta.offsets.npy  offsets into chunks.meta.bin
+
+Readers mmap the files and decode only the chunks they fetch, so worker
+processes share the page cache instead of each unpickling a private list.
+
+Convert a legacy chunks.pkl once with:
+    python -m app.services.ia.chunk_store --convert
+"""
+
+import argparse
+import json
+import mmap
+import os
+import pickle
+
+import numpy as np
+
+from app.config import CHUNKS_PATH, EMBEDDINGS_DIR
+
+BLOB_FILENAME = "chunks.bin"
+OFFSETS_FILENAME = "chunks.offsets.npy"
+META_BLOB_FILENAME = "chunks.meta.bin"
+META_OFFSETS_FILENAME = "chunks.meta.offsets.npy"
+
+
+def _write_blob(items: list[bytes], blob_path: str, offsets_path: str) -> None:
+    offsets = np.zeros(len(items) + 1, dtype=np.uint64)
+    with open(blob_path + ".tmp", "wb") as f:
+        position = 0
+        for i, data in enumerate(items):
+            f.write(data)
+            position += len(data)
+            offsets[i + 1] = position
+
+    np.save(offsets_path + ".tmp.npy", offsets)
+    os.replace(blob_path + ".tmp", blob_path)
+    os.replace(offsets_path + ".tmp.npy", offsets_path)
+
+
+def write_chunk_store(chunks: list[str], output_dir: str = EMBEDDINGS_DIR, metadata: list[dict] | None = None) -> None:
+    """
+    Writes chunks (and optional per-chunk metadata) in the chunk store format.
+
+    Args:
+        chunks (list[str]): Chunk texts; chunk ids are their positions.
+        output_dir (str): Directory where the store files are written.
+        metadata (list[dict] | None): Optional metadata, one dict per chunk
+            (e.g. rule number, section).
+    """
+    if metadata is not None and len(metadata) != len(chunks):
+        raise ValueError("metadata must have one entry per chunk")
+
+    os.makedirs(output_dir, exist_ok=True)
+    _write_blob(
+        [chunk.encode("utf-8") for chunk in chunks],
+        os.path.join(output_dir, BLOB_FILENAME),
+        os.path.join(output_dir, OFFSETS_FILENAME),
+    )
+
+    meta_blob = os.path.join(output_dir, META_BLOB_FILENAME)
+    meta_offsets = os.path.join(output_dir, META_OFFSETS_FILENAME)
+    if metadata is not None:
+        _write_blob(
+            [json.dumps(entry, ensure_ascii=False, separators=(",", ":")).encode("utf-8") for entry in metadata],
+            meta_blob,
+            meta_offsets,
+        )
+    else:
+        # No dejar metadatos de un build anterior desalineados con los chunks nuevos
+        for path in (meta_blob, meta_offsets):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class _MappedBlob:
+    def __init__(self, blob_path: str, offsets_path: str):
+        self.offsets = np.load(offsets_path, mmap_mode="r")
+        self._file = open(blob_path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        # mmap no admite ficheros vacíos
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def get(self, i: int) -> bytes:
+        if not 0 <= i < len(self):
+            raise IndexError(f"chunk id {i} out of range")
+        return self._mm[int(self.offsets[i]):int(self.offsets[i + 1])]
+
+    def close(self) -> None:
+        if isinstance(self._mm, mmap.mmap):
+            self._mm.close()
+        self._file.close()
+
+
+class ChunkStore:
+    """
+    Read-only, id-addressable view over a chunk store directory.
+
+    Supports `len(store)`, `store[i]` and iteration, so it can replace the
+    list previously loaded from chunks.pkl.
+
+    Args:
+        directory (str): Directory containing the store files.
+    """
+
+    def __init__(self, directory: str = EMBEDDINGS_DIR):
+        self.directory = directory
+        self._texts = _MappedBlob(
+            os.path.join(directory, BLOB_FILENAME),
+            os.path.join(directory, OFFSETS_FILENAME),
+        )
+        self._meta = None
+        meta_blob = os.path.join(directory, META_BLOB_FILENAME)
+        if os.path.exists(meta_blob):
+            self._meta = _MappedBlob(meta_blob, os.path.join(directory, META_OFFSETS_FILENAME))
+
+    def __len__(self) -> int:
+        return len(self._texts)
+
+    def __getitem__(self, chunk_id: int) -> str:
+        return self._texts.get(int(chunk_id)).decode("utf-8")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def get_many(self, chunk_ids) -> list[str]:
+        """
+        Returns the texts of several chunks, in the given order.
+        """
+        return [self[i] for i in chunk_ids]
+
+    @property
+    def has_metadata(self) -> bool:
+        return self._meta is not None
+
+    def metadata(self, chunk_id: int) -> dict:
+        """
+        Returns the metadata stored for a chunk ({} if the store has none).
+        """
+        if self._meta is None:
+            return {}
+        return json.loads(self._meta.get(int(chunk_id)))
+
+    def close(self) -> None:
+        self._texts.close()
+        if self._meta is not None:
+            self._meta.close()
+
+
+def open_chunk_store(directory: str = EMBEDDINGS_DIR) -> ChunkStore:
+    """
+    Opens the chunk store, with a hint when only a legacy chunks.pkl exists.
+
+    Args:
+        directory (str): Directory containing the store files.
+
+    Returns:
+        ChunkStore: The opened store.
+    """
+    if not os.path.exists(os.path.join(directory, OFFSETS_FILENAME)):
+        legacy = os.path.join(directory, os.path.basename(CHUNKS_PATH))
+        hint = (
+            f" Found legacy {legacy}; convert it with: python -m app.services.ia.chunk_store --convert"
+            if os.path.exists(legacy) else ""
+        )
+        raise FileNotFoundError(f"Chunk store not found in {directory}.{hint}")
+    return ChunkStore(directory)
+
+
+def convert_pickle(pkl_path: str = CHUNKS_PATH, output_dir: str = EMBEDDINGS_DIR) -> int:
+    """
+    One-shot conversion of a legacy chunks.pkl into the chunk store format.
+
+    Args:
+        pkl_path (str): Path to the pickled list of chunks (trusted, produced by us).
+        output_dir (str): Directory where the store files are written.
+
+    Returns:
+        int: Number of converted chunks.
+    """
+    with open(pkl_path, "rb") as f:
+        chunks = pickle.load(f)
+    write_chunk_store(list(chunks), output_dir)
+    return len(chunks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chunk store utilities")
+    parser.add_argument("--convert", action="store_true", help="Convert chunks.pkl into the chunk store format")
+    parser.add_argument("--pkl", default=CHUNKS_PATH)
+    parser.add_argument("--output-dir", default=EMBEDDINGS_DIR)
+    args = parser.parse_args()
+
+    if args.convert:
+        count = convert_pickle(args.pkl, args.output_dir)
+        print(f"✅ Convertidos {count} chunks a {args.output_dir}")
+    else:
+        store = open_chunk_store(args.output_dir)
+        print(f"📦 {len(store)} chunks en {args.output_dir} (metadatos: {'sí' if store.has_metadata else 'no'})")
+
+
+if __name__ == "__main__":
+    main()
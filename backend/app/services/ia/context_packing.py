@@ -0,0 +1,181 @@
+"""
+context_packing.py
+
+Token-budgeted packing of the retrieved context before generation.
+
+Retrieval returns chunks best first, but several of them can overlap (a
+rule lookup hit and its vector neighbours, continuation chunks that repeat
+the rule heading) and together they can exceed what the answer needs. The
+packer, in relevance order:
+
+1. normalizes whitespace padding;
+2. drops exact duplicates, chunks contained in an already kept chunk and
+   near-duplicates (word-shingle Jaccard similarity);
+3. keeps chunks while they fit in the token budget (the best chunk is
+   truncated at a line boundary if it alone exceeds it).
+
+Token counts are estimates (no provider tokenizer is available offline), good
+enough to compare prompt sizes before and after packing.
+"""
+
+import re
+import threading
+from dataclasses import dataclass
+
+_PIECE_RE = re.compile(r"\w+|[^\w\s]")
+_BLANK_LINES_RE = re.compile(r"\n\s*\n+")
+_SPACES_RE = re.compile(r"[ \t]+")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimates the number of BPE tokens of a text: one per punctuation mark or
+    short word, plus one per extra 6 characters of long words.
+    """
+    return sum(1 + len(piece) // 6 for piece in _PIECE_RE.findall(text))
+
+
+def _clean(text: str) -> str:
+    text = _SPACES_RE.sub(" ", text.strip())
+    return _BLANK_LINES_RE.sub("\n", text)
+
+
+def _shingles(text: str, n: int = 3) -> set[tuple[str, ...]]:
+    words = text.lower().split()
+    if len(words) < n:
+        return {tuple(words)}
+    return {tuple(words[i:i + n]) for i in range(len(words) - n + 1)}
+
+
+def _truncate(text: str, budget: int) -> str:
+    """
+    Cuts a chunk to at most `budget` tokens, at a line boundary when possible.
+    """
+    kept: list[str] = []
+    used = 0
+    for line in text.split("\n"):
+        tokens = estimate_tokens(line)
+        if used + tokens > budget:
+            break
+        kept.append(line)
+        used += tokens
+    if kept:
+        return "\n".join(kept)
+
+    # Primera línea demasiado larga: cortar por palabras
+    result: list[str] = []
+    for word in text.split():
+        used += estimate_tokens(word)
+        if used > budget:
+            break
+        result.append(word)
+    return " ".join(result)
+
+
+@dataclass
+class PackedContext:
+    """
+    Result of packing: the chunks for the prompt and their token counts.
+    """
+    chunks: list[str]
+    tokens_before: int
+    tokens_after: int
+    duplicates_dropped: int
+    budget_dropped: int
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.tokens_before - self.tokens_after
+
+
+class ContextPacker:
+    """
+    Deduplicates and trims context chunks to a token budget, keeping
+    aggregate counters of the tokens saved.
+
+    Args:
+        token_budget (int): Maximum estimated tokens of context per prompt (0 = no limit).
+        dedup_threshold (float): Shingle Jaccard similarity above which a chunk
+            counts as a near-duplicate of a better ranked one.
+    """
+
+    def __init__(self, token_budget: int = 1200, dedup_threshold: float = 0.8):
+        self.token_budget = token_budget
+        self.dedup_threshold = dedup_threshold
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self.duplicates_dropped = 0
+        self.budget_dropped = 0
+
+    def _is_redundant(self, text: str, shingles: set, kept: list[tuple[str, set]]) -> bool:
+        for other, other_shingles in kept:
+            if text in other:
+                return True
+            union = len(shingles | other_shingles)
+            if union and len(shingles & other_shingles) / union >= self.dedup_threshold:
+                return True
+        return False
+
+    def pack(self, chunks: list[str]) -> PackedContext:
+        """
+        Packs retrieved chunks for the prompt.
+
+        Args:
+            chunks (list[str]): Retrieved chunks, best first.
+
+        Returns:
+            PackedContext: Kept chunks (still best first) and token counts.
+        """
+        tokens_before = sum(estimate_tokens(chunk) for chunk in chunks)
+
+        unique: list[tuple[str, set]] = []
+        duplicates = 0
+        for chunk in chunks:
+            text = _clean(chunk)
+            if not text:
+                continue
+            shingles = _shingles(text)
+            if self._is_redundant(text, shingles, unique):
+                duplicates += 1
+                continue
+            unique.append((text, shingles))
+
+        packed: list[str] = []
+        used = 0
+        over_budget = 0
+        for text, _ in unique:
+            tokens = estimate_tokens(text)
+            if self.token_budget and used + tokens > self.token_budget:
+                if not packed:
+                    text = _truncate(text, self.token_budget)
+                    tokens = estimate_tokens(text)
+                else:
+                    # Seguir: un chunk posterior más corto aún puede caber
+                    over_budget += 1
+                    continue
+            packed.append(text)
+            used += tokens
+
+        result = PackedContext(packed, tokens_before, used, duplicates, over_budget)
+        with self._lock:
+            self.requests += 1
+            self.tokens_before += tokens_before
+            self.tokens_after += used
+            self.duplicates_dropped += duplicates
+            self.budget_dropped += over_budget
+        return result
+
+    def stats(self) -> dict:
+        saved = self.tokens_before - self.tokens_after
+        return {
+            "token_budget": self.token_budget,
+            "requests": self.requests,
+            "tokens_before": self.tokens_before,
+            "tokens_after": self.tokens_after,
+            "tokens_saved": saved,
+            "saved_ratio": round(saved / self.tokens_before, 4) if self.tokens_before else 0.0,
+            "duplicates_dropped": self.duplicates_dropped,
+            "budget_dropped": self.budget_dropped,
+        }
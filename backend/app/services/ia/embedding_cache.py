@@ -0,0 +1,150 @@
+"""
+embedding_cache.py
+
+Bounded, thread-safe caches used by the retrieval pipeline.
+
+- `TTLCache`: generic LRU cache with a maximum size and a time-to-live.
+- `EmbeddingCache`: query-embedding cache keyed on the normalized question,
+  invalidated automatically when the embedding model changes.
+"""
+
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_EDGE_PUNCTUATION = " \t\n¿?¡!.,;:\"'"
+
+
+def normalize_question(question: str) -> str:
+    """
+    Normalizes a question so trivially different spellings share a cache key.
+
+    Applies NFKC, lowercasing, whitespace collapsing and strips surrounding
+    punctuation ("¿Qué es trample?" and "qué es  trample" map to the same key).
+
+    Args:
+        question (str): Raw question text.
+
+    Returns:
+        str: Normalized question.
+    """
+    text = unicodedata.normalize("NFKC", question).lower()
+    text = _WHITESPACE_RE.sub(" ", text)
+    return text.strip(_EDGE_PUNCTUATION)
+
+
+class TTLCache:
+    """
+    LRU cache with a maximum number of entries and a per-entry TTL.
+
+    Args:
+        maxsize (int): Maximum number of entries (0 disables the cache).
+        ttl (float): Seconds an entry stays valid (0 = no expiry).
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Returns the cached value for `key`, or None if missing or expired.
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+
+            value, stored_at = item
+            if self.ttl and time.monotonic() - stored_at > self.ttl:
+                del self._data[key]
+                self.misses += 1
+                return None
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value) -> None:
+        """
+        Stores `value` under `key`, evicting the least recently used entries.
+        """
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """
+        Removes every entry (counters are kept).
+        """
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        """
+        Returns size and hit/miss counters.
+        """
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+class EmbeddingCache(TTLCache):
+    """
+    Cache of query embeddings keyed on the normalized question.
+
+    Entries belong to one embedding model: asking with a different `model_id`
+    clears the cache, so vectors from an old model are never reused.
+    """
+
+    def __init__(self, maxsize: int = 4096, ttl: float = 3600, model_id: str | None = None):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self.model_id = model_id
+
+    def _check_model(self, model_id: str) -> None:
+        with self._lock:
+            if model_id != self.model_id:
+                self._data.clear()
+                self.model_id = model_id
+
+    def get_embedding(self, question: str, model_id: str):
+        """
+        Returns the cached embedding for `question` under `model_id`, or None.
+        """
+        self._check_model(model_id)
+        return self.get(normalize_question(question))
+
+    def put_embedding(self, question: str, model_id: str, embedding) -> None:
+        """
+        Stores the embedding for `question` computed with `model_id`.
+        """
+        self._check_model(model_id)
+        self.put(normalize_question(question), embedding)
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats["model_id"] = self.model_id
+        return stats
@@ -1,23 +1,330 @@
+import hashlib
+import json
+import os
+import time
+from datetime import datetime, timezone
+
 import faiss
 from sentence_transformers import SentenceTransformer
 import numpy as np
-import pickle
 
-def build_faiss_index(chunks: list[str], model_id: str = "all-MiniLM-L6-v2", output_dir: str = "./data/embeddings") -> None:
+from app.services.ia.chunk_store import write_chunk_store
+
+INDEX_META_FILENAME = "index_meta.json"
+CHUNK_MANIFEST_FILENAME = "chunk_manifest.json"
+CHUNK_VECTORS_FILENAME = "chunk_vectors.npy"
+
+# Alias legibles → cadenas de faiss.index_factory
+INDEX_SPEC_ALIASES = {
+    "flat": "Flat",
+    "ivf": "IVF{nlist},Flat",
+    "ivfsq8": "IVF{nlist},SQ8",
+    "ivfpq": "IVF{nlist},PQ{pq_m}",
+    "sq8": "SQ8",
+    "hnsw": "HNSW32",
+    "hnswsq8": "HNSW32,SQ8",
+}
+
+
+def resolve_index_spec(index_spec: str, num_vectors: int, dim: int) -> str:
+    """
+    Turns an alias ('flat', 'ivf', 'hnsw', 'ivfpq', 'sq8', ...) into a
+    faiss.index_factory string. Any other string is passed through unchanged,
+    so full factory specs like 'IVF1024,PQ32' or 'HNSW64' also work.
+
+    Args:
+        index_spec (str): Alias or factory string.
+        num_vectors (int): Number of vectors to index (sizes the IVF lists).
+        dim (int): Embedding dimension (sizes the PQ sub-quantizers).
+
+    Returns:
+        str: faiss.index_factory string.
+    """
+    template = INDEX_SPEC_ALIASES.get(index_spec.lower())
+    if template is None:
+        return index_spec
+
+    # Regla habitual: ~4·sqrt(N) listas, con al menos ~39 puntos de entrenamiento por lista
+    nlist = max(1, min(int(4 * np.sqrt(num_vectors)), num_vectors // 39))
+    pq_m = next(m for m in (32, 16, 8, 4, 2, 1) if dim % m == 0 and m <= dim)
+    return template.format(nlist=nlist, pq_m=pq_m)
+
+
+def apply_search_params(index: faiss.Index, nprobe: int | None = None, ef_search: int | None = None) -> None:
+    """
+    Sets query-time parameters on IVF (nprobe) and HNSW (efSearch) indexes.
+    Parameters that do not apply to the index type are ignored.
+    """
+    params = faiss.ParameterSpace()
+    for name, value in (("nprobe", nprobe), ("efSearch", ef_search)):
+        if not value:
+            continue
+        try:
+            params.set_index_parameter(index, name, value)
+        except RuntimeError:
+            pass  # el tipo de índice no tiene ese parámetro
+
+
+def chunk_hash(text: str, model_id: str) -> str:
+    """
+    Content hash of a chunk for a given embedding model.
+    """
+    return hashlib.sha256(f"{model_id}\0{text}".encode("utf-8")).hexdigest()
+
+
+def _load_manifest(output_dir: str, model_id: str) -> tuple[dict[str, int], np.ndarray | None]:
+    manifest_path = os.path.join(output_dir, CHUNK_MANIFEST_FILENAME)
+    vectors_path = os.path.join(output_dir, CHUNK_VECTORS_FILENAME)
+    if not (os.path.exists(manifest_path) and os.path.exists(vectors_path)):
+        return {}, None
+
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("model_id") != model_id:
+        return {}, None
+
+    vectors = np.load(vectors_path, mmap_mode="r")
+    return {h: row for row, h in enumerate(manifest["hashes"])}, vectors
+
+
+def embed_chunks_incremental(chunks: list[str], model_id: str, output_dir: str) -> tuple[np.ndarray, dict]:
+    """
+    Embeds chunks reusing the vectors cached by the previous build.
+
+    A manifest with the content hash of every chunk is stored next to the cached
+    vectors (`chunk_manifest.json` + `chunk_vectors.npy`); only chunks whose hash
+    is new are sent through the model. The cache is rewritten for the current
+    chunk list, so removed chunks are dropped.
+
+    Args:
+        chunks (list[str]): Current chunk texts.
+        model_id (str): Name of the sentence transformer model.
+        output_dir (str): Directory holding the manifest and cached vectors.
+
+    Returns:
+        tuple[np.ndarray, dict]: float32 embeddings in chunk order and reuse stats.
+
+    Raises:
+        ValueError: If `chunks` is empty (the embedding dimension is unknown
+            and there is nothing to index).
+    """
+    if not chunks:
+        raise ValueError("No chunks to embed: check the rules file and the chunking parameters")
+
+    previous, old_vectors = _load_manifest(output_dir, model_id)
+    hashes = [chunk_hash(chunk, model_id) for chunk in chunks]
+
+    new_rows = {}
+    for i, h in enumerate(hashes):
+        if h not in previous and h not in new_rows:
+            new_rows[h] = i
+
+    new_vectors = None
+    if new_rows:
+        model = SentenceTransformer(model_id)
+        new_vectors = model.encode([chunks[i] for i in new_rows.values()], convert_to_numpy=True).astype(np.float32)
+
+    dim = new_vectors.shape[1] if new_vectors is not None else old_vectors.shape[1]
+    embeddings = np.empty((len(chunks), dim), dtype=np.float32)
+    new_positions = {h: pos for pos, h in enumerate(new_rows)}
+    for i, h in enumerate(hashes):
+        if h in new_positions:
+            embeddings[i] = new_vectors[new_positions[h]]
+        else:
+            embeddings[i] = old_vectors[previous[h]]
+
+    current = set(hashes)
+    stats = {
+        "reused": sum(1 for h in hashes if h in previous),
+        "added": len(new_rows),
+        "removed": sum(1 for h in previous if h not in current),
+    }
+
+    # Escribir primero a un temporal: un fallo no deja la caché a medias
+    tmp_vectors = os.path.join(output_dir, "chunk_vectors.tmp.npy")
+    np.save(tmp_vectors, embeddings)
+    del old_vectors  # liberar el mmap antes de reemplazar el fichero
+    os.replace(tmp_vectors, os.path.join(output_dir, CHUNK_VECTORS_FILENAME))
+
+    manifest_path = os.path.join(output_dir, CHUNK_MANIFEST_FILENAME)
+    with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"model_id": model_id, "hashes": hashes}, f)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+    print(f"♻️ Chunks reutilizados: {stats['reused']} | nuevos: {stats['added']} | eliminados: {stats['removed']}")
+    return embeddings, stats
+
+
+def _build_index(embeddings: np.ndarray, factory: str, metric: str) -> faiss.Index:
+    faiss_metric = faiss.METRIC_INNER_PRODUCT if metric == "ip" else faiss.METRIC_L2
+    index = faiss.index_factory(embeddings.shape[1], factory, faiss_metric)
+    if not index.is_trained:
+        index.train(embeddings)
+    index.add(embeddings)
+    return index
+
+
+def evaluate_index(index: faiss.Index, baseline: faiss.Index, queries: np.ndarray, k: int = 8) -> dict:
+    """
+    Measures recall@k of an index against an exact baseline and its per-query latency.
+
+    Args:
+        index (faiss.Index): Candidate index (search params already applied).
+        baseline (faiss.Index): Exact index over the same vectors and metric.
+        queries (np.ndarray): Query vectors.
+        k (int): Number of neighbours.
+
+    Returns:
+        dict: recall_at_k and latency percentiles in milliseconds.
+    """
+    _, expected = baseline.search(queries, k)
+
+    latencies = []
+    found = np.empty_like(expected)
+    for i, query in enumerate(queries):
+        start = time.perf_counter()
+        _, ids = index.search(query.reshape(1, -1), k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        found[i] = ids[0]
+
+    hits = sum(len(set(e) & set(f)) for e, f in zip(expected, found))
+    latencies = np.array(latencies)
+    return {
+        "k": k,
+        "queries": len(queries),
+        "recall_at_k": round(hits / expected.size, 4),
+        "latency_ms_p50": round(float(np.percentile(latencies, 50)), 4),
+        "latency_ms_p95": round(float(np.percentile(latencies, 95)), 4),
+        "latency_ms_p99": round(float(np.percentile(latencies, 99)), 4),
+    }
+
+
+def held_out_recall(embeddings: np.ndarray, factory: str, metric: str, num_queries: int,
+                    nprobe: int | None = None, ef_search: int | None = None, seed: int = 0) -> dict:
+    """
+    Recall@k of an index type measured with held-out queries.
+
+    A query taken from the indexed vectors is always its own nearest
+    neighbour, which inflates the recall of approximate indexes. Here a sample
+    of vectors is left out: the candidate index and the exact baseline are
+    built over the rest, and the held-out vectors are the queries.
+
+    Args:
+        embeddings (np.ndarray): All chunk vectors (already normalized for cosine).
+        factory (str): faiss.index_factory string of the candidate index.
+        metric (str): 'l2' or 'ip'.
+        num_queries (int): Vectors held out as queries (at most 10% of the data).
+        nprobe (int | None): IVF lists visited per query.
+        ef_search (int | None): HNSW search breadth.
+        seed (int): Seed of the held-out sample.
+
+    Returns:
+        dict: `evaluate_index` report of the candidate, with the baseline's under "baseline".
+    """
+    rng = np.random.default_rng(seed)
+    size = max(1, min(num_queries, len(embeddings) // 10))
+    held_out = np.zeros(len(embeddings), dtype=bool)
+    held_out[rng.choice(len(embeddings), size=size, replace=False)] = True
+    queries, indexed = embeddings[held_out], embeddings[~held_out]
+
+    index = _build_index(indexed, factory, metric)
+    apply_search_params(index, nprobe=nprobe, ef_search=ef_search)
+    baseline = _build_index(indexed, "Flat", metric)
+
+    report = evaluate_index(index, baseline, queries)
+    report["baseline"] = evaluate_index(baseline, baseline, queries)
+    return report
+
+
+def build_faiss_index(
+    chunks: list[str],
+    model_id: str = "all-MiniLM-L6-v2",
+    output_dir: str = "./data/embeddings",
+    index_spec: str = "flat",
+    metric: str = "l2",
+    nprobe: int = 16,
+    ef_search: int = 64,
+    eval_queries: int = 200,
+    incremental: bool = True,
+    metadata: list[dict] | None = None,
+) -> dict:
     """
     Builds a FAISS index from a list of text chunks and saves it along with the chunk data.
 
+    Chunks are written in the memory-mapped chunk store format (see chunk_store).
+    Besides `faiss.index` and the chunks, writes `index_meta.json` describing the
+    index type, metric and search parameters so `semantic_search` can load it
+    correctly, and prints recall@k against an exact flat baseline.
+
     Args:
         chunks (list): List of strings representing rule chunks.
         model_id (str): Name of the sentence transformer model.
         output_dir (str): Directory to store the FAISS index and chunks.
+        index_spec (str): 'flat', 'ivf', 'ivfsq8', 'ivfpq', 'sq8', 'hnsw', 'hnswsq8'
+            or any faiss.index_factory string.
+        metric (str): 'l2' (raw embeddings) or 'cosine' (normalized vectors, inner product).
+        nprobe (int): IVF lists visited per query.
+        ef_search (int): HNSW search breadth.
+        eval_queries (int): Chunks held out as queries for the recall report (0 = skip); see
+            `held_out_recall`.
+        incremental (bool): Reuse cached vectors of unchanged chunks (see
+            `embed_chunks_incremental`); False re-embeds everything.
+        metadata (list[dict] | None): Optional per-chunk metadata for the chunk store.
+
+    Returns:
+        dict: The metadata written to `index_meta.json`.
     """
-    model = SentenceTransformer(model_id)
-    embeddings = model.encode(chunks, convert_to_numpy=True)
+    if metric not in ("l2", "cosine"):
+        raise ValueError(f"Unsupported metric: {metric}")
 
-    index = faiss.IndexFlatL2(embeddings.shape[1])
-    index.add(embeddings)
+    embed_start = time.perf_counter()
+    if incremental:
+        embeddings, reuse_stats = embed_chunks_incremental(chunks, model_id, output_dir)
+    else:
+        model = SentenceTransformer(model_id)
+        embeddings = model.encode(chunks, convert_to_numpy=True).astype(np.float32)
+        reuse_stats = {"reused": 0, "added": len(chunks), "removed": 0}
+    embed_seconds = time.perf_counter() - embed_start
+
+    normalize = metric == "cosine"
+    if normalize:
+        faiss.normalize_L2(embeddings)
+    faiss_metric = "ip" if normalize else "l2"
+
+    factory = resolve_index_spec(index_spec, len(embeddings), embeddings.shape[1])
+    start = time.perf_counter()
+    index = _build_index(embeddings, factory, faiss_metric)
+    build_seconds = time.perf_counter() - start
+    apply_search_params(index, nprobe=nprobe, ef_search=ef_search)
+
+    report = None
+    if eval_queries and factory != "Flat":
+        report = held_out_recall(embeddings, factory, faiss_metric, eval_queries, nprobe, ef_search)
+        print(f"📏 {factory}: recall@{report['k']} = {report['recall_at_k']:.3f} | "
+              f"p50 {report['latency_ms_p50']:.3f} ms vs flat {report['baseline']['latency_ms_p50']:.3f} ms")
 
     faiss.write_index(index, f"{output_dir}/faiss.index")
-    with open(f"{output_dir}/chunks.pkl", "wb") as f:
-        pickle.dump(chunks, f)
+    write_chunk_store(chunks, output_dir, metadata)
+
+    built_at = datetime.now(timezone.utc).isoformat()
+    meta = {
+        "version": hashlib.sha1(f"{factory}|{model_id}|{built_at}".encode()).hexdigest()[:12],
+        "built_at": built_at,
+        "model_id": model_id,
+        "index_factory": factory,
+        "metric": faiss_metric,
+        "normalize": normalize,
+        "dim": int(embeddings.shape[1]),
+        "num_vectors": int(index.ntotal),
+        "nprobe": nprobe,
+        "ef_search": ef_search,
+        "embed_seconds": round(embed_seconds, 3),
+        "build_seconds": round(build_seconds, 3),
+        "chunks": reuse_stats,
+        "index_bytes": os.path.getsize(f"{output_dir}/faiss.index"),
+        "evaluation": report,
+    }
+    with open(os.path.join(output_dir, INDEX_META_FILENAME), "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+
+    return meta
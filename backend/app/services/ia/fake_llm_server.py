@@ -0,0 +1,121 @@
+"""
+fake_llm_server.py
+
+Local stand-in for the OpenRouter chat completions API, for testing the
+streaming endpoint and load tests without network or API costs.
+
+Implements POST /v1/chat/completions in both modes: a single JSON body, or
+OpenAI-style server-sent events when the request has `"stream": true`.
+Latency is configurable (time to first token and delay between tokens).
+The in-process equivalent is GENERATION_BACKEND=fake.
+
+Run it and point the backend at it:
+    python -m app.services.ia.fake_llm_server --port 8001 --first-token-ms 300 --token-ms 20
+    GENERATION_BACKEND=openai OPENAI_COMPAT_API_URL=http://127.0.0.1:8001/v1/chat/completions uvicorn app.main:app
+"""
+
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+from app.config import FAKE_FIRST_TOKEN_MS, FAKE_TOKEN_MS, FAKE_TOKENS
+from app.services.ia.generation_backends import fake_answer_tokens
+
+FIRST_TOKEN_MS = FAKE_FIRST_TOKEN_MS
+TOKEN_MS = FAKE_TOKEN_MS
+NUM_TOKENS = FAKE_TOKENS
+
+app = FastAPI(title="Fake LLM")
+app.state.stats = {"requests": 0, "streams": 0, "streams_completed": 0, "streams_cancelled": 0}
+
+
+def _question(prompt: str) -> str:
+    return prompt.rsplit("### Pregunta:", 1)[-1].split("### Respuesta:", 1)[0].strip()
+
+
+def _chunk(completion_id: str, model: str, content: str | None, finish_reason: str | None = None) -> str:
+    delta = {"content": content} if content is not None else {}
+    body = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(body, ensure_ascii=False)}\n\n"
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    app.state.stats["requests"] += 1
+
+    model = body.get("model", "fake/model")
+    prompt = body["messages"][-1]["content"]
+    count = min(NUM_TOKENS, int(body.get("max_tokens") or NUM_TOKENS))
+    # Mismas respuestas que el backend "fake" en proceso
+    tokens = fake_answer_tokens(_question(prompt), count)
+    completion_id = f"fake-{uuid.uuid4().hex[:12]}"
+
+    if not body.get("stream"):
+        await asyncio.sleep((FIRST_TOKEN_MS + TOKEN_MS * len(tokens)) / 1000)
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": len(prompt.split()), "completion_tokens": len(tokens)},
+        }
+
+    app.state.stats["streams"] += 1
+
+    async def events():
+        try:
+            # Igual que OpenRouter: comentario SSE mientras el modelo arranca
+            yield ": OPENROUTER PROCESSING\n\n"
+            await asyncio.sleep(FIRST_TOKEN_MS / 1000)
+            for token in tokens:
+                yield _chunk(completion_id, model, token)
+                await asyncio.sleep(TOKEN_MS / 1000)
+            yield _chunk(completion_id, model, None, "stop")
+            yield "data: [DONE]\n\n"
+            app.state.stats["streams_completed"] += 1
+        except asyncio.CancelledError:
+            # El cliente cerró la conexión a mitad de respuesta
+            app.state.stats["streams_cancelled"] += 1
+            raise
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.get("/stats")
+def stats():
+    return app.state.stats
+
+
+def main():
+    global FIRST_TOKEN_MS, TOKEN_MS, NUM_TOKENS
+
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible streaming LLM server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--first-token-ms", type=float, default=FIRST_TOKEN_MS)
+    parser.add_argument("--token-ms", type=float, default=TOKEN_MS)
+    parser.add_argument("--tokens", type=int, default=NUM_TOKENS)
+    args = parser.parse_args()
+
+    FIRST_TOKEN_MS, TOKEN_MS, NUM_TOKENS = args.first_token_ms, args.token_ms, args.tokens
+    print(f"🤖 Fake LLM en http://{args.host}:{args.port}/v1/chat/completions "
+          f"(primer token {FIRST_TOKEN_MS} ms, {TOKEN_MS} ms/token, {NUM_TOKENS} tokens)")
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
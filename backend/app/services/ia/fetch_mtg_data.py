@@ -1,8 +1,32 @@
+"""
+fetch_mtg_data.py
+
+Downloads the MTGJSON and Scryfall bulk datasets into data/training_data.
+
+- Downloads stream to `<file>.part` in 1 MB chunks while the SHA-256 is
+  computed incrementally, then replace the old file with an atomic rename:
+  memory stays at a few MB whatever the file size, and a failed download
+  never leaves a truncated dataset behind.
+- `<file>.meta` (JSON) keeps the hash, ETag and Last-Modified of the last
+  download; the next run sends If-None-Match / If-Modified-Since and a 304
+  skips the transfer. Old plain-hash .meta files are still read.
+- An interrupted transfer resumes from the .part file with a Range request
+  (If-Range makes the server send the whole file again if it changed).
+- Independent files download in parallel (`DOWNLOAD_WORKERS`).
+
+The source URLs can be pointed at a local HTTP server
+(MTGJSON_BASE_URL, SCRYFALL_BULK_ENDPOINT).
+
+Usage:
+    python -m app.services.ia.fetch_mtg_data
+"""
+
 import os
 import requests
 import hashlib
 import json
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
 
 # === CONFIGURACION ===
 PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../../.."))
@@ -13,80 +37,200 @@ SCRYFALL_DIR = os.path.join(DATA_DIR, "scryfall")
 os.makedirs(MTGJSON_DIR, exist_ok=True)
 os.makedirs(SCRYFALL_DIR, exist_ok=True)
 
+CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "4"))
+TIMEOUT = (10, 60)  # conexión, lectura entre bloques (segundos)
+
+
+def sha256sum_from_file(path, hasher=None):
+    hasher = hasher or hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b""):
+            hasher.update(block)
+    return hasher
+
+def load_meta(meta_path):
+    """
+    Reads a .meta file: JSON with sha256/etag/last_modified, or the legacy
+    format holding only the hex digest.
+    """
+    if not os.path.exists(meta_path):
+        return {}
+    with open(meta_path, "r") as f:
+        content = f.read().strip()
+    try:
+        meta = json.loads(content)
+    except json.JSONDecodeError:
+        meta = None
+    return meta if isinstance(meta, dict) else {"sha256": content}
+
+def write_meta(meta_path, meta):
+    with open(meta_path + ".tmp", "w") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(meta_path + ".tmp", meta_path)
+
+def _validators(response):
+    return {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+
+def download_file(url, dest_path, session=None):
+    """
+    Downloads `url` to `dest_path` if it changed since the last download.
+
+    Args:
+        url (str): Source URL.
+        dest_path (str): Final path of the file.
+        session (requests.Session | None): Session to use (one per thread).
+
+    Returns:
+        str: "updated", "unchanged" (same content downloaded again) or
+        "not_modified" (304, nothing transferred).
+    """
+    http = session or requests
+    name = os.path.basename(dest_path)
+    meta_path = dest_path + ".meta"
+    part_path = dest_path + ".part"
+    part_meta_path = part_path + ".meta"
+    meta = load_meta(meta_path)
+
+    # Sin compresión de transporte: los rangos y Content-Length se refieren a los bytes del fichero
+    headers = {"Accept-Encoding": "identity"}
+    if os.path.exists(dest_path):
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    # Reanudar una descarga a medias: solo si sabemos de qué versión es
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    part_meta = load_meta(part_meta_path) if offset else {}
+    # If-Range exige un ETag fuerte; si es débil, usar Last-Modified
+    etag = part_meta.get("etag")
+    validator = etag if etag and not etag.startswith("W/") else part_meta.get("last_modified")
+    if offset and validator and part_meta.get("url") == url:
+        headers["Range"] = f"bytes={offset}-"
+        headers["If-Range"] = validator
+    else:
+        offset = 0
+
+    with http.get(url, headers=headers, stream=True, timeout=TIMEOUT) as r:
+        if r.status_code == 304:
+            print(f"⏭️  Sin cambios (304): {name}")
+            return "not_modified"
+        resumed = r.status_code == 206 and r.headers.get("Content-Range", "").startswith(f"bytes {offset}-")
+        if r.status_code == 416 or (r.status_code == 206 and not resumed):
+            # Rango rechazado o inesperado: descartar el .part y empezar de cero la próxima vez
+            for path in (part_path, part_meta_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise IOError(f"{name}: rango no válido ({r.status_code}), se descargará completo")
+        r.raise_for_status()
 
-def sha256sum_from_bytes(data):
-    return hashlib.sha256(data).hexdigest()
-
-def save_if_changed(path, data):
-    new_hash = sha256sum_from_bytes(data)
-    meta_path = path + ".meta"
-    old_hash = None
-
-    if os.path.exists(meta_path):
-        with open(meta_path, "r") as f:
-            old_hash = f.read().strip()
-
-    if new_hash != old_hash:
-        with open(path, "wb") as f:
-            f.write(data)
-        with open(meta_path, "w") as f:
-            f.write(new_hash)
-        print(f"✅ Archivo actualizado: {os.path.basename(path)}")
+        hasher = hashlib.sha256()
+        if resumed:
+            sha256sum_from_file(part_path, hasher)
+            mode = "ab"
+            print(f"↩️  Reanudando {name} desde {offset / 1e6:.1f} MB")
+        else:
+            # 200: el servidor ignora el rango o el fichero cambió → empezar de cero
+            offset = 0
+            mode = "wb"
+        write_meta(part_meta_path, {"url": url, **_validators(r)})
+
+        expected = r.headers.get("Content-Length")
+        received = 0
+        with open(part_path, mode) as f:
+            for block in r.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(block)
+                hasher.update(block)
+                received += len(block)
+
+        if expected is not None and received != int(expected):
+            # Se conserva el .part para reanudar en la próxima ejecución
+            raise IOError(f"{name}: recibidos {received} de {expected} bytes")
+        validators = _validators(r)
+
+    new_hash = hasher.hexdigest()
+    new_meta = {
+        "sha256": new_hash,
+        **validators,
+        "url": url,
+        "size": offset + received,
+        "fetched_at": datetime.now(timezone.utc).isoformat(),
+    }
+
+    if new_hash == meta.get("sha256") and os.path.exists(dest_path):
+        os.remove(part_path)
+        status = "unchanged"
+        print(f"⏭️  Sin cambios: {name}")
     else:
-        print(f"⏭️  Sin cambios: {os.path.basename(path)}")
+        os.replace(part_path, dest_path)
+        status = "updated"
+        print(f"✅ Archivo actualizado: {name} ({new_meta['size'] / 1e6:.1f} MB)")
+    os.remove(part_meta_path)
+    write_meta(meta_path, new_meta)
+    return status
+
+def download_all(jobs, workers=DOWNLOAD_WORKERS):
+    """
+    Downloads several (url, dest_path) pairs in parallel.
+
+    Returns:
+        dict[str, str]: File name → status ("updated", "unchanged", "not_modified" or "error").
+    """
+    results = {}
+
+    def run(url, dest_path):
+        with requests.Session() as session:
+            return download_file(url, dest_path, session)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run, url, dest): os.path.basename(dest) for url, dest in jobs}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                print(f"⚠️  Error al descargar {name}: {e}")
+                results[name] = "error"
+    return results
 
 
 # === MTGJSON ===
-MTGJSON_FILES = {
-    "AllPrintings.sqlite": "https://mtgjson.com/api/v5/AllPrintings.sqlite",
-    "AllPrices.json": "https://mtgjson.com/api/v5/AllPrices.json",
-    "AllSets.json": "https://mtgjson.com/api/v5/AllSets.json"
-}
-
-def fetch_mtgjson():
-    print("\n📥 Descargando datos desde MTGJSON...")
-    for filename, url in MTGJSON_FILES.items():
-        dest_path = os.path.join(MTGJSON_DIR, filename)
-        try:
-            r = requests.get(url)
-            r.raise_for_status()
-            save_if_changed(dest_path, r.content)
-        except Exception as e:
-            print(f"⚠️  Error al descargar {filename}: {e}")
+MTGJSON_BASE_URL = os.getenv("MTGJSON_BASE_URL", "https://mtgjson.com/api/v5")
+MTGJSON_FILES = ["AllPrintings.sqlite", "AllPrices.json", "AllSets.json"]
+
+def mtgjson_jobs():
+    return [(f"{MTGJSON_BASE_URL}/{filename}", os.path.join(MTGJSON_DIR, filename)) for filename in MTGJSON_FILES]
 
 
 # === SCRYFALL ===
-SCRYFALL_BULK_ENDPOINT = "https://api.scryfall.com/bulk-data"
+SCRYFALL_BULK_ENDPOINT = os.getenv("SCRYFALL_BULK_ENDPOINT", "https://api.scryfall.com/bulk-data")
 
 
-def fetch_scryfall():
-    print("\n📥 Descargando datos desde Scryfall...")
+def scryfall_jobs():
+    """
+    Fetches the Scryfall bulk-data listing and returns its download jobs.
+    """
     try:
-        r = requests.get(SCRYFALL_BULK_ENDPOINT)
+        r = requests.get(SCRYFALL_BULK_ENDPOINT, timeout=TIMEOUT)
         r.raise_for_status()
         bulk_data = r.json()
-        with open(os.path.join(SCRYFALL_DIR, "bulk-data.json"), "w") as f:
-            json.dump(bulk_data, f, indent=2)
-
-        for obj in bulk_data["data"]:
-            name = obj["type"]
-            download_url = obj["download_uri"]
-            filename = f"{name}.json"
-            dest_path = os.path.join(SCRYFALL_DIR, filename)
-
-            r2 = requests.get(download_url)
-            r2.raise_for_status()
-            save_if_changed(dest_path, r2.content)
-
     except Exception as e:
         print(f"⚠️  Error al descargar desde Scryfall: {e}")
+        return []
+
+    with open(os.path.join(SCRYFALL_DIR, "bulk-data.json"), "w") as f:
+        json.dump(bulk_data, f, indent=2)
+
+    return [(obj["download_uri"], os.path.join(SCRYFALL_DIR, f"{obj['type']}.json")) for obj in bulk_data["data"]]
 
 
 def main():
     print("📦 Iniciando actualización de datasets de Magic...")
-    fetch_mtgjson()
-    fetch_scryfall()
-    print("\n🎉 Actualización completada.")
+    print("\n📥 Descargando datos desde MTGJSON y Scryfall...")
+    results = download_all(mtgjson_jobs() + scryfall_jobs())
+    summary = {status: sum(1 for s in results.values() if s == status) for status in sorted(set(results.values()))}
+    print(f"\n🎉 Actualización completada: {summary}")
 
 
 if __name__ == "__main__":
@@ -1,6 +1,10 @@
 import os
 import json
 import random
+import re
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from hashlib import md5
 from pathlib import Path
 from tqdm import tqdm
@@ -15,13 +19,106 @@ CARDS_PATH = os.path.join(SCRYFALL_DIR, "oracle_cards.json")
 RULINGS_PATH = os.path.join(SCRYFALL_DIR, "rulings.json")
 OUTPUT_PATH = os.path.join(OUTPUT_DIR, "card_qa_data.jsonl")
 
-NUM_QUESTIONS = 72000  
+NUM_QUESTIONS = 72000
+QUESTIONS_PER_CARD = 3  # preguntas distintas por carta (el pool completo tiene ~30k cartas)
+
+# Generación en paralelo: cartas por lote y semilla base (cada lote usa su propio RNG)
+BATCH_SIZE = 1000
+SEED = 42
+READ_CHUNK_CHARS = 1 << 20
+# Las cartas se barajan en una ventana de este tamaño (memoria acotada, reproducible con la semilla)
+SHUFFLE_WINDOW = 10 * BATCH_SIZE
+
+# Campos de la carta que necesitan los workers (no se envía el objeto completo de Scryfall)
+CARD_FIELDS = ("name", "oracle_text", "type_line", "keywords", "oracle_id")
+
+ELEMENT_END_RE = re.compile(r"\s*[,\]]")
 
 # === FUNCIONES ===
 
-def load_json(path):
+def iter_json_array(path, chunk_chars=READ_CHUNK_CHARS):
+    """
+    Streams the elements of a top-level JSON array (Scryfall bulk files)
+    without loading the whole file: reads fixed-size chunks and decodes one
+    element at a time, so memory stays at one chunk plus one element.
+
+    Args:
+        path (str): JSON file holding an array.
+        chunk_chars (int): Characters read per chunk.
+
+    Yields:
+        Any: Each element of the array, in order.
+    """
+    decoder = json.JSONDecoder()
     with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+        buf, pos, eof = "", 0, False
+
+        def refill():
+            nonlocal buf, pos, eof
+            more = f.read(chunk_chars)
+            buf, pos, eof = buf[pos:] + more, 0, not more
+
+        started = False
+        while True:
+            # Saltar espacios y separadores entre elementos
+            while True:
+                while pos < len(buf) and buf[pos] in " \t\r\n,":
+                    pos += 1
+                if pos < len(buf) or eof:
+                    break
+                refill()
+            if pos >= len(buf):
+                raise ValueError(f"{path}: unexpected end of file")
+
+            if not started:
+                if buf[pos] != "[":
+                    raise ValueError(f"{path}: expected a JSON array")
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == "]":
+                return
+
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                refill()  # elemento partido entre dos bloques
+                continue
+            if not isinstance(item, (dict, list, str)) and not eof and not ELEMENT_END_RE.match(buf, end):
+                # Un número puede seguir en el siguiente bloque ("12" + "3", "7." + "5"):
+                # solo está completo si le sigue un separador
+                refill()
+                continue
+            yield item
+            pos = end
+
+def build_rulings_index(path):
+    """
+    Indexes the ruling comments by oracle id, streaming the bulk file.
+
+    Accepts the bulk format (flat list of ruling objects) and saved API
+    responses ({"data": [ruling, ...]}).
+
+    Args:
+        path (str): rulings.json.
+
+    Returns:
+        dict[str, list[str]]: oracle_id → ruling comments.
+    """
+    index = {}
+    for entry in iter_json_array(path):
+        for ruling in entry.get("data", [entry]):
+            oracle_id = ruling.get("oracle_id")
+            comment = ruling.get("comment")
+            if oracle_id and comment:
+                index.setdefault(oracle_id, []).append(comment)
+    return index
+
+def example_key(prompt):
+    # Misma clave al cargar el fichero y al generar: md5 del prompt completo
+    return md5(prompt.encode()).hexdigest()
 
 def load_existing_questions(path):
     existing = set()
@@ -30,13 +127,12 @@ def load_existing_questions(path):
             for line in f:
                 try:
                     obj = json.loads(line)
-                    key = md5(obj["prompt"].encode()).hexdigest()
-                    existing.add(key)
+                    existing.add(example_key(obj["prompt"]))
                 except Exception:
                     continue
     return existing
 
-def generate_prompt(card):
+def generate_prompt(card, rng=random, count=1):
     # Ejemplos de preguntas diversas
     name = card.get("name", "")
     oracle_text = card.get("oracle_text", "")
@@ -56,69 +152,147 @@ def generate_prompt(card):
         f"¿Cómo interactúa {name} con habilidades como Hexproof?",
     ]
 
-    question = random.choice([q for q in questions if q])
+    candidates = [q for q in questions if q]
+    chosen = rng.sample(candidates, min(count, len(candidates)))
     context = f"Nombre: {name}\nTipo: {type_line}\nTexto: {oracle_text}"
-    return question, context
-
-def find_ruling_answer(card, rulings):
-    uri = card.get("rulings_uri", "")
-    matching = [r for r in rulings if r.get("uri", "") == uri]
-    if matching:
-        entry = matching[0].get("data", [])
-        if entry:
-            return random.choice(entry).get("comment", "")
-    return ""
+    return chosen, context
 
-def generate_examples(cards, rulings, existing_hashes, limit):
-    dataset = []
-    random.shuffle(cards)
+def find_ruling_answer(card, rng=random):
+    # Los rulings ya vienen unidos a la carta por oracle_id (ver iter_card_batches)
+    comments = card.get("rulings", [])
+    if comments:
+        return rng.choice(comments)
+    return ""
 
-    for card in tqdm(cards[:2000]):
-        result = generate_prompt(card)
+def _generate_batch(args):
+    """
+    Worker: builds the examples of one batch of cards. Each batch has its own
+    RNG seeded from (seed, batch number), so the output does not depend on
+    which process runs it.
+    """
+    batch_number, cards, seed, per_card = args
+    rng = random.Random(f"{seed}:{batch_number}")
+    examples = []
+    for card in cards:
+        result = generate_prompt(card, rng, per_card)
         if not result:
             continue
+        questions, context = result
+        for question in questions:
+            answer = find_ruling_answer(card, rng) or "Respuesta no disponible basada en reglas oficiales."
+            examples.append({
+                "prompt": f"{question}\n\nContexto:\n{context}\n\nRespuesta:",
+                "completion": f" {answer}"
+            })
+    return examples
 
-        question, context = result
-        key = md5(question.encode()).hexdigest()
-        if key in existing_hashes:
-            continue
+def iter_shuffled(items, rng, window):
+    """
+    Shuffles a stream with a bounded buffer: each output is drawn at random
+    from the next `window` pending items, so the order is mixed across the
+    whole stream without holding it in memory.
+    """
+    buffer = []
+    for item in items:
+        buffer.append(item)
+        if len(buffer) >= window:
+            i = rng.randrange(len(buffer))
+            buffer[i], buffer[-1] = buffer[-1], buffer[i]
+            yield buffer.pop()
+    rng.shuffle(buffer)
+    yield from buffer
+
+def iter_card_batches(cards_path, rulings_index, batch_size, seed=SEED, shuffle_window=SHUFFLE_WINDOW):
+    """
+    Streams the card pool in batches, each card reduced to the fields the
+    workers use plus its ruling comments, joined through the oracle id index.
+    Cards are shuffled with a seeded RNG inside a window of `shuffle_window`
+    cards, so `--limit` samples the pool instead of taking the first cards of
+    the file.
+    """
+    batch = []
+    cards = iter_shuffled(iter_json_array(cards_path), random.Random(seed), shuffle_window)
+    for card in cards:
+        slim = {field: card.get(field) for field in CARD_FIELDS if card.get(field) is not None}
+        slim["rulings"] = rulings_index.get(card.get("oracle_id"), [])
+        batch.append(slim)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
-        answer = find_ruling_answer(card, rulings) or "Respuesta no disponible basada en reglas oficiales."
-        example = {
-            "prompt": f"{question}\n\nContexto:\n{context}\n\nRespuesta:",
-            "completion": f" {answer}"
-        }
+def generate_examples(cards_path, rulings_index, existing_hashes, limit, output_path,
+                      workers=None, seed=SEED, per_card=QUESTIONS_PER_CARD, batch_size=BATCH_SIZE):
+    """
+    Generates new examples from the whole card pool in a process pool and
+    appends them to the output file in batch order (reproducible for a
+    given seed).
 
-        dataset.append(example)
-        existing_hashes.add(key)
+    Returns:
+        int: Examples written.
+    """
+    workers = workers or os.cpu_count() or 1
+    written = 0
+    pending = deque()
+    batches = enumerate(iter_card_batches(cards_path, rulings_index, batch_size, seed))
 
-        if len(dataset) >= limit:
-            break
+    with ProcessPoolExecutor(max_workers=workers) as pool, \
+            open(output_path, "a", encoding="utf-8") as out, \
+            tqdm(unit="cartas") as progress:
 
-    return dataset
+        def submit_next():
+            batch_number, batch = next(batches, (None, None))
+            if batch is not None:
+                pending.append((len(batch), pool.submit(_generate_batch, (batch_number, batch, seed, per_card))))
 
-def save_dataset(dataset, output_path):
-    with open(output_path, "a", encoding="utf-8") as f:
-        for entry in dataset:
-            json.dump(entry, f, ensure_ascii=False)
-            f.write("\n")
+        # Ventana acotada de lotes en vuelo: la memoria no crece con el pool de cartas
+        for _ in range(workers * 2):
+            submit_next()
+
+        while pending and written < limit:
+            num_cards, future = pending.popleft()
+            for example in future.result():
+                key = example_key(example["prompt"])
+                if key in existing_hashes:
+                    continue
+                json.dump(example, out, ensure_ascii=False)
+                out.write("\n")
+                existing_hashes.add(key)
+                written += 1
+                if written >= limit:
+                    break
+            progress.update(num_cards)
+            submit_next()
+
+        for _, future in pending:
+            future.cancel()
+
+    return written
 
 # === MAIN ===
 
 def main():
-    print("📥 Cargando cartas y rulings de Scryfall...")
-    cards = load_json(CARDS_PATH)
-    rulings = load_json(RULINGS_PATH)
+    parser = argparse.ArgumentParser(description="Generate card-based QA examples from Scryfall bulk data")
+    parser.add_argument("--limit", type=int, default=NUM_QUESTIONS, help="New examples to generate")
+    parser.add_argument("--per-card", type=int, default=QUESTIONS_PER_CARD, help="Distinct questions per card")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Cards per worker task")
+    parser.add_argument("--seed", type=int, default=SEED)
+    args = parser.parse_args()
+
+    print("📥 Indexando rulings de Scryfall por oracle_id...")
+    rulings_index = build_rulings_index(RULINGS_PATH)
+    print(f"📑 {len(rulings_index)} cartas con rulings")
 
     print("📊 Cargando preguntas existentes...")
     existing_hashes = load_existing_questions(OUTPUT_PATH)
 
     print("🤖 Generando ejemplos únicos...")
-    new_data = generate_examples(cards, rulings, existing_hashes, NUM_QUESTIONS)
-
-    print(f"💾 Guardando {len(new_data)} nuevos ejemplos...")
-    save_dataset(new_data, OUTPUT_PATH)
+    written = generate_examples(CARDS_PATH, rulings_index, existing_hashes, args.limit, OUTPUT_PATH,
+                                args.workers, args.seed, args.per_card, args.batch_size)
 
+    print(f"💾 Guardados {written} nuevos ejemplos en {OUTPUT_PATH}")
     print("✅ Finalizado.")
 
 if __name__ == "__main__":
@@ -8,70 +8,203 @@ Generates synthetic QA examples for Aethermind AI training.
 - For each question, generates an answer using an LLM API.
 - Saves the dataset in .jsonl format (compatible with Huggingface).
 
+Chunks are processed concurrently: at most `CONCURRENCY` requests are in
+flight and a token bucket keeps the request rate under the provider quota
+(`REQUESTS_PER_SECOND`, `BURST`). 429 / 5xx / network errors are retried
+with exponential backoff, honouring Retry-After.
+
+Each example is appended to the dataset as soon as its answer arrives, and a
+checkpoint file next to it records the questions of every chunk and which
+ones are answered. After a crash or Ctrl+C, running the script again only
+does the missing work; `--restart` starts a new dataset.
+
 Usage:
     python -m app.services.ia.generate_synthetic_data
+    python -m app.services.ia.generate_synthetic_data --concurrency 16 --rps 5
 """
 
-import os
+import argparse
+import asyncio
+import email.utils
+import hashlib
 import json
-import pickle
-import time
+import os
 import random
-import requests
+import time
 
-from app.config import CHUNKS_PATH, TRAINING_DATA_PATH, TRAINING_DATA_DIR
+import httpx
+
+from app.config import EMBEDDINGS_DIR, TRAINING_DATA_PATH, TRAINING_DATA_DIR
+from app.services.ia.chunk_store import open_chunk_store
 from app.services.ia import generate_synthetic_data_config as config
 
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
 # --------------------------------------------------------------
 
-def load_chunks():
+
+class LLMAPIError(Exception):
+    """
+    The LLM API failed for good (non-retryable status or retries exhausted).
     """
-    Loads Magic rules chunks from pickle file.
 
-    Returns:
-        list[str]: List of text chunks.
+
+class TokenBucket:
     """
-    print(f"USANDO CHUNKS_PATH: {CHUNKS_PATH}")
-    with open(CHUNKS_PATH, "rb") as f:
-        chunks = pickle.load(f)
-    print(f"✅ Cargados {len(chunks)} chunks.")
-    return chunks
+    Async token bucket rate limiter.
+
+    Args:
+        rate (float): Tokens added per second (sustained requests per second).
+        capacity (int): Bucket size (maximum burst).
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """
+        Waits until a token is available and takes it.
+        """
+        # El lock reparte los tokens por orden de llegada
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def _retry_after(response: httpx.Response) -> float | None:
+    """
+    Seconds to wait according to the Retry-After header (seconds or HTTP date).
+    """
+    value = response.headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
 
-def call_llm_api(prompt):
+class LLMClient:
     """
-    Calls the LLM API to get a response.
+    Rate-limited, retrying async client for the LLM API.
 
     Args:
-        prompt (str): The input prompt.
+        concurrency (int): Maximum requests in flight.
+        rate (float): Sustained requests per second.
+        burst (int): Token bucket capacity.
+    """
 
-    Returns:
-        str: The generated response.
-    """
-    headers = {
-        "Content-Type": "application/json",
-    }
-    api_key = os.getenv("PUTER_API_KEY")
-    if api_key:
-        headers["Authorization"] = f"Bearer {api_key}"
-
-    data = {
-        "messages": [
-            {"role": "system", "content": "You are a Magic: The Gathering rules expert. Answer clearly and concisely."},
-            {"role": "user", "content": prompt}
-        ],
-        "model": config.MODEL
-    }
+    def __init__(self, concurrency: int = config.CONCURRENCY, rate: float = config.REQUESTS_PER_SECOND,
+                 burst: int = config.BURST):
+        headers = {"Content-Type": "application/json"}
+        api_key = os.getenv("PUTER_API_KEY")
+        if api_key:
+            headers["Authorization"] = f"Bearer {api_key}"
+
+        self.client = httpx.AsyncClient(
+            headers=headers,
+            timeout=config.REQUEST_TIMEOUT,
+            limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+        )
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.bucket = TokenBucket(rate, burst)
+        self.requests = 0
+        self.retries = 0
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+    async def call(self, prompt: str) -> str:
+        """
+        Calls the LLM API to get a response.
+
+        Args:
+            prompt (str): The input prompt.
+
+        Returns:
+            str: The generated response.
+
+        Raises:
+            LLMAPIError: Non-retryable error or malformed response, or still
+            failing (or empty) after MAX_RETRIES.
+        """
+        data = {
+            "messages": [
+                {"role": "system", "content": "You are a Magic: The Gathering rules expert. Answer clearly and concisely."},
+                {"role": "user", "content": prompt}
+            ],
+            "model": config.MODEL
+        }
+
+        for attempt in range(config.MAX_RETRIES + 1):
+            wait = None
+            async with self.semaphore:
+                await self.bucket.acquire()
+                self.requests += 1
+                try:
+                    response = await self.client.post(config.API_URL, json=data)
+                except httpx.HTTPError as e:
+                    error = f"{type(e).__name__}: {e}"
+                else:
+                    if response.status_code == 200:
+                        try:
+                            result = response.json()
+                        except ValueError:
+                            raise LLMAPIError(f"Respuesta no JSON: {response.text[:200]}")
+                        # Puter format (adjust if needed)
+                        try:
+                            content = result["choices"][0]["message"]["content"]
+                        except (IndexError, KeyError, TypeError, AttributeError):
+                            raise LLMAPIError(f"Respuesta con formato inesperado: {response.text[:200]}")
+                        if isinstance(content, str) and content.strip():
+                            return content.strip()
+                        # Respuesta vacía: se reintenta, nunca se escribe un ejemplo vacío
+                        error = "respuesta vacía del modelo"
+                    else:
+                        error = f"{response.status_code} - {response.text[:200]}"
+                        if response.status_code not in RETRY_STATUS:
+                            raise LLMAPIError(error)
+                        wait = _retry_after(response)
+
+            if attempt == config.MAX_RETRIES:
+                break
+            # Backoff exponencial con jitter completo, fuera del semáforo
+            if wait is None:
+                wait = random.uniform(0, min(config.BACKOFF_MAX, config.BACKOFF_BASE * 2 ** attempt))
+            self.retries += 1
+            print(f"⏳ Reintento {attempt + 1}/{config.MAX_RETRIES} en {wait:.1f} s ({error})")
+            await asyncio.sleep(wait)
+
+        raise LLMAPIError(f"Sin respuesta tras {config.MAX_RETRIES} reintentos: {error}")
 
-    try:
-        response = requests.post(config.API_URL, headers=headers, json=data)
-        response.raise_for_status()
-        result = response.json()
 
-        # Puter format (adjust if needed)
-        return result.get("choices", [{}])[0].get("message", {}).get("content", "").strip()
-    except Exception as e:
-        print(f"⚠️ Error calling LLM API: {e}")
-        return "Error generating answer."
+# --------------------------------------------------------------
+
+def load_chunks():
+    """
+    Opens the memory-mapped Magic rules chunk store.
+
+    Returns:
+        ChunkStore: Id-addressable chunk texts.
+    """
+    print(f"USANDO EMBEDDINGS_DIR: {EMBEDDINGS_DIR}")
+    chunks = open_chunk_store(EMBEDDINGS_DIR)
+    print(f"✅ Cargados {len(chunks)} chunks.")
+    return chunks
 
 def generate_question_prompts(chunk_text):
     """
@@ -81,7 +214,7 @@ def generate_question_prompts(chunk_text):
         chunk_text (str): The chunk of Magic rules.
 
     Returns:
-        list[str]: List of question prompts.
+        str: Question generation prompt.
     """
     base_prompt = (
         f"""Eres un experto en reglas de Magic: The Gathering.
@@ -100,81 +233,230 @@ Devuélveme SOLO la lista de preguntas, una por línea:
     )
     return base_prompt
 
-def save_dataset(dataset):
+def generate_answer_prompt(question, chunk_text):
     """
-    Saves the dataset in .jsonl format.
+    Generates the prompt to answer a question from its chunk.
 
     Args:
-        dataset (list[dict]): List of examples.
-    """
-    os.makedirs(TRAINING_DATA_DIR, exist_ok=True)
-
-    with open(TRAINING_DATA_PATH, "w", encoding="utf-8") as f:
-        for entry in dataset:
-            json.dump(entry, f, ensure_ascii=False)
-            f.write("\n")
+        question (str): Generated question.
+        chunk_text (str): The chunk of Magic rules.
 
-# --------------------------------------------------------------
+    Returns:
+        str: Answer generation prompt.
+    """
+    return (
+        f"""Eres un experto en reglas de Magic: The Gathering.
 
-def main():
-    print("📚 Cargando chunks de reglas...")
-    chunks = load_chunks()
+Voy a darte una pregunta sobre las reglas y el fragmento de reglas correspondiente.
 
-    dataset = []
-    total_questions_generated = 0
+Contesta de forma clara y precisa. Si el fragmento no tiene suficiente información, indica claramente que se necesita más contexto.
 
-    print("🤖 Generando preguntas y respuestas sintéticas...")
+Pregunta: {question}
 
-    for idx, chunk in enumerate(chunks):
-        print(f"\n🔹 Chunk {idx + 1}/{len(chunks)}")
+Fragmento de reglas:
+\"\"\"
+{chunk_text}
+\"\"\"
 
-        # Generar preguntas
-        question_prompt = generate_question_prompts(chunk)
-        questions_text = call_llm_api(question_prompt)
+Respuesta:"""
+    )
 
-        questions = [q.strip("-• ") for q in questions_text.strip().split("\n") if q.strip()]
-        questions = questions[:config.NUM_QUESTIONS_PER_CHUNK]
+def parse_questions(questions_text):
+    """
+    Splits the question list returned by the model, one per line.
+    """
+    questions = [q.strip("-• ") for q in questions_text.strip().split("\n") if q.strip()]
+    return questions[:config.NUM_QUESTIONS_PER_CHUNK]
 
-        print(f"📌 Preguntas generadas: {len(questions)}")
+# --------------------------------------------------------------
 
-        for question in questions:
-            print(f"  ❓ {question}")
 
-            # Generar respuesta
-            answer_prompt = (
-                f"""Eres un experto en reglas de Magic: The Gathering.
+class Checkpoint:
+    """
+    Append-only progress log of a generation run.
 
-Voy a darte una pregunta sobre las reglas y el fragmento de reglas correspondiente.
+    Two kinds of lines: {"chunk", "questions"} when the questions of a chunk
+    are generated and {"chunk", "answered"} when one of its examples has been
+    written to the dataset. Chunks are identified by a hash of their text, so
+    a rebuilt index with different chunk ids does not confuse the resume.
 
-Contesta de forma clara y precisa. Si el fragmento no tiene suficiente información, indica claramente que se necesita más contexto.
+    Args:
+        path (str): Checkpoint file.
+    """
 
-Pregunta: {question}
+    def __init__(self, path: str):
+        self.path = path
+        self.questions: dict[str, list[str]] = {}
+        self.answered: dict[str, set[str]] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # última línea a medio escribir tras un corte
+                    if "questions" in entry:
+                        self.questions[entry["chunk"]] = entry["questions"]
+                    else:
+                        self.answered.setdefault(entry["chunk"], set()).add(entry["answered"])
+        self._file = open(path, "a", encoding="utf-8")
+
+    def pending(self, key: str) -> list[str] | None:
+        """
+        Questions of a chunk still to answer, or None if its questions were never generated.
+        """
+        if key not in self.questions:
+            return None
+        done = self.answered.get(key, set())
+        return [q for q in self.questions[key] if q not in done]
+
+    def _append(self, entry: dict) -> None:
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def record_questions(self, key: str, questions: list[str]) -> None:
+        self.questions[key] = questions
+        self._append({"chunk": key, "questions": questions})
+
+    def record_answered(self, key: str, question: str) -> None:
+        self.answered.setdefault(key, set()).add(question)
+        self._append({"chunk": key, "answered": question})
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def _chunk_key(chunk_text: str) -> str:
+    return hashlib.sha1(chunk_text.encode("utf-8")).hexdigest()
+
+
+async def process_chunk(llm: LLMClient, checkpoint: Checkpoint, dataset, chunk: str) -> int:
+    """
+    Generates the missing questions and answers of one chunk, appending each
+    example to the dataset as soon as it is ready.
 
-Fragmento de reglas:
-\"\"\"
-{chunk}
-\"\"\"
+    Returns:
+        int: Examples written.
+    """
+    key = _chunk_key(chunk)
+    questions = checkpoint.pending(key)
+    if questions is None:
+        questions = parse_questions(await llm.call(generate_question_prompts(chunk)))
+        if not questions:
+            raise LLMAPIError("El modelo no devolvió preguntas")
+        checkpoint.record_questions(key, questions)
+
+    async def answer(question):
+        answer_text = await llm.call(generate_answer_prompt(question, chunk))
+        entry = {
+            "prompt": f"Pregunta: {question}\n\nContexto:\n{chunk}\n\nRespuesta:",
+            "completion": f" {answer_text}"
+        }
+        # Primero el ejemplo y después el checkpoint: un corte entre ambos
+        # como mucho repite ese ejemplo, nunca lo pierde
+        dataset.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        dataset.flush()
+        checkpoint.record_answered(key, question)
+
+    results = await asyncio.gather(*(answer(q) for q in questions), return_exceptions=True)
+    errors = [r for r in results if isinstance(r, BaseException)]
+    if errors:
+        raise errors[0]
+    return len(questions)
+
+
+async def generate(chunks, concurrency: int, rate: float, burst: int, limit: int | None = None) -> dict:
+    """
+    Runs the generation over the chunk store with bounded concurrency.
 
-Respuesta:"""
-            )
+    Args:
+        chunks (ChunkStore): Rule chunks.
+        concurrency (int): Maximum API requests in flight (also the number of chunk workers).
+        rate (float): Sustained API requests per second.
+        burst (int): Token bucket capacity.
+        limit (int | None): Only process the first `limit` chunks.
 
-            answer = call_llm_api(answer_prompt)
+    Returns:
+        dict: Counters of the run.
+    """
+    checkpoint = Checkpoint(TRAINING_DATA_PATH + config.CHECKPOINT_SUFFIX)
+    llm = LLMClient(concurrency, rate, burst)
+    total = len(chunks) if limit is None else min(limit, len(chunks))
+    ids = iter(range(total))
+    stats = {"chunks": total, "done": 0, "skipped": 0, "failed": 0, "examples": 0}
+    start = time.perf_counter()
+
+    async def worker():
+        for idx in ids:
+            chunk = chunks[idx]
+            pending = checkpoint.pending(_chunk_key(chunk))
+            if pending is not None and not pending:
+                stats["skipped"] += 1
+                continue
+            try:
+                stats["examples"] += await process_chunk(llm, checkpoint, dataset, chunk)
+                stats["done"] += 1
+            except LLMAPIError as e:
+                stats["failed"] += 1
+                print(f"⚠️ Chunk {idx + 1}: {e}")
+                continue
+            finished = stats["done"] + stats["failed"]
+            if finished % 10 == 0:
+                elapsed = time.perf_counter() - start
+                print(f"🔹 {finished + stats['skipped']}/{total} chunks | {stats['examples']} ejemplos | "
+                      f"{stats['examples'] / elapsed:.2f} ejemplos/s | {llm.retries} reintentos")
 
-            entry = {
-                "prompt": f"Pregunta: {question}\n\nContexto:\n{chunk}\n\nRespuesta:",
-                "completion": f" {answer}"
-            }
+    try:
+        with open(TRAINING_DATA_PATH, "a", encoding="utf-8") as dataset:
+            # Todos los workers comparten el mismo iterador de ids
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+    finally:
+        await llm.close()
+        checkpoint.close()
+
+    stats.update({
+        "requests": llm.requests,
+        "retries": llm.retries,
+        "seconds": round(time.perf_counter() - start, 1),
+    })
+    return stats
 
-            dataset.append(entry)
-            total_questions_generated += 1
+# --------------------------------------------------------------
 
-            # Sleep opcional
-            time.sleep(random.uniform(config.MIN_SLEEP, config.MAX_SLEEP))
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic QA training data from the rule chunks")
+    parser.add_argument("--concurrency", type=int, default=config.CONCURRENCY, help="API requests in flight")
+    parser.add_argument("--rps", type=float, default=config.REQUESTS_PER_SECOND, help="Sustained API requests per second")
+    parser.add_argument("--burst", type=int, default=config.BURST, help="Token bucket size")
+    parser.add_argument("--limit", type=int, default=None, help="Only process the first N chunks")
+    parser.add_argument("--restart", action="store_true", help="Discard the checkpoint and the existing dataset")
+    args = parser.parse_args()
 
-    print(f"\n💾 Guardando dataset en {TRAINING_DATA_PATH} ...")
-    save_dataset(dataset)
+    print("📚 Cargando chunks de reglas...")
+    chunks = load_chunks()
 
-    print(f"✅ Dataset generado: {TRAINING_DATA_PATH} ({total_questions_generated} ejemplos)")
+    os.makedirs(TRAINING_DATA_DIR, exist_ok=True)
+    checkpoint_path = TRAINING_DATA_PATH + config.CHECKPOINT_SUFFIX
+    if args.restart or not os.path.exists(checkpoint_path):
+        # Sin checkpoint no se sabe qué contiene el dataset: empezar de cero
+        for path in (TRAINING_DATA_PATH, checkpoint_path):
+            if os.path.exists(path):
+                os.remove(path)
+    else:
+        print(f"♻️ Reanudando desde {checkpoint_path}")
+
+    print(f"🤖 Generando preguntas y respuestas sintéticas "
+          f"({args.concurrency} en paralelo, {args.rps} req/s, ráfaga {args.burst})...")
+    try:
+        stats = asyncio.run(generate(chunks, args.concurrency, args.rps, args.burst, args.limit))
+    except KeyboardInterrupt:
+        print("\n⏸️ Interrumpido: vuelve a ejecutar el script para continuar donde se quedó.")
+        return
+
+    print(json.dumps(stats, indent=2))
+    print(f"✅ Dataset generado: {TRAINING_DATA_PATH} ({stats['examples']} ejemplos nuevos)")
+    if stats["failed"]:
+        print(f"⚠️ {stats['failed']} chunks fallaron: vuelve a ejecutar el script para reintentarlos.")
 
 # --------------------------------------------------------------
 
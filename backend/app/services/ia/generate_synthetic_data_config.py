@@ -13,6 +13,20 @@ API_URL = "https://api.puter.com/ai/chat"
 # Model name (optional, if your API supports it)
 MODEL = "gpt-4o"
 
-# Sleep between API calls (in seconds, to avoid rate limits)
-MIN_SLEEP = 0.5
-MAX_SLEEP = 1.0
+# Maximum API requests in flight at the same time
+CONCURRENCY = 8
+
+# Token bucket: sustained requests per second and burst size (ajustar a la cuota del proveedor)
+REQUESTS_PER_SECOND = 2.0
+BURST = 4
+
+# Retries on 429 / 5xx / network errors (exponential backoff with jitter; Retry-After wins if sent)
+MAX_RETRIES = 6
+BACKOFF_BASE = 1.0  # seconds
+BACKOFF_MAX = 60.0  # seconds
+
+# Timeout per API request (seconds)
+REQUEST_TIMEOUT = 120.0
+
+# Progress file next to the dataset: a rerun skips questions and answers already done
+CHECKPOINT_SUFFIX = ".checkpoint.jsonl"
@@ -16,41 +16,48 @@ Output:
     data/training_data/training_data.jsonl
 """
 
-import sqlite3
 import json
-import pickle
 import os
-from app.config import HISTORY_DB_PATH, CHUNKS_PATH, TRAINING_DATA_PATH
+from app.config import HISTORY_DB_PATH, EMBEDDINGS_DIR, TRAINING_DATA_PATH
+from app.services.db.history import connect
+from app.services.ia.chunk_store import open_chunk_store
 
 def load_chunks():
     """
-    Loads Magic rules chunks from pickle file.
+    Opens the memory-mapped Magic rules chunk store.
 
     Returns:
-        list[str]: List of text chunks.
+        ChunkStore: Id-addressable chunk texts.
     """
-    print(f"USANDO CHUNKS_PATH: {CHUNKS_PATH}")  # Para depuración
-    with open(CHUNKS_PATH, "rb") as f:
-        chunks = pickle.load(f)
-    return chunks
+    print(f"USANDO EMBEDDINGS_DIR: {EMBEDDINGS_DIR}")  # Para depuración
+    return open_chunk_store(EMBEDDINGS_DIR)
 
 def load_history():
     """
     Loads question, context, and answer history from SQLite.
 
+    The context text is rebuilt from the chunk ids stored in each row; the
+    deduplicated `context_chunks` table is read once.
+
     Returns:
-        list[tuple]: List of (question, context_used_json, answer) tuples.
+        list[tuple]: List of (question, context_list, answer) tuples.
     """
     print(f"USANDO HISTORY_DB_PATH: {HISTORY_DB_PATH}")  # Para depuración
-    conn = sqlite3.connect(HISTORY_DB_PATH)
-    conn.execute('PRAGMA journal_mode=DELETE;')  # 🔥 Forzar modo consistente
+    # Solo lectura: en modo WAL no bloquea al writer de la API
+    conn = connect(HISTORY_DB_PATH, readonly=True)
     cursor = conn.cursor()
 
+    chunk_texts = dict(cursor.execute('SELECT id, text FROM context_chunks'))
+
     cursor.execute('''
-        SELECT question, context_used, answer FROM history
+        SELECT question, context_ids, answer FROM history ORDER BY id
     ''')
 
-    rows = cursor.fetchall()
+    rows = []
+    for question, context_ids, answer in cursor:
+        context_list = [chunk_texts[i] for i in json.loads(context_ids or "[]") if i in chunk_texts]
+        rows.append((question, context_list, answer))
+
     conn.close()
     print(f"🔎 Se encontraron {len(rows)} registros en la tabla history.")
     return rows
@@ -60,27 +67,14 @@ def build_dataset(rows):
     Builds the training dataset from history data.
 
     Args:
-        rows (list[tuple]): List of (question, context_used_json, answer) tuples.
+        rows (list[tuple]): List of (question, context_list, answer) tuples.
 
     Returns:
         list[dict]: List of examples in {'prompt': ..., 'completion': ...} format.
     """
     dataset = []
 
-    for row in rows:
-        question = row[0]
-        context_json = row[1]
-        answer = row[2]
-
-        try:
-            # Parsear el contexto que es un string JSON → lista
-            context_list = json.loads(context_json)
-            if not isinstance(context_list, list):
-                context_list = []
-        except Exception as e:
-            print(f"⚠️ Error al parsear context_used para pregunta '{question}': {e}")
-            context_list = []
-
+    for question, context_list, answer in rows:
         # Construir el ejemplo (aunque el contexto esté vacío)
         entry = {
             "prompt": f"Pregunta: {question}\n\nContexto:\n" + "\n".join(context_list) + "\n\nRespuesta:",
@@ -0,0 +1,558 @@
+"""
+generation_backends.py
+
+Pluggable answer generation backends.
+
+- `OpenRouterBackend`: OpenRouter chat completions API (default).
+- `OpenAICompatibleBackend`: any OpenAI-compatible server (llama.cpp server,
+  vLLM, Ollama, `fake_llm_server`, ...).
+- `OnnxLocalBackend`: in-process CPU model exported to ONNX (optional
+  dependency: optimum[onnxruntime]).
+- `FakeBackend`: deterministic in-process answers with configurable latency,
+  for offline runs and load tests.
+
+The backend is selected with GENERATION_BACKEND in `app/config.py`. Every
+backend reports token counts and timings (`GenerationResult` per call,
+aggregated in `stats()`), so their latency and throughput can be compared.
+"""
+
+import abc
+import asyncio
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import AsyncIterator
+
+import httpx
+from dotenv import load_dotenv
+
+from app.config import (
+    FAKE_FIRST_TOKEN_MS,
+    FAKE_TOKEN_MS,
+    FAKE_TOKENS,
+    GENERATION_API_URL,
+    GENERATION_BACKEND,
+    GENERATION_CONNECT_TIMEOUT,
+    GENERATION_MAX_CONNECTIONS,
+    GENERATION_MAX_KEEPALIVE,
+    GENERATION_MAX_TOKENS,
+    GENERATION_MODEL,
+    GENERATION_READ_TIMEOUT,
+    GENERATION_TEMPERATURE,
+    ONNX_MODEL_DIR,
+    OPENAI_COMPAT_API_KEY,
+    OPENAI_COMPAT_API_URL,
+    OPENAI_COMPAT_MODEL,
+)
+from app.services.ia.context_packing import estimate_tokens
+from app.services.metrics import GENERATION_ERRORS, GENERATION_TOKENS
+
+load_dotenv()
+
+
+class GenerationError(Exception):
+    """
+    Raised when a backend fails; the message has the same "Error: ..." form
+    the non-raising generation functions return.
+    """
+
+
+@dataclass
+class GenerationResult:
+    """
+    A generated answer with its token counts and timings.
+    """
+    text: str
+    backend: str
+    model: str
+    prompt_tokens: int
+    completion_tokens: int
+    first_token_seconds: float
+    total_seconds: float
+
+
+def build_prompt(question: str, context_chunks: list[str]) -> str:
+    """
+    Builds the judge prompt sent to the generation model.
+
+    Args:
+        question (str): The user's question.
+        context_chunks (list[str]): Relevant text chunks from rule index.
+
+    Returns:
+        str: The full prompt.
+    """
+    return f"""Eres un juez profesional de Magic: The Gathering. Usa el contexto para dar una respuesta específica, incluso si el término exacto no aparece.
+
+
+### Contexto:
+{chr(10).join(context_chunks)}
+
+### Pregunta:
+{question}
+
+### Respuesta:"""
+
+
+def fake_answer_tokens(question: str, count: int) -> list[str]:
+    """
+    Deterministic answer for a question, split in word tokens.
+    """
+    words = f"Respuesta simulada a: {question}".split()
+    return [(" " if i else "") + words[i % len(words)] for i in range(count)]
+
+
+class GenerationBackend(abc.ABC):
+    """
+    Base class: subclasses implement `_generate` and `_stream` (abstract, so
+    a backend missing one fails when it is created); the public
+    `generate` / `stream` wrappers time the calls and keep the counters.
+
+    Args:
+        model (str): Model identifier reported in results and stats.
+    """
+
+    name = "base"
+
+    def __init__(self, model: str):
+        self.model = model
+        self.requests = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.total_seconds = 0.0
+        self.first_token_seconds = 0.0
+        self._lock = threading.Lock()
+
+    async def start(self) -> None:
+        """
+        Creates connections or loads the model. Called at application startup.
+        """
+
+    async def close(self) -> None:
+        """
+        Releases connections or the model. Called at application shutdown.
+        """
+
+    @abc.abstractmethod
+    async def _generate(self, prompt: str, question: str) -> tuple[str, int | None, int | None]:
+        """
+        Returns the answer text and the prompt/completion token counts (None if unknown).
+        """
+
+    @abc.abstractmethod
+    def _stream(self, prompt: str, question: str) -> AsyncIterator[str | dict]:
+        """
+        Yields text deltas, plus an optional usage dict with token counts.
+        """
+
+    def _record(self, result: GenerationResult | None) -> None:
+        if result is None:
+            GENERATION_ERRORS.inc(1, self.name)
+        else:
+            GENERATION_TOKENS.inc(result.prompt_tokens, self.name, "prompt")
+            GENERATION_TOKENS.inc(result.completion_tokens, self.name, "completion")
+
+        with self._lock:
+            self.requests += 1
+            if result is None:
+                self.errors += 1
+                return
+            self.prompt_tokens += result.prompt_tokens
+            self.completion_tokens += result.completion_tokens
+            self.total_seconds += result.total_seconds
+            self.first_token_seconds += result.first_token_seconds
+
+    async def generate(self, question: str, context_chunks: list[str]) -> GenerationResult:
+        """
+        Generates the complete answer.
+
+        Args:
+            question (str): The user's question.
+            context_chunks (list[str]): Relevant text chunks from rule index.
+
+        Returns:
+            GenerationResult: Answer text, token counts and timings.
+
+        Raises:
+            GenerationError: If the backend fails.
+        """
+        prompt = build_prompt(question, context_chunks)
+        start = time.perf_counter()
+        try:
+            text, prompt_tokens, completion_tokens = await self._generate(prompt, question)
+        except Exception:
+            # Cualquier fallo cuenta como error en las métricas, no solo GenerationError
+            self._record(None)
+            raise
+
+        elapsed = time.perf_counter() - start
+        result = GenerationResult(
+            text=text.strip(),
+            backend=self.name,
+            model=self.model,
+            prompt_tokens=prompt_tokens if prompt_tokens is not None else estimate_tokens(prompt),
+            completion_tokens=completion_tokens if completion_tokens is not None else estimate_tokens(text),
+            first_token_seconds=elapsed,  # sin streaming el primer token llega con el último
+            total_seconds=elapsed,
+        )
+        self._record(result)
+        return result
+
+    async def stream(self, question: str, context_chunks: list[str]) -> AsyncIterator[str]:
+        """
+        Streams the answer as text deltas.
+
+        Closing the generator early stops the generation where the backend
+        allows it (HTTP backends close the upstream response).
+
+        Args:
+            question (str): The user's question.
+            context_chunks (list[str]): Relevant text chunks from rule index.
+
+        Yields:
+            str: Text deltas in arrival order.
+
+        Raises:
+            GenerationError: If the backend fails.
+        """
+        prompt = build_prompt(question, context_chunks)
+        start = time.perf_counter()
+        first_token = None
+        parts: list[str] = []
+        usage: dict = {}
+        try:
+            async for item in self._stream(prompt, question):
+                if isinstance(item, dict):
+                    usage = item
+                    continue
+                if first_token is None:
+                    first_token = time.perf_counter() - start
+                parts.append(item)
+                yield item
+        except Exception:
+            self._record(None)
+            raise
+
+        text = "".join(parts)
+        elapsed = time.perf_counter() - start
+        self._record(GenerationResult(
+            text=text,
+            backend=self.name,
+            model=self.model,
+            prompt_tokens=usage.get("prompt_tokens") or estimate_tokens(prompt),
+            completion_tokens=usage.get("completion_tokens") or estimate_tokens(text),
+            first_token_seconds=first_token if first_token is not None else elapsed,
+            total_seconds=elapsed,
+        ))
+
+    def stats(self) -> dict:
+        ok = self.requests - self.errors
+        return {
+            "backend": self.name,
+            "model": self.model,
+            "requests": self.requests,
+            "errors": self.errors,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "avg_latency_ms": round(1000 * self.total_seconds / ok, 1) if ok else None,
+            "avg_first_token_ms": round(1000 * self.first_token_seconds / ok, 1) if ok else None,
+            "completion_tokens_per_s": round(self.completion_tokens / self.total_seconds, 1) if self.total_seconds else None,
+        }
+
+
+class OpenAICompatibleBackend(GenerationBackend):
+    """
+    Chat completions over HTTP against any OpenAI-compatible server, with a
+    shared keep-alive connection pool.
+
+    Args:
+        url (str): Full chat completions URL.
+        model (str): Model name sent in the payload.
+        api_key (str | None): Bearer token, if the server needs one.
+        extra_headers (dict | None): Additional request headers.
+    """
+
+    name = "openai"
+
+    def __init__(self, url: str, model: str, api_key: str | None = None, extra_headers: dict | None = None):
+        super().__init__(model)
+        self.url = url
+        self.headers = {"Content-Type": "application/json", **(extra_headers or {})}
+        if api_key:
+            self.headers["Authorization"] = f"Bearer {api_key}"
+        self._client: httpx.AsyncClient | None = None
+
+    async def start(self) -> None:
+        self._get_client()
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(GENERATION_READ_TIMEOUT, connect=GENERATION_CONNECT_TIMEOUT),
+                limits=httpx.Limits(
+                    max_connections=GENERATION_MAX_CONNECTIONS,
+                    max_keepalive_connections=GENERATION_MAX_KEEPALIVE,
+                ),
+                headers=self.headers,
+            )
+        return self._client
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _payload(self, prompt: str, stream: bool = False) -> dict:
+        payload = {
+            "model": self.model,
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": GENERATION_TEMPERATURE,
+            "max_tokens": GENERATION_MAX_TOKENS,
+        }
+        if stream:
+            payload["stream"] = True
+            payload["stream_options"] = {"include_usage": True}
+        return payload
+
+    async def _generate(self, prompt: str, question: str) -> tuple[str, int | None, int | None]:
+        try:
+            response = await self._get_client().post(self.url, json=self._payload(prompt))
+        except httpx.TimeoutException:
+            raise GenerationError("Error: timeout al contactar con el modelo.")
+        except httpx.HTTPError as e:
+            raise GenerationError(f"Error: {e}")
+
+        if response.status_code != 200:
+            raise GenerationError(f"Error: {response.status_code} - {response.text}")
+
+        try:
+            body = response.json()
+            usage = body.get("usage") or {}
+            content = body["choices"][0]["message"]["content"]
+        except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+            raise GenerationError(f"Error: respuesta inválida del modelo ({e!r}).")
+        return content, usage.get("prompt_tokens"), usage.get("completion_tokens")
+
+    async def _stream(self, prompt: str, question: str) -> AsyncIterator[str | dict]:
+        try:
+            async with self._get_client().stream("POST", self.url, json=self._payload(prompt, stream=True)) as response:
+                if response.status_code != 200:
+                    body = (await response.aread()).decode("utf-8", errors="replace")
+                    raise GenerationError(f"Error: {response.status_code} - {body}")
+
+                async for line in response.aiter_lines():
+                    # Ignorar comentarios SSE (": OPENROUTER PROCESSING") y líneas vacías
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    try:
+                        chunk = json.loads(data)
+                        if "error" in chunk:
+                            error = chunk["error"]
+                            message = error.get("message", error) if isinstance(error, dict) else error
+                            raise GenerationError(f"Error: {message}")
+                        usage = chunk.get("usage")
+                        choices = chunk.get("choices") or [{}]
+                        delta = (choices[0].get("delta") or {}).get("content")
+                    except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+                        raise GenerationError(f"Error: respuesta inválida del modelo ({e!r}).")
+                    if usage:
+                        yield usage
+                    if delta:
+                        yield delta
+        except httpx.TimeoutException:
+            raise GenerationError("Error: timeout al contactar con el modelo.")
+        except httpx.HTTPError as e:
+            raise GenerationError(f"Error: {e}")
+
+
+def openrouter_headers() -> dict:
+    return {
+        "Authorization": f"Bearer {os.getenv('OPENROUTER_API_KEY')}",
+        "Content-Type": "application/json",
+        "HTTP-Referer": "https://tu-dominio.dev",
+        "X-Title": "Coyote-Aethermind"
+    }
+
+
+class OpenRouterBackend(OpenAICompatibleBackend):
+    """
+    OpenRouter chat completions (OPENROUTER_API_KEY from the environment).
+
+    Args:
+        url (str): Chat completions URL.
+        model (str): OpenRouter model id.
+    """
+
+    name = "openrouter"
+
+    def __init__(self, url: str = GENERATION_API_URL, model: str = GENERATION_MODEL):
+        super().__init__(url, model, extra_headers=openrouter_headers())
+
+
+class OnnxLocalBackend(GenerationBackend):
+    """
+    In-process CPU generation with a causal language model exported to ONNX
+    (e.g. `optimum-cli export onnx --model Qwen/Qwen2.5-0.5B-Instruct <dir>`).
+
+    optimum[onnxruntime] is imported lazily, only when this backend starts.
+    Generations run one at a time in a dedicated thread: the model already
+    uses every core, so running them in parallel would only add contention.
+
+    Args:
+        model_dir (str): Directory with the ONNX model and its tokenizer.
+    """
+
+    name = "onnx"
+
+    def __init__(self, model_dir: str = ONNX_MODEL_DIR):
+        super().__init__(os.path.basename(os.path.normpath(model_dir)) or model_dir)
+        self.model_dir = model_dir
+        self._model = None
+        self._tokenizer = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="onnx-generation")
+
+    def _load(self) -> None:
+        if self._model is not None:
+            return
+        try:
+            from optimum.onnxruntime import ORTModelForCausalLM
+            from transformers import AutoTokenizer
+        except ImportError as e:
+            raise GenerationError(
+                "Error: el backend 'onnx' necesita optimum[onnxruntime] (pip install optimum[onnxruntime])"
+            ) from e
+
+        print(f"🧠 Cargando modelo ONNX local desde {self.model_dir}...")
+        self._tokenizer = AutoTokenizer.from_pretrained(self.model_dir)
+        self._model = ORTModelForCausalLM.from_pretrained(self.model_dir, provider="CPUExecutionProvider")
+
+    async def start(self) -> None:
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._load)
+
+    async def close(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _inputs(self, prompt: str):
+        if getattr(self._tokenizer, "chat_template", None):
+            prompt = self._tokenizer.apply_chat_template(
+                [{"role": "user", "content": prompt}], tokenize=False, add_generation_prompt=True
+            )
+        return self._tokenizer(prompt, return_tensors="pt")
+
+    def _generate_kwargs(self) -> dict:
+        kwargs = {"max_new_tokens": GENERATION_MAX_TOKENS, "do_sample": GENERATION_TEMPERATURE > 0}
+        if GENERATION_TEMPERATURE > 0:
+            kwargs["temperature"] = GENERATION_TEMPERATURE
+        return kwargs
+
+    def _generate_sync(self, prompt: str) -> tuple[str, int, int]:
+        self._load()
+        inputs = self._inputs(prompt)
+        prompt_tokens = inputs["input_ids"].shape[1]
+        output = self._model.generate(**inputs, **self._generate_kwargs())
+        new_tokens = output[0][prompt_tokens:]
+        return self._tokenizer.decode(new_tokens, skip_special_tokens=True), prompt_tokens, len(new_tokens)
+
+    async def _generate(self, prompt: str, question: str) -> tuple[str, int | None, int | None]:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._generate_sync, prompt)
+
+    async def _stream(self, prompt: str, question: str) -> AsyncIterator[str | dict]:
+        from transformers import StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._load)
+
+        cancelled = threading.Event()
+
+        class _StopWhenCancelled(StoppingCriteria):
+            def __call__(self, input_ids, scores, **kwargs):
+                return cancelled.is_set()
+
+        inputs = self._inputs(prompt)
+        streamer = TextIteratorStreamer(
+            self._tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=GENERATION_READ_TIMEOUT
+        )
+        generation = loop.run_in_executor(
+            self._executor,
+            lambda: self._model.generate(
+                **inputs, **self._generate_kwargs(), streamer=streamer,
+                stopping_criteria=StoppingCriteriaList([_StopWhenCancelled()]),
+            ),
+        )
+        try:
+            while True:
+                try:
+                    delta = await loop.run_in_executor(None, next, streamer, None)
+                except queue.Empty:
+                    raise GenerationError("Error: timeout generando con el modelo local.")
+                if delta is None:
+                    break
+                if delta:
+                    yield delta
+            output = await generation
+            prompt_tokens = inputs["input_ids"].shape[1]
+            yield {"prompt_tokens": prompt_tokens, "completion_tokens": output.shape[1] - prompt_tokens}
+        finally:
+            # El consumidor se fue: parar la generación en el siguiente token
+            cancelled.set()
+
+
+class FakeBackend(GenerationBackend):
+    """
+    Deterministic answers with configurable latency, no network or model.
+
+    Args:
+        first_token_ms (float): Delay before the first token.
+        token_ms (float): Delay between tokens.
+        tokens (int): Tokens per answer.
+    """
+
+    name = "fake"
+
+    def __init__(self, first_token_ms: float = FAKE_FIRST_TOKEN_MS, token_ms: float = FAKE_TOKEN_MS, tokens: int = FAKE_TOKENS):
+        super().__init__("fake/deterministic")
+        self.first_token = first_token_ms / 1000
+        self.token_delay = token_ms / 1000
+        self.tokens = tokens
+
+    async def _generate(self, prompt: str, question: str) -> tuple[str, int | None, int | None]:
+        tokens = fake_answer_tokens(question, self.tokens)
+        await asyncio.sleep(self.first_token + self.token_delay * len(tokens))
+        return "".join(tokens), None, len(tokens)
+
+    async def _stream(self, prompt: str, question: str) -> AsyncIterator[str | dict]:
+        tokens = fake_answer_tokens(question, self.tokens)
+        await asyncio.sleep(self.first_token)
+        for token in tokens:
+            yield token
+            await asyncio.sleep(self.token_delay)
+        yield {"completion_tokens": len(tokens)}
+
+
+def create_backend(name: str = GENERATION_BACKEND) -> GenerationBackend:
+    """
+    Instantiates the generation backend selected in the configuration.
+
+    Args:
+        name (str): 'openrouter', 'openai', 'onnx' or 'fake'.
+
+    Returns:
+        GenerationBackend: The backend (not started yet).
+    """
+    if name == "openrouter":
+        return OpenRouterBackend()
+    if name == "openai":
+        return OpenAICompatibleBackend(OPENAI_COMPAT_API_URL, OPENAI_COMPAT_MODEL, api_key=OPENAI_COMPAT_API_KEY)
+    if name == "onnx":
+        return OnnxLocalBackend()
+    if name == "fake":
+        return FakeBackend()
+    raise ValueError(f"Unknown generation backend: {name}")
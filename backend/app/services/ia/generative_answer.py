@@ -1,53 +1,132 @@
 import requests
-import os
-from dotenv import load_dotenv
+from typing import AsyncIterator
 
-load_dotenv()
+from app.config import (
+    GENERATION_API_URL,
+    GENERATION_MODEL,
+    GENERATION_CONNECT_TIMEOUT,
+    GENERATION_READ_TIMEOUT,
+    GENERATION_MAX_TOKENS,
+    GENERATION_TEMPERATURE,
+)
+from app.services.ia.generation_backends import (
+    GenerationBackend,
+    GenerationError,
+    build_prompt,
+    create_backend,
+    openrouter_headers,
+)
 
-API_KEY = os.getenv("OPENROUTER_API_KEY")
+# Backend de generación compartido. Se crea/cierra en el lifespan de la app.
+_backend: GenerationBackend | None = None
+_sync_session: requests.Session | None = None
 
-def generate_answer_openrouter(question: str, context_chunks: list[str], model: str = "openai/gpt-3.5-turbo") -> str:
+
+def get_generation_backend() -> GenerationBackend:
     """
-    Uses OpenRouter to generate a natural language answer from provided context.
+    Returns the configured generation backend (GENERATION_BACKEND), creating it on first use.
+    """
+    global _backend
+    if _backend is None:
+        _backend = create_backend()
+    return _backend
+
+
+async def start_generation_backend() -> GenerationBackend:
+    """
+    Creates the generation backend and its connections (or loads the local
+    model). Called once at application startup.
+    """
+    backend = get_generation_backend()
+    await backend.start()
+    print(f"🤖 Backend de generación: {backend.name} ({backend.model})")
+    return backend
+
+
+async def close_generation_backend() -> None:
+    """
+    Releases the generation backend. Called at application shutdown.
+    """
+    global _backend
+    if _backend is not None:
+        await _backend.close()
+        _backend = None
+
+
+async def generate_answer_async(question: str, context_chunks: list[str]) -> tuple[str, bool]:
+    """
+    Generates an answer with the configured backend without holding a worker
+    thread while the model runs.
 
     Args:
         question (str): The user's question.
         context_chunks (list[str]): Relevant text chunks from rule index.
-        model (str): Model to use (default: GPT-3.5 Turbo)
 
     Returns:
-        str: The generated answer from the model.
+        tuple[str, bool]: The generated answer (or the error message) and
+        whether generation succeeded.
     """
-    prompt = f"""Eres un juez profesional de Magic: The Gathering. Usa el contexto para dar una respuesta específica, incluso si el término exacto no aparece.
+    try:
+        result = await get_generation_backend().generate(question, context_chunks)
+    except GenerationError as e:
+        return str(e), False
+    return result.text, True
 
 
-### Contexto:
-{chr(10).join(context_chunks)}
+def stream_answer_tokens(question: str, context_chunks: list[str]) -> AsyncIterator[str]:
+    """
+    Streams the answer token by token from the configured backend.
 
-### Pregunta:
-{question}
+    Closing the generator early (e.g. the client disconnected) stops the
+    generation upstream.
 
-### Respuesta:"""
+    Args:
+        question (str): The user's question.
+        context_chunks (list[str]): Relevant text chunks from rule index.
+
+    Returns:
+        AsyncIterator[str]: Text deltas in arrival order; raises
+        `GenerationError` if the backend fails.
+    """
+    return get_generation_backend().stream(question, context_chunks)
+
+
+def generate_answer_openrouter(question: str, context_chunks: list[str], model: str = GENERATION_MODEL) -> str:
+    """
+    Uses OpenRouter to generate a natural language answer from provided context.
+
+    Blocking variant for offline scripts; the API uses the configured backend.
+
+    Args:
+        question (str): The user's question.
+        context_chunks (list[str]): Relevant text chunks from rule index.
+        model (str): Model to use (default: GPT-3.5 Turbo)
+
+    Returns:
+        str: The generated answer from the model.
+    """
+    global _sync_session
+    if _sync_session is None:
+        _sync_session = requests.Session()
+        _sync_session.headers.update(openrouter_headers())
 
-    headers = {
-        "Authorization": f"Bearer {API_KEY}",
-        "Content-Type": "application/json",
-        "HTTP-Referer": "https://tu-dominio.dev",
-        "X-Title": "Coyote-Aethermind"
+    prompt = build_prompt(question, context_chunks)
+    payload = {
+        "model": model,
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": GENERATION_TEMPERATURE,
+        "max_tokens": GENERATION_MAX_TOKENS
     }
 
-    response = requests.post(
-        "https://openrouter.ai/api/v1/chat/completions",
-        headers=headers,
-        json={
-            "model": model,
-            "messages": [{"role": "user", "content": prompt}],
-            "temperature": 0.7,
-            "max_tokens": 500
-        }
-    )
+    try:
+        response = _sync_session.post(
+            GENERATION_API_URL,
+            json=payload,
+            timeout=(GENERATION_CONNECT_TIMEOUT, GENERATION_READ_TIMEOUT)
+        )
+    except requests.Timeout:
+        return "Error: timeout al contactar con el modelo."
 
     if response.status_code == 200:
         return response.json()["choices"][0]["message"]["content"].strip()
-    else:
-        return f"Error: {response.status_code} - {response.text}"
+    return f"Error: {response.status_code} - {response.text}"
@@ -0,0 +1,168 @@
+"""
+lexical_index.py
+
+In-process BM25 inverted index over the rule chunks.
+
+Built by build_index.py and stored as `bm25.npz` next to `faiss.index`:
+a sorted vocabulary plus CSR postings (term offsets, doc ids, term
+frequencies) and document lengths. `semantic_search` fuses its ranking with
+the vector ranking (reciprocal rank fusion) and can skip the vector stage for
+keyword-style questions with a confident lexical hit.
+"""
+
+import math
+import re
+import unicodedata
+from collections import Counter
+
+import numpy as np
+
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:[.'-][a-z0-9]+)*")
+
+STOPWORDS = {
+    # English
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "for", "from", "has", "if",
+    "in", "is", "it", "its", "of", "on", "or", "that", "the", "this", "to", "was", "with",
+    # Español (las preguntas llegan en castellano)
+    "al", "como", "con", "cual", "de", "del", "el", "en", "entre", "es", "esta", "hay",
+    "la", "las", "lo", "los", "mi", "por", "que", "se", "si", "su", "un", "una", "y",
+}
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Lowercases, strips accents and splits into terms (rule numbers such as
+    "702.19b" stay one token). Stopwords are dropped.
+    """
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return [t for t in TOKEN_RE.findall(text) if t not in STOPWORDS]
+
+
+def build_bm25_index(texts: list[str], path: str, k1: float = 1.2, b: float = 0.75) -> dict:
+    """
+    Builds the BM25 postings for the chunk texts and saves them to `path`.
+
+    Args:
+        texts (list[str]): Chunk texts; doc ids are their positions.
+        path (str): Output .npz file.
+        k1 (float): BM25 term-frequency saturation.
+        b (float): BM25 length normalization.
+
+    Returns:
+        dict: Vocabulary size and number of postings.
+    """
+    postings: dict[str, list[tuple[int, int]]] = {}
+    doc_lengths = np.zeros(len(texts), dtype=np.float32)
+
+    for doc_id, text in enumerate(texts):
+        tokens = tokenize(text)
+        doc_lengths[doc_id] = len(tokens)
+        for term, tf in Counter(tokens).items():
+            postings.setdefault(term, []).append((doc_id, tf))
+
+    vocab = sorted(postings)
+    term_offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+    for i, term in enumerate(vocab):
+        term_offsets[i + 1] = term_offsets[i] + len(postings[term])
+
+    doc_ids = np.empty(term_offsets[-1], dtype=np.int32)
+    tfs = np.empty(term_offsets[-1], dtype=np.float32)
+    for i, term in enumerate(vocab):
+        entries = postings[term]
+        start = term_offsets[i]
+        doc_ids[start:start + len(entries)] = [d for d, _ in entries]
+        tfs[start:start + len(entries)] = [tf for _, tf in entries]
+
+    np.savez(
+        path,
+        vocab=np.array(vocab, dtype=str),
+        term_offsets=term_offsets,
+        doc_ids=doc_ids,
+        tfs=tfs,
+        doc_lengths=doc_lengths,
+        params=np.array([k1, b], dtype=np.float32),
+    )
+    return {"terms": len(vocab), "postings": int(term_offsets[-1])}
+
+
+class BM25Index:
+    """
+    Loaded BM25 index.
+
+    Args:
+        path (str): .npz file written by `build_bm25_index`.
+    """
+
+    def __init__(self, path: str):
+        data = np.load(path)
+        self.vocab = {term: i for i, term in enumerate(data["vocab"].tolist())}
+        self.term_offsets = data["term_offsets"]
+        self.doc_ids = data["doc_ids"]
+        self.tfs = data["tfs"]
+        self.doc_lengths = data["doc_lengths"]
+        self.k1, self.b = (float(x) for x in data["params"])
+        self.num_docs = len(self.doc_lengths)
+        avgdl = float(self.doc_lengths.mean()) if self.num_docs else 1.0
+        # Denominador constante por documento, precalculado
+        self._norm = self.k1 * (1 - self.b + self.b * self.doc_lengths / max(avgdl, 1e-9))
+
+    def _idf(self, df: int) -> float:
+        return math.log(1 + (self.num_docs - df + 0.5) / (df + 0.5))
+
+    def search(self, query: str, top_k: int = 8) -> tuple[list[int], list[float], float]:
+        """
+        Ranks chunks for a query.
+
+        Args:
+            query (str): The user's query.
+            top_k (int): Number of results.
+
+        Returns:
+            tuple: (doc ids, scores, coverage), where coverage is the fraction of
+            the known query terms present in the best document.
+        """
+        term_ids = list(dict.fromkeys(self.vocab[t] for t in tokenize(query) if t in self.vocab))
+        if not term_ids or self.num_docs == 0:
+            return [], [], 0.0
+
+        scores = np.zeros(self.num_docs, dtype=np.float32)
+        matched = np.zeros(self.num_docs, dtype=np.int16)
+        for term_id in term_ids:
+            start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+            docs = self.doc_ids[start:end]
+            tf = self.tfs[start:end]
+            scores[docs] += self._idf(end - start) * tf * (self.k1 + 1) / (tf + self._norm[docs])
+            matched[docs] += 1
+
+        k = min(top_k, self.num_docs)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        top = top[scores[top] > 0]
+
+        coverage = float(matched[top[0]]) / len(term_ids) if len(top) else 0.0
+        return top.tolist(), scores[top].tolist(), coverage
+
+    def num_query_terms(self, query: str) -> int:
+        """
+        Number of distinct query terms present in the vocabulary.
+        """
+        return len({t for t in tokenize(query) if t in self.vocab})
+
+
+def reciprocal_rank_fusion(rankings: list[list[int]], k: int = 60) -> list[int]:
+    """
+    Fuses several rankings of doc ids: score(d) = Σ 1 / (k + rank(d)).
+
+    Args:
+        rankings (list[list[int]]): Doc ids ordered best first, one list per retriever.
+        k (int): RRF damping constant.
+
+    Returns:
+        list[int]: Fused ranking, best first.
+    """
+    scores: dict[int, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
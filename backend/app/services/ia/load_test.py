@@ -0,0 +1,399 @@
+"""
+load_test.py
+
+Async load generator for the Aethermind API.
+
+Two load models:
+- closed loop (`--users N`): N simulated users, each sending its next question
+  as soon as the previous answer arrives (optionally after `--think-ms`).
+  Throughput adapts to the server; good for finding the capacity knee.
+- open loop (`--rps R`): requests arrive at a fixed rate (uniform or Poisson
+  arrivals) whether or not earlier ones finished. Latency is measured from the
+  scheduled send time, so a slow server is not hidden by a slower client
+  (coordinated omission).
+
+Requests sent during `--warmup` seconds are discarded; the report covers the
+following `--duration` seconds: latency percentiles, time to first token
+(stream endpoint), error rates by kind (a 200 flagged `"error": true` by the
+API counts as "generation_error"), throughput and the average
+Server-Timing stages reported by the API. The report is printed as JSON and
+optionally written to `--output`. `--max-p95-ms` / `--max-error-rate` make the
+script exit with status 1 when exceeded, to catch capacity regressions.
+
+Run it against a local server with the fake LLM backend, so the numbers
+measure the service and not the provider:
+    GENERATION_BACKEND=fake uvicorn app.main:app
+    python -m app.services.ia.load_test --users 32 --warmup 10 --duration 60
+    python -m app.services.ia.load_test --rps 50 --endpoint stream --no-cache --output load.json
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from dataclasses import dataclass, field
+
+import httpx
+
+BASE_URL = "http://127.0.0.1:8000"
+
+# Pool de plantillas
+QUESTION_TEMPLATES = [
+    "¿Qué es {}?",
+    "¿Cómo funciona {}?",
+    "¿Qué ocurre si uso {} con {}?",
+    "¿Qué pasa si mi oponente juega {}?",
+    "¿Puedo responder con {} a {}?",
+    "¿Se puede prevenir {} con {}?",
+    "¿Qué sucede si copio un hechizo con {}?",
+    "¿En qué orden se resuelven {} y {}?",
+    "¿Cómo afecta {} a {}?",
+    "¿Qué interacción hay entre {} y {}?",
+]
+
+# Keywords / habilidades / conceptos de MTG
+KEYWORDS = [
+    "la pila",
+    "storm",
+    "protection",
+    "trample",
+    "first strike",
+    "double strike",
+    "lifelink",
+    "deathtouch",
+    "flashback",
+    "morph",
+    "cascade",
+    "split second",
+    "counterspell",
+    "copy",
+    "combat damage",
+    "planeswalker",
+    "legend rule",
+    "state-based actions",
+    "priority",
+    "replacement effect",
+    "triggered ability",
+    "continuous effect",
+    "mana ability",
+    "static ability",
+    "layers",
+    "timestamp",
+    "two-headed giant",
+    "commander damage",
+    "partner",
+    "saga",
+    "crew",
+    "modular",
+    "equip",
+    "meld",
+    "venture into the dungeon",
+    "initiative",
+    "poison counters",
+    "emblem",
+    "combat phase",
+    "turn structure",
+    "stack",
+]
+
+ENDPOINTS = {
+    "ask": "/ask_rule",
+    "stream": "/ask_rule/stream",
+}
+
+
+def generate_question(rng: random.Random) -> str:
+    """
+    Generates a random Magic rules question using 1 or 2 keywords as needed.
+    """
+    template = rng.choice(QUESTION_TEMPLATES)
+    words = [rng.choice(KEYWORDS) for _ in range(template.count("{}"))]
+    return template.format(*words)
+
+
+def _percentile(values: list[float], pct: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def _latency_summary(seconds: list[float]) -> dict:
+    def ms(value):
+        return round(value * 1000, 2) if value is not None else None
+
+    return {
+        "p50": ms(_percentile(seconds, 50)),
+        "p90": ms(_percentile(seconds, 90)),
+        "p95": ms(_percentile(seconds, 95)),
+        "p99": ms(_percentile(seconds, 99)),
+        "max": ms(max(seconds) if seconds else None),
+        "mean": ms(sum(seconds) / len(seconds) if seconds else None),
+    }
+
+
+def _parse_server_timing(header: str | None) -> dict[str, float]:
+    timings = {}
+    for entry in (header or "").split(","):
+        name, _, params = entry.strip().partition(";")
+        if name and params.startswith("dur="):
+            try:
+                timings[name] = float(params[4:])
+            except ValueError:
+                pass
+    return timings
+
+
+@dataclass
+class Sample:
+    """
+    Outcome of one request.
+    """
+    sent: float
+    latency: float
+    error: str | None = None
+    ttft: float | None = None
+    server_timing: dict = field(default_factory=dict)
+
+
+class LoadTest:
+    """
+    Drives one load test run and collects its samples.
+
+    Args:
+        base_url (str): API base URL.
+        endpoint (str): "ask" (/ask_rule) or "stream" (/ask_rule/stream).
+        no_cache (bool): Bypass the semantic answer cache on every request.
+        timeout (float): Per-request timeout in seconds.
+        seed (int): Seed for the question generator.
+    """
+
+    def __init__(self, base_url: str = BASE_URL, endpoint: str = "ask", no_cache: bool = False,
+                 timeout: float = 60.0, seed: int = 0):
+        self.url = base_url.rstrip("/") + ENDPOINTS[endpoint]
+        self.endpoint = endpoint
+        self.no_cache = no_cache
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        self.samples: list[Sample] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.skipped = 0
+
+    async def _request(self, client: httpx.AsyncClient, sent: float) -> None:
+        params = {"question": generate_question(self.rng)}
+        if self.no_cache:
+            params["no_cache"] = "true"
+
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        sample = Sample(sent=sent, latency=0.0)
+        try:
+            async with client.stream("GET", self.url, params=params) as response:
+                sample.server_timing = _parse_server_timing(response.headers.get("server-timing"))
+                if response.status_code != 200:
+                    await response.aread()
+                    sample.error = f"http_{response.status_code}"
+                elif self.endpoint == "stream":
+                    await self._read_stream(response, sample)
+                else:
+                    # Un fallo del modelo llega como 200 con "error": true
+                    try:
+                        failed = json.loads(await response.aread()).get("error")
+                    except (ValueError, AttributeError):
+                        sample.error = "invalid_response"
+                    else:
+                        if failed:
+                            sample.error = "generation_error"
+        except httpx.TimeoutException:
+            sample.error = "timeout"
+        except httpx.HTTPError as e:
+            sample.error = type(e).__name__
+        finally:
+            self.in_flight -= 1
+        sample.latency = time.perf_counter() - sent
+        self.samples.append(sample)
+
+    async def _read_stream(self, response: httpx.Response, sample: Sample) -> None:
+        event = None
+        async for line in response.aiter_lines():
+            if line.startswith("event: "):
+                event = line[7:]
+                if event == "token" and sample.ttft is None:
+                    sample.ttft = time.perf_counter() - sample.sent
+                elif event == "error":
+                    sample.error = "generation_error"
+            elif not line and event == "done":
+                return
+        if sample.error is None:
+            sample.error = "stream_truncated"
+
+    def _client(self, connections: int) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            timeout=httpx.Timeout(self.timeout, connect=5.0),
+            limits=httpx.Limits(max_connections=connections, max_keepalive_connections=connections),
+        )
+
+    async def run_closed(self, users: int, warmup: float, duration: float, think_ms: float = 0.0) -> tuple[float, float]:
+        """
+        Closed loop: `users` concurrent users send requests back to back.
+
+        Returns:
+            tuple[float, float]: Start and end of the measurement window (perf_counter).
+        """
+        start = time.perf_counter()
+        window = (start + warmup, start + warmup + duration)
+
+        async def user(client):
+            while time.perf_counter() < window[1]:
+                await self._request(client, time.perf_counter())
+                if think_ms:
+                    await asyncio.sleep(think_ms / 1000)
+
+        async with self._client(users) as client:
+            await asyncio.gather(*(user(client) for _ in range(users)))
+        return window
+
+    async def run_open(self, rps: float, warmup: float, duration: float, poisson: bool = True,
+                       max_in_flight: int = 1000) -> tuple[float, float]:
+        """
+        Open loop: requests are sent at `rps` on average, independently of
+        the responses. Arrivals beyond `max_in_flight` pending requests are
+        counted as skipped instead of piling up in the client.
+
+        Returns:
+            tuple[float, float]: Start and end of the measurement window (perf_counter).
+        """
+        start = time.perf_counter()
+        window = (start + warmup, start + warmup + duration)
+        tasks: set[asyncio.Task] = set()
+
+        async with self._client(max_in_flight) as client:
+            next_send = start
+            while next_send < window[1]:
+                delay = next_send - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if self.in_flight >= max_in_flight:
+                    if next_send >= window[0]:
+                        self.skipped += 1
+                else:
+                    # Latencia desde el envío programado, no desde el real
+                    task = asyncio.create_task(self._request(client, next_send))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                next_send += self.rng.expovariate(rps) if poisson else 1 / rps
+            if tasks:
+                await asyncio.gather(*tasks)
+        return window
+
+    def report(self, window: tuple[float, float]) -> dict:
+        """
+        Summarizes the requests sent inside the measurement window.
+        """
+        measured = [s for s in self.samples if window[0] <= s.sent < window[1]]
+        ok = [s for s in measured if s.error is None]
+        errors: dict[str, int] = {}
+        for sample in measured:
+            if sample.error:
+                errors[sample.error] = errors.get(sample.error, 0) + 1
+
+        stages: dict[str, list[float]] = {}
+        for sample in ok:
+            for name, ms in sample.server_timing.items():
+                stages.setdefault(name, []).append(ms)
+
+        duration = window[1] - window[0]
+        attempted = len(measured) + self.skipped
+        report = {
+            "requests": len(measured),
+            "ok": len(ok),
+            "errors": errors,
+            "skipped": self.skipped,
+            "error_rate": round((attempted - len(ok)) / attempted, 4) if attempted else 0.0,
+            "throughput_rps": round(len(ok) / duration, 2) if duration else None,
+            "max_in_flight": self.max_in_flight,
+            "latency_ms": _latency_summary([s.latency for s in ok]),
+            "server_timing_ms": {name: round(sum(v) / len(v), 2) for name, v in sorted(stages.items())},
+        }
+        if self.endpoint == "stream":
+            report["ttft_ms"] = _latency_summary([s.ttft for s in ok if s.ttft is not None])
+        return report
+
+
+async def _wait_ready(base_url: str, timeout: float = 120.0) -> None:
+    deadline = time.perf_counter() + timeout
+    async with httpx.AsyncClient(timeout=5.0) as client:
+        while True:
+            try:
+                response = await client.get(base_url.rstrip("/") + "/ready")
+                if response.status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            if time.perf_counter() > deadline:
+                raise RuntimeError(f"{base_url} no está listo tras {timeout:.0f} s")
+            await asyncio.sleep(1)
+
+
+async def main_async(args) -> dict:
+    await _wait_ready(args.url)
+    test = LoadTest(args.url, args.endpoint, args.no_cache, args.timeout, args.seed)
+
+    if args.rps:
+        mode = {"mode": "open", "rps": args.rps, "arrivals": "uniform" if args.uniform else "poisson"}
+        print(f"🚀 Lazo abierto: {args.rps} req/s contra {test.url} ({args.warmup:.0f} s calentamiento + {args.duration:.0f} s)")
+        window = await test.run_open(args.rps, args.warmup, args.duration, not args.uniform, args.max_in_flight)
+    else:
+        mode = {"mode": "closed", "users": args.users, "think_ms": args.think_ms}
+        print(f"🚀 Lazo cerrado: {args.users} usuarios contra {test.url} ({args.warmup:.0f} s calentamiento + {args.duration:.0f} s)")
+        window = await test.run_closed(args.users, args.warmup, args.duration, args.think_ms)
+
+    config = {**mode, "endpoint": args.endpoint, "no_cache": args.no_cache,
+              "warmup_s": args.warmup, "duration_s": args.duration}
+    return {"config": config, **test.report(window)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the Aethermind API (open or closed loop)")
+    parser.add_argument("--url", default=BASE_URL, help="API base URL")
+    parser.add_argument("--endpoint", choices=sorted(ENDPOINTS), default="ask")
+    load = parser.add_mutually_exclusive_group()
+    load.add_argument("--users", type=int, default=16, help="Closed loop: concurrent users")
+    load.add_argument("--rps", type=float, default=None, help="Open loop: target requests per second")
+    parser.add_argument("--think-ms", type=float, default=0.0, help="Closed loop: pause between a user's requests")
+    parser.add_argument("--uniform", action="store_true", help="Open loop: evenly spaced instead of Poisson arrivals")
+    parser.add_argument("--max-in-flight", type=int, default=1000, help="Open loop: pending requests before skipping arrivals")
+    parser.add_argument("--warmup", type=float, default=10.0, help="Seconds of load excluded from the report")
+    parser.add_argument("--duration", type=float, default=60.0, help="Seconds of measured load")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Per-request timeout in seconds")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the semantic answer cache")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Also write the JSON report to this file")
+    parser.add_argument("--max-p95-ms", type=float, default=None, help="Exit with status 1 if p95 latency is higher")
+    parser.add_argument("--max-error-rate", type=float, default=None, help="Exit with status 1 if the error rate is higher")
+    args = parser.parse_args()
+
+    report = asyncio.run(main_async(args))
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"💾 Informe guardado en {args.output}")
+
+    failures = []
+    p95 = report["latency_ms"]["p95"]
+    if args.max_p95_ms is not None and (p95 is None or p95 > args.max_p95_ms):
+        failures.append(f"p95 {p95} ms > {args.max_p95_ms} ms")
+    if args.max_error_rate is not None and report["error_rate"] > args.max_error_rate:
+        failures.append(f"error_rate {report['error_rate']} > {args.max_error_rate}")
+    if failures:
+        print(f"❌ Regresión de capacidad: {'; '.join(failures)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
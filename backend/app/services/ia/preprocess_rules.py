@@ -1,29 +1,198 @@
-def split_rules_into_chunks(file_path: str, max_chars: int = 512) -> list[str]:
+"""
+preprocess_rules.py
+
+Rule-aware chunking of the Magic comprehensive rules (MagicCompRules.txt).
+
+The file is parsed line by line (never loaded whole) into entries that know
+their structure:
+
+    1. Game Concepts                 → section
+    100. General                     → rule group title
+    100.1. These Magic rules ...     → rule
+    100.1a A two-player game ...     → subrule
+    Glossary / <term> / <definition> → glossary entry
+
+Chunks never cut a rule or subrule in half and carry rule-id metadata
+(`rule`, `rules`, `section`, or `term` for glossary entries), which feeds the
+exact rule lookup used by `semantic_search`.
+"""
+
+import re
+from typing import Iterator
+
+SECTION_RE = re.compile(r"^(\d)\.\s+(\S.*)$")
+RULE_GROUP_RE = re.compile(r"^(\d{3})\.\s+(\S.*)$")
+RULE_RE = re.compile(r"^(\d{3}\.\d+)\.\s+(.*)$")
+SUBRULE_RE = re.compile(r"^(\d{3}\.\d+[a-z])\s+(.*)$")
+
+
+def iter_rule_entries(file_path: str) -> Iterator[dict]:
     """
-    Splits the MTG rules text into smaller chunks for embedding.
+    Streams the structured entries of the comprehensive rules.
+
+    The table of contents and credits are skipped: rules start at the first
+    numbered rule (e.g. "100.1.") and the glossary at the "Glossary" heading
+    that follows them.
 
     Args:
         file_path (str): Path to the full rules text file.
-        max_chars (int): Maximum number of characters per chunk.
+
+    Yields:
+        dict: {"kind": "rule"|"subrule"|"glossary", "id", "parent", "section",
+        "group", "text"} (glossary entries carry "term" instead of ids).
+    """
+    in_rules = False
+    in_glossary = False
+    section = ""
+    group = ""
+    current = None
+    glossary_lines: list[str] = []
+
+    def flush_glossary():
+        if glossary_lines:
+            term = glossary_lines[0]
+            text = "\n".join(glossary_lines)
+            glossary_lines.clear()
+            return {"kind": "glossary", "term": term, "section": "Glossary", "text": text}
+        return None
+
+    with open(file_path, "r", encoding="utf-8-sig") as f:
+        for raw in f:
+            line = raw.strip()
+
+            if in_glossary:
+                if line == "Credits":
+                    break
+                if not line:
+                    entry = flush_glossary()
+                    if entry:
+                        yield entry
+                else:
+                    glossary_lines.append(line)
+                continue
+
+            if not in_rules:
+                match = SECTION_RE.match(line)
+                if match:
+                    section = line
+                match = RULE_GROUP_RE.match(line)
+                if match:
+                    group = line
+                if not RULE_RE.match(line):
+                    continue
+                in_rules = True
+
+            if not line:
+                continue
+
+            if line == "Glossary":
+                if current:
+                    yield current
+                    current = None
+                in_glossary = True
+                continue
+
+            if SECTION_RE.match(line):
+                section = line
+                continue
+            if RULE_GROUP_RE.match(line):
+                group = line
+                continue
+
+            match = RULE_RE.match(line) or SUBRULE_RE.match(line)
+            if match:
+                if current:
+                    yield current
+                rule_id = match.group(1)
+                is_subrule = rule_id[-1].isalpha()
+                current = {
+                    "kind": "subrule" if is_subrule else "rule",
+                    "id": rule_id,
+                    "parent": rule_id[:-1] if is_subrule else rule_id,
+                    "section": section,
+                    "group": group,
+                    "text": line,
+                }
+            elif current:
+                # Líneas "Example:" y continuaciones pertenecen a la regla actual
+                current["text"] += "\n" + line
+
+    if current and not in_glossary:
+        yield current
+    entry = flush_glossary()
+    if entry:
+        yield entry
+
+
+def _rule_chunks(entries: list[dict], max_chars: int) -> Iterator[dict]:
+    """
+    Packs one rule and its subrules into chunks of at most ~max_chars,
+    splitting only at subrule boundaries. Continuation chunks repeat the
+    rule heading so they stay self-describing.
+    """
+    heading = entries[0]["text"].split("\n", 1)[0] if entries[0]["kind"] == "rule" else ""
+    parent = entries[0]["parent"]
+    base = {"kind": "rule", "rule": parent, "section": entries[0]["section"], "group": entries[0]["group"]}
+
+    texts: list[str] = []
+    ids: list[str] = []
+    size = 0
+    for entry in entries:
+        if ids and size + len(entry["text"]) + 1 > max_chars:
+            yield {"text": "\n".join(texts), "meta": {**base, "rules": ids}}
+            texts, ids = ([heading], []) if heading else ([], [])
+            size = len(heading)
+        texts.append(entry["text"])
+        ids.append(entry["id"])
+        size += len(entry["text"]) + 1
+
+    if ids:
+        yield {"text": "\n".join(texts), "meta": {**base, "rules": ids}}
+
+
+def split_rules_into_records(file_path: str, max_chars: int = 512) -> list[dict]:
+    """
+    Splits the MTG rules into rule-aware chunks with metadata.
+
+    Args:
+        file_path (str): Path to the full rules text file.
+        max_chars (int): Target maximum characters per chunk (a single
+            subrule longer than this is kept whole rather than cut).
 
     Returns:
-        List[str]: A list of text chunks.
+        list[dict]: [{"text": str, "meta": dict}, ...] in document order.
     """
-    with open(file_path, "r", encoding="utf-8") as f:
-        text = f.read()
+    records = []
+    pending: list[dict] = []
+
+    for entry in iter_rule_entries(file_path):
+        if entry["kind"] == "glossary":
+            if pending:
+                records.extend(_rule_chunks(pending, max_chars))
+                pending = []
+            records.append({"text": entry["text"], "meta": {"kind": "glossary", "term": entry["term"], "section": "Glossary"}})
+            continue
 
-    sections = text.split("\n\n")
-    chunks = []
-    current_chunk = ""
+        if pending and entry["parent"] != pending[0]["parent"]:
+            records.extend(_rule_chunks(pending, max_chars))
+            pending = []
+        pending.append(entry)
 
-    for section in sections:
-        if len(current_chunk) + len(section) < max_chars:
-            current_chunk += section + "\n\n"
-        else:
-            chunks.append(current_chunk.strip())
-            current_chunk = section + "\n\n"
+    if pending:
+        records.extend(_rule_chunks(pending, max_chars))
 
-    if current_chunk:
-        chunks.append(current_chunk.strip())
+    return records
 
-    return chunks
+
+def split_rules_into_chunks(file_path: str, max_chars: int = 512) -> list[str]:
+    """
+    Splits the MTG rules text into smaller chunks for embedding.
+
+    Args:
+        file_path (str): Path to the full rules text file.
+        max_chars (int): Maximum number of characters per chunk.
+
+    Returns:
+        List[str]: A list of text chunks.
+    """
+    return [record["text"] for record in split_rules_into_records(file_path, max_chars)]
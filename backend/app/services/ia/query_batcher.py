@@ -0,0 +1,176 @@
+"""
+query_batcher.py
+
+Micro-batching scheduler for concurrent retrieval queries.
+
+Queries that arrive within `max_wait_ms` of each other (up to `max_batch_size`)
+are embedded with a single `model.encode` call and served by a single FAISS
+`index.search`; the results are then fanned back out to the waiting callers.
+While all batch slots are busy new queries keep accumulating, so batches grow
+with load and a lone request only pays the (small) `max_wait_ms`.
+"""
+
+import asyncio
+from concurrent.futures import Executor
+from typing import Callable
+
+
+class QueryBatcher:
+    """
+    Collects concurrent queries and runs them as one batched search.
+
+    Args:
+        search_fn (Callable): Blocking function `(questions, top_k) -> list[result]`,
+            one result per question.
+        executor_fn (Callable): Returns the executor where `search_fn` runs.
+        max_batch_size (int): Maximum number of queries per batch.
+        max_wait_ms (float): How long the first query of a batch waits for company.
+        max_concurrent_batches (int): Batches allowed to run at the same time.
+        trim_fn (Callable | None): `(result, k) -> result` cutting a result to
+            the caller's top_k (default: list slicing).
+    """
+
+    def __init__(
+        self,
+        search_fn: Callable[[list[str], int], list],
+        executor_fn: Callable[[], Executor],
+        max_batch_size: int = 32,
+        max_wait_ms: float = 2.0,
+        max_concurrent_batches: int = 1,
+        trim_fn: Callable | None = None,
+    ):
+        self.search_fn = search_fn
+        self.executor_fn = executor_fn
+        self.trim_fn = trim_fn or (lambda result, k: result[:k])
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_concurrent_batches = max_concurrent_batches
+
+        self._pending: list[tuple[str, int, asyncio.Future]] = []
+        self._wakeup: asyncio.Event | None = None
+        self._full: asyncio.Event | None = None
+        self._slots: asyncio.Semaphore | None = None
+        self._task: asyncio.Task | None = None
+        self._running: set[asyncio.Task] = set()
+
+        self.batches = 0
+        self.queries = 0
+        self.max_seen_batch = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self) -> None:
+        """
+        Starts the scheduling loop on the running event loop.
+        """
+        if self.running:
+            return
+        self._wakeup = asyncio.Event()
+        self._full = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.max_concurrent_batches)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stops the loop after flushing the queries already queued.
+        """
+        if not self.running:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+        while self._pending:
+            batch, self._pending = self._pending[:self.max_batch_size], self._pending[self.max_batch_size:]
+            await self._execute(batch)
+        if self._running:
+            await asyncio.gather(*self._running, return_exceptions=True)
+
+    async def search(self, question: str, top_k: int = 8):
+        """
+        Queues a query and waits for its batched result.
+
+        Args:
+            question (str): The user's query.
+            top_k (int): Number of relevant results to return.
+
+        Returns:
+            The result of `search_fn` for this question, trimmed to `top_k`.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((question, top_k, future))
+        self._wakeup.set()
+        if len(self._pending) >= self.max_batch_size:
+            self._full.set()
+        return await future
+
+    async def _run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if not self._pending:
+                continue
+
+            # Dar unos milisegundos para que lleguen más consultas
+            if len(self._pending) < self.max_batch_size and self.max_wait > 0:
+                self._full.clear()
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.max_wait)
+                except asyncio.TimeoutError:
+                    pass
+
+            # Mientras no haya hueco, la cola sigue creciendo (lotes más grandes bajo carga)
+            await self._slots.acquire()
+            batch, self._pending = self._pending[:self.max_batch_size], self._pending[self.max_batch_size:]
+            if self._pending:
+                self._wakeup.set()
+
+            task = asyncio.create_task(self._execute(batch, release_slot=True))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _execute(self, batch: list[tuple[str, int, asyncio.Future]], release_slot: bool = False) -> None:
+        try:
+            live = [item for item in batch if not item[2].done()]  # descartar peticiones canceladas
+            if not live:
+                return
+
+            questions = [question for question, _, _ in live]
+            top_k = max(k for _, k, _ in live)
+
+            self.batches += 1
+            self.queries += len(live)
+            self.max_seen_batch = max(self.max_seen_batch, len(live))
+
+            loop = asyncio.get_running_loop()
+            try:
+                results = await loop.run_in_executor(self.executor_fn(), self.search_fn, questions, top_k)
+            except Exception as e:
+                for _, _, future in live:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+
+            for (_, k, future), result in zip(live, results):
+                if not future.done():
+                    future.set_result(self.trim_fn(result, k))
+        finally:
+            if release_slot:
+                self._slots.release()
+
+    def stats(self) -> dict:
+        """
+        Returns batching counters.
+        """
+        return {
+            "batches": self.batches,
+            "queries": self.queries,
+            "avg_batch_size": round(self.queries / self.batches, 2) if self.batches else 0.0,
+            "max_batch_size_seen": self.max_seen_batch,
+            "pending": len(self._pending),
+        }
@@ -0,0 +1,229 @@
+"""
+reranker.py
+
+Second retrieval stage: a small CPU cross-encoder rescoring a wide candidate
+set from FAISS/BM25, so only the few best chunks reach generation.
+
+Scores of (question, chunk) pairs are cached by normalized question and
+chunk id, so repeated and coalesced questions only pay the model once.
+
+Recall check on a held-out question set (glossary definitions paraphrased
+into questions that do not name the term, or a JSONL file of
+{"question", "rules"}). Questions that serving would answer from the rule
+lookup or from confident BM25 never reach the reranker, so they are left out
+of the set and only counted:
+    python -m app.services.ia.reranker --candidates 50 --k 4
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+
+import numpy as np
+
+from app.config import (
+    RERANK_BATCH_SIZE,
+    RERANK_CACHE_SIZE,
+    RERANK_CACHE_TTL,
+    RERANK_CANDIDATES,
+    RERANK_MODEL_ID,
+    RERANK_TOP_K,
+)
+from app.services.ia.embedding_cache import TTLCache, normalize_question
+
+
+class CrossEncoderReranker:
+    """
+    Cross-encoder reranker with a cache of pair scores.
+
+    Args:
+        model_id (str): sentence-transformers CrossEncoder model.
+        batch_size (int): Pairs per forward pass.
+        cache_size (int): Cached (question, chunk) scores.
+        cache_ttl (float): Seconds a cached score stays valid.
+    """
+
+    def __init__(self, model_id: str = RERANK_MODEL_ID, batch_size: int = RERANK_BATCH_SIZE,
+                 cache_size: int = RERANK_CACHE_SIZE, cache_ttl: float = RERANK_CACHE_TTL):
+        self.model_id = model_id
+        self.batch_size = batch_size
+        self.model = None
+        self.scores = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.pairs_scored = 0
+        self.seconds = 0.0
+
+    def load(self) -> None:
+        """
+        Loads the cross-encoder on CPU (idempotent).
+        """
+        if self.model is None:
+            from sentence_transformers import CrossEncoder
+
+            print(f"🧠 Cargando reranker {self.model_id}...")
+            self.model = CrossEncoder(self.model_id, device="cpu")
+
+    def rerank(self, questions: list[str], candidates: list[list[int]], texts: list[list[str]], top_k: int) -> list[list[int]]:
+        """
+        Reorders the candidate chunks of several questions by cross-encoder score.
+
+        All uncached pairs of the batch are scored in one `predict` call.
+
+        Args:
+            questions (list[str]): The user queries.
+            candidates (list[list[int]]): Candidate chunk ids per question.
+            texts (list[list[str]]): Texts of those candidates.
+            top_k (int): Chunks to keep per question.
+
+        Returns:
+            list[list[int]]: Best `top_k` chunk ids per question, best first.
+        """
+        start = time.perf_counter()
+        keys = [[(normalize_question(q), chunk_id) for chunk_id in ids] for q, ids in zip(questions, candidates)]
+        scores = [[self.scores.get(key) for key in row] for row in keys]
+
+        missing = [(i, j) for i, row in enumerate(scores) for j, score in enumerate(row) if score is None]
+        if missing:
+            pairs = [(questions[i], texts[i][j]) for i, j in missing]
+            predicted = self.model.predict(pairs, batch_size=self.batch_size, show_progress_bar=False)
+            for (i, j), score in zip(missing, predicted):
+                scores[i][j] = float(score)
+                self.scores.put(keys[i][j], float(score))
+
+        results = []
+        for ids, row in zip(candidates, scores):
+            order = np.argsort(-np.array(row, dtype=np.float32), kind="stable")[:top_k]
+            results.append([ids[k] for k in order])
+
+        with self._lock:
+            self.calls += 1
+            self.pairs_scored += len(missing)
+            self.seconds += time.perf_counter() - start
+        return results
+
+    def stats(self) -> dict:
+        return {
+            "model_id": self.model_id,
+            "loaded": self.model is not None,
+            "calls": self.calls,
+            "pairs_scored": self.pairs_scored,
+            "avg_ms": round(1000 * self.seconds / self.calls, 2) if self.calls else None,
+            "score_cache": self.scores.stats(),
+        }
+
+
+SEE_RULE_RE = re.compile(r"\s*See (?:also )?rules? .*$")
+
+
+def _held_out_questions(store, path: str | None, seed: int) -> list[tuple[str, set[int]]]:
+    """
+    Builds the candidate evaluation set: (question, relevant chunk ids) pairs.
+    """
+    from app.services.ia import semantic_search
+
+    if path:
+        lookup = semantic_search.rule_lookup
+        items = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    relevant = {i for rule in entry["rules"] for i in lookup.rules.get(rule, [])} if lookup else set()
+                    if relevant:
+                        items.append((entry["question"], relevant))
+        return items
+
+    # Preguntas sintéticas a partir del glosario: se pregunta por la definición
+    # sin nombrar el término (si lo nombrara, la búsqueda exacta la resolvería)
+    glossary = [i for i in range(len(store)) if store.metadata(i).get("kind") == "glossary"]
+    random.Random(seed).shuffle(glossary)
+    items = []
+    for chunk_id in glossary:
+        definition = " ".join(store[chunk_id].split("\n")[1:])
+        sentence = SEE_RULE_RE.sub("", definition.split(". ")[0]).strip().rstrip(".")
+        if len(sentence.split()) >= 4:
+            items.append((f"Which game term means: {sentence}?", {chunk_id}))
+    return items
+
+
+def evaluate(num_questions: int = 200, candidates: int = RERANK_CANDIDATES, k: int = RERANK_TOP_K,
+             questions_path: str | None = None, seed: int = 0) -> dict:
+    """
+    Compares recall@k of the first-stage ranking against the reranked one on a
+    held-out question set, and measures the rerank latency (cold score cache).
+
+    Only questions that serving would send through the vector stage (and so
+    through the reranker) are evaluated; the others are counted per path in
+    `skipped`.
+
+    Args:
+        num_questions (int): Maximum questions in the evaluation set.
+        candidates (int): First-stage candidates per question.
+        k (int): Chunks kept for generation.
+        questions_path (str | None): Optional JSONL of {"question", "rules"}.
+        seed (int): Seed for sampling the synthetic questions.
+
+    Returns:
+        dict: recall@k with and without reranking, latency percentiles and
+        the skipped questions per retrieval path.
+    """
+    from app.services.ia import semantic_search
+
+    semantic_search.load_resources()
+    reranker = CrossEncoderReranker(cache_size=0)
+    reranker.load()
+
+    items, skipped = [], {}
+    for question, relevant in _held_out_questions(semantic_search.chunks, questions_path, seed):
+        if len(items) >= num_questions:
+            break
+        path = semantic_search.retrieval_path(question, k)
+        if path in semantic_search.VECTOR_PATHS:
+            items.append((question, relevant))
+        else:
+            skipped[path] = skipped.get(path, 0) + 1
+    if not items:
+        raise ValueError(f"Empty evaluation set (no glossary metadata, no matching rules or all served by fast paths: {skipped})")
+
+    baseline_hits, reranked_hits, latencies = 0, 0, []
+    for question, relevant in items:
+        ids = semantic_search.first_stage_candidates([question], candidates)[0]
+        texts = semantic_search.chunks.get_many(ids)
+        start = time.perf_counter()
+        reranked = reranker.rerank([question], [ids], [texts], k)[0]
+        latencies.append((time.perf_counter() - start) * 1000)
+        baseline_hits += bool(relevant & set(ids[:k]))
+        reranked_hits += bool(relevant & set(reranked))
+
+    latencies = np.array(latencies)
+    return {
+        "questions": len(items),
+        "skipped": skipped,
+        "candidates": candidates,
+        "k": k,
+        "recall_at_k_first_stage": round(baseline_hits / len(items), 4),
+        "recall_at_k_reranked": round(reranked_hits / len(items), 4),
+        "rerank_ms_p50": round(float(np.percentile(latencies, 50)), 2),
+        "rerank_ms_p95": round(float(np.percentile(latencies, 95)), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Held-out recall check of the cross-encoder reranker")
+    parser.add_argument("--questions", type=int, default=200, help="Held-out questions to evaluate")
+    parser.add_argument("--questions-file", default=None, help='JSONL with {"question", "rules": [...]}')
+    parser.add_argument("--candidates", type=int, default=RERANK_CANDIDATES)
+    parser.add_argument("--k", type=int, default=RERANK_TOP_K)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    report = evaluate(args.questions, args.candidates, args.k, args.questions_file, args.seed)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,343 @@
+"""
+retrieval_benchmark.py
+
+Offline benchmark of the retrieval choices: chunk size, embedding model and
+FAISS index type.
+
+Every combination of `--max-chars` × `--models` × `--index-specs` is built
+from MagicCompRules.txt in a temporary directory (the served index is not
+touched) and queried with a golden question set. Relevance is defined by rule
+numbers, not chunk ids, so the same golden set scores any chunking: a
+retrieved chunk is relevant if it contains one of the expected rules (or a
+subrule of an expected rule).
+
+Golden set sources (combined, deduplicated by normalized question):
+- `history`: past questions whose answer cites rule numbers ("rule 702.19b");
+- rule titles: "702.19. Trample" → "How does Trample work?" → {702.19};
+- `--golden-file`: JSONL of {"question", "rules": [...]}.
+
+For each candidate the report has recall@k, MRR, chunk count, embedding and
+build time, index size on disk, memory growth of the process, and per-query
+latency percentiles (search only and encode + search). The JSON output has
+sorted keys and rounded values so reports of two commits can be diffed:
+    python -m app.services.ia.retrieval_benchmark --max-chars 256 512 1024 --index-specs flat hnsw ivf --output bench.json
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import sqlite3
+import subprocess
+import tempfile
+import time
+
+import faiss
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+from app.config import EMBEDDING_MODEL_ID, HISTORY_DB_PATH, RULES_PATH
+from app.services.db.history import connect
+from app.services.ia.embedding_cache import normalize_question
+from app.services.ia.embedding_index import _build_index, apply_search_params, resolve_index_spec
+from app.services.ia.preprocess_rules import iter_rule_entries, split_rules_into_records
+from app.services.ia.rule_lookup import RULE_REF_RE
+
+# "702.19. Trample": reglas cuyo texto es solo un título corto
+RULE_TITLE_RE = re.compile(r"^(\d{3}\.\d+)\.\s+([A-Z][\w' ,/-]{1,40})$")
+
+TITLE_TEMPLATES = [
+    "How does {} work?",
+    "What are the rules for {}?",
+    "¿Cómo funciona {}?",
+    "¿Qué reglas se aplican a {}?",
+]
+
+
+def _parent_rule(rule_id: str) -> str:
+    return rule_id[:-1] if rule_id[-1].isalpha() else rule_id
+
+
+def _chunk_rules(meta: dict) -> set[str]:
+    """
+    Rule ids a chunk answers for: its rules and subrules plus their parents.
+    """
+    if meta.get("kind") != "rule":
+        return set()
+    ids = {meta["rule"], *meta.get("rules", [])}
+    return ids | {_parent_rule(rule_id) for rule_id in ids}
+
+
+def _history_questions(db_path: str, limit: int) -> list[dict]:
+    if not os.path.exists(db_path):
+        return []
+    conn = connect(db_path, readonly=True)
+    try:
+        rows = conn.execute(
+            "SELECT question, answer FROM history WHERE answer NOT LIKE 'Error:%' ORDER BY id DESC LIMIT ?",
+            (limit,),
+        ).fetchall()
+    except sqlite3.OperationalError:
+        rows = []  # base de datos sin inicializar
+    finally:
+        conn.close()
+
+    items = []
+    for question, answer in rows:
+        rules = sorted(set(RULE_REF_RE.findall(answer)))
+        if rules:
+            items.append({"question": question, "rules": rules, "source": "history"})
+    return items
+
+
+def _title_questions(rules_path: str, limit: int, seed: int) -> list[dict]:
+    rng = random.Random(seed)
+    items = []
+    for entry in iter_rule_entries(rules_path):
+        if entry["kind"] != "rule":
+            continue
+        match = RULE_TITLE_RE.match(entry["text"].split("\n", 1)[0])
+        if match:
+            question = rng.choice(TITLE_TEMPLATES).format(match.group(2).strip())
+            items.append({"question": question, "rules": [match.group(1)], "source": "rule_title"})
+    rng.shuffle(items)
+    return items[:limit]
+
+
+def load_golden_set(rules_path: str = RULES_PATH, db_path: str = HISTORY_DB_PATH, golden_file: str | None = None,
+                    history_limit: int = 500, title_limit: int = 500, seed: int = 0) -> list[dict]:
+    """
+    Builds the golden question set.
+
+    Args:
+        rules_path (str): Comprehensive rules text file.
+        db_path (str): History database (skipped if missing).
+        golden_file (str | None): Optional JSONL of {"question", "rules": [...]}.
+        history_limit (int): Most recent history rows to scan.
+        title_limit (int): Maximum rule-title questions.
+        seed (int): Seed for sampling and phrasing the rule-title questions.
+
+    Returns:
+        list[dict]: [{"question", "rules", "source"}, ...] without duplicate questions.
+    """
+    items = []
+    if golden_file:
+        with open(golden_file, "r", encoding="utf-8") as f:
+            items.extend({**json.loads(line), "source": "file"} for line in f if line.strip())
+    items.extend(_history_questions(db_path, history_limit))
+    items.extend(_title_questions(rules_path, title_limit, seed))
+
+    golden, seen = [], set()
+    for item in items:
+        key = normalize_question(item["question"])
+        if key not in seen and item["rules"]:
+            seen.add(key)
+            golden.append(item)
+    return golden
+
+
+def _rss_bytes() -> int | None:
+    """
+    Resident set size of this process (Linux), or None if unavailable.
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def _ms_percentiles(seconds: list[float]) -> dict:
+    values = np.array(seconds) * 1000
+    return {f"p{p}": round(float(np.percentile(values, p)), 4) for p in (50, 95, 99)}
+
+
+def score_rankings(rankings: list[list[int]], relevant: list[set[int]], ks: list[int]) -> dict:
+    """
+    recall@k (fraction of questions with a relevant chunk in the top k) and
+    MRR over the full ranking depth.
+    """
+    recall = {k: 0 for k in ks}
+    reciprocal_ranks = 0.0
+    for ranking, expected in zip(rankings, relevant):
+        rank = next((pos for pos, chunk_id in enumerate(ranking, 1) if chunk_id in expected), None)
+        if rank is None:
+            continue
+        reciprocal_ranks += 1 / rank
+        for k in ks:
+            recall[k] += rank <= k
+
+    n = len(rankings)
+    return {
+        **{f"recall_at_{k}": round(hits / n, 4) for k, hits in recall.items()},
+        "mrr": round(reciprocal_ranks / n, 4),
+    }
+
+
+def benchmark_candidate(index: faiss.Index, model: SentenceTransformer, questions: list[str],
+                        relevant: list[set[int]], ks: list[int], normalize: bool) -> dict:
+    """
+    Runs the golden questions one by one (like the API) against an index.
+    """
+    depth = max(ks)
+    rankings, search_seconds, total_seconds = [], [], []
+    for question in questions:
+        start = time.perf_counter()
+        vector = model.encode([question], convert_to_numpy=True).astype(np.float32)
+        if normalize:
+            faiss.normalize_L2(vector)
+        search_start = time.perf_counter()
+        _, ids = index.search(vector, depth)
+        end = time.perf_counter()
+        search_seconds.append(end - search_start)
+        total_seconds.append(end - start)
+        rankings.append([int(i) for i in ids[0] if i >= 0])
+
+    return {
+        **score_rankings(rankings, relevant, ks),
+        "search_ms": _ms_percentiles(search_seconds),
+        "query_ms": _ms_percentiles(total_seconds),
+    }
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(max_chars_list: list[int], models: list[str], index_specs: list[str], metric: str = "l2",
+                  ks: list[int] = (1, 4, 8), nprobe: int = 16, ef_search: int = 64, golden: list[dict] | None = None,
+                  rules_path: str = RULES_PATH) -> dict:
+    """
+    Builds every candidate index and scores it on the golden set.
+
+    Args:
+        max_chars_list (list[int]): Chunk sizes for `split_rules_into_records`.
+        models (list[str]): Sentence transformer model ids.
+        index_specs (list[str]): Index aliases or faiss.index_factory strings.
+        metric (str): 'l2' or 'cosine'.
+        ks (list[int]): Cut-offs for recall@k (the largest is the search depth).
+        nprobe (int): IVF lists visited per query.
+        ef_search (int): HNSW search breadth.
+        golden (list[dict] | None): Golden set (default: `load_golden_set()`).
+        rules_path (str): Comprehensive rules text file.
+
+    Returns:
+        dict: Run configuration, golden set summary and one result per candidate.
+    """
+    golden = golden if golden is not None else load_golden_set(rules_path)
+    if not golden:
+        raise ValueError("Empty golden set (no history citations, rule titles or golden file)")
+    questions = [item["question"] for item in golden]
+    expected_rules = [set(item["rules"]) for item in golden]
+    normalize = metric == "cosine"
+    faiss_metric = "ip" if normalize else "l2"
+    ks = sorted(ks)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for model_id in models:
+            print(f"🧠 Cargando modelo {model_id}...")
+            model = SentenceTransformer(model_id)
+            model.encode(["warmup"])
+
+            for max_chars in max_chars_list:
+                records = split_rules_into_records(rules_path, max_chars=max_chars)
+                chunks = [record["text"] for record in records]
+                chunk_rules = [_chunk_rules(record["meta"]) for record in records]
+                # Ids de chunk relevantes para cada pregunta con este troceado
+                relevant = [{i for i, ids in enumerate(chunk_rules) if ids & rules} for rules in expected_rules]
+
+                start = time.perf_counter()
+                embeddings = model.encode(chunks, convert_to_numpy=True).astype(np.float32)
+                embed_seconds = time.perf_counter() - start
+                if normalize:
+                    faiss.normalize_L2(embeddings)
+
+                for spec in index_specs:
+                    factory = resolve_index_spec(spec, len(embeddings), embeddings.shape[1])
+                    rss_before = _rss_bytes()
+                    start = time.perf_counter()
+                    index = _build_index(embeddings, factory, faiss_metric)
+                    build_seconds = time.perf_counter() - start
+                    rss_after = _rss_bytes()
+                    apply_search_params(index, nprobe=nprobe, ef_search=ef_search)
+
+                    path = os.path.join(tmp, "faiss.index")
+                    faiss.write_index(index, path)
+
+                    result = {
+                        "model_id": model_id,
+                        "max_chars": max_chars,
+                        "index_spec": spec,
+                        "index_factory": factory,
+                        "chunks": len(chunks),
+                        "dim": int(embeddings.shape[1]),
+                        "embed_seconds": round(embed_seconds, 3),
+                        "build_seconds": round(build_seconds, 3),
+                        "index_bytes": os.path.getsize(path),
+                        "memory_bytes": rss_after - rss_before if rss_before is not None else None,
+                        "unanswerable": sum(1 for ids in relevant if not ids),
+                        **benchmark_candidate(index, model, questions, relevant, ks, normalize),
+                    }
+                    results.append(result)
+                    print(f"📏 {model_id} | {max_chars} chars | {factory}: "
+                          f"recall@{ks[-1]} {result[f'recall_at_{ks[-1]}']:.3f} | MRR {result['mrr']:.3f} | "
+                          f"p95 {result['query_ms']['p95']:.2f} ms")
+                    del index
+
+    sources: dict[str, int] = {}
+    for item in golden:
+        sources[item["source"]] = sources.get(item["source"], 0) + 1
+    digest = hashlib.sha1(json.dumps([[q, sorted(r)] for q, r in zip(questions, expected_rules)],
+                                     ensure_ascii=False).encode("utf-8")).hexdigest()[:12]
+
+    return {
+        "commit": _git_commit(),
+        "config": {"metric": metric, "ks": ks, "nprobe": nprobe, "ef_search": ef_search},
+        "golden_set": {"questions": len(golden), "sources": sources, "hash": digest},
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark chunking, embedding model and FAISS index choices")
+    parser.add_argument("--max-chars", type=int, nargs="+", default=[512], help="Chunk sizes to compare")
+    parser.add_argument("--models", nargs="+", default=[EMBEDDING_MODEL_ID], help="Embedding models to compare")
+    parser.add_argument("--index-specs", nargs="+", default=["flat", "hnsw", "ivf"],
+                        help="Index aliases or faiss.index_factory strings")
+    parser.add_argument("--metric", choices=["l2", "cosine"], default="l2")
+    parser.add_argument("--k", type=int, nargs="+", default=[1, 4, 8], help="Cut-offs for recall@k")
+    parser.add_argument("--nprobe", type=int, default=16)
+    parser.add_argument("--ef-search", type=int, default=64)
+    parser.add_argument("--golden-file", default=None, help='JSONL with {"question", "rules": [...]}')
+    parser.add_argument("--history-limit", type=int, default=500, help="Recent history rows to scan (0 = none)")
+    parser.add_argument("--title-limit", type=int, default=500, help="Rule-title questions (0 = none)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Also write the JSON report to this file")
+    args = parser.parse_args()
+
+    if not os.path.exists(RULES_PATH):
+        print(f"❌ Rules file not found at {RULES_PATH}")
+        return
+
+    golden = load_golden_set(RULES_PATH, HISTORY_DB_PATH, args.golden_file, args.history_limit, args.title_limit, args.seed)
+    print(f"🎯 Conjunto dorado: {len(golden)} preguntas")
+    report = run_benchmark(args.max_chars, args.models, args.index_specs, args.metric, args.k,
+                           args.nprobe, args.ef_search, golden)
+
+    text = json.dumps(report, indent=2, sort_keys=True, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        print(f"💾 Informe guardado en {args.output}")
+
+
+if __name__ == "__main__":
+    main()
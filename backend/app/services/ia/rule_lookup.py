@@ -0,0 +1,156 @@
+"""
+rule_lookup.py
+
+Exact lookup from rule numbers ("702.19", "702.19b") and glossary terms
+("trample", "first strike") to chunk ids.
+
+Built from the chunk metadata produced by `preprocess_rules` and saved as
+`rule_lookup.json` next to the FAISS index. `semantic_search` uses it as a
+fast path: questions that cite a rule number or a glossary keyword are
+answered from the lookup without running the embedding model.
+"""
+
+import json
+import re
+import unicodedata
+
+RULE_REF_RE = re.compile(r"\b(\d{3}\.\d+[a-z]?)\b")
+SEE_RULE_RE = re.compile(r"\brules? (\d{3}\.\d+[a-z]?)")
+WORD_RE = re.compile(r"[\w'-]+")
+
+# Términos del glosario demasiado genéricos para decidir por sí solos el contexto
+GENERIC_TERMS = {
+    "ability", "attack", "block", "card", "cast", "color", "combat", "copy", "cost",
+    "counter", "damage", "draw", "effect", "game", "hand", "land", "life", "mana",
+    "object", "owner", "permanent", "play", "player", "source", "spell", "stack",
+    "target", "token", "turn", "type", "zone",
+}
+
+
+def normalize_term(term: str) -> str:
+    """
+    Lowercases, strips accents and parenthetical notes ("Bury (Obsolete)").
+    """
+    term = re.sub(r"\(.*?\)", "", term)
+    term = unicodedata.normalize("NFKD", term)
+    term = "".join(c for c in term if not unicodedata.combining(c))
+    return " ".join(WORD_RE.findall(term.lower()))
+
+
+def build_rule_lookup(metadata: list[dict], texts: list[str]) -> dict:
+    """
+    Builds the rule-number and glossary-term lookup tables.
+
+    Args:
+        metadata (list[dict]): Per-chunk metadata from `split_rules_into_records`.
+        texts (list[str]): Chunk texts (glossary definitions are scanned for
+            "See rule 702.19" references).
+
+    Returns:
+        dict: {"rules": {rule_id: [chunk ids]}, "glossary": {term: [chunk ids]}}.
+    """
+    rules: dict[str, list[int]] = {}
+    glossary: dict[str, list[int]] = {}
+
+    for chunk_id, meta in enumerate(metadata):
+        if meta.get("kind") == "rule":
+            for rule_id in [meta["rule"], *meta.get("rules", [])]:
+                ids = rules.setdefault(rule_id, [])
+                if chunk_id not in ids:
+                    ids.append(chunk_id)
+
+    for chunk_id, meta in enumerate(metadata):
+        if meta.get("kind") != "glossary":
+            continue
+        ids = [chunk_id]
+        # "See rule 702.19" → incluir también los chunks de esa regla
+        for ref in SEE_RULE_RE.findall(texts[chunk_id]):
+            ids.extend(i for i in rules.get(ref, []) if i not in ids)
+
+        for alias in meta["term"].split(","):
+            term = normalize_term(alias)
+            if len(term) >= 4 and term not in GENERIC_TERMS:
+                glossary.setdefault(term, ids)
+
+    return {"rules": rules, "glossary": glossary}
+
+
+def save_rule_lookup(lookup: dict, path: str) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(lookup, f, ensure_ascii=False)
+
+
+class RuleLookup:
+    """
+    In-memory lookup tables with question matching.
+
+    Args:
+        lookup (dict): Tables produced by `build_rule_lookup`.
+    """
+
+    def __init__(self, lookup: dict):
+        self.rules: dict[str, list[int]] = lookup.get("rules", {})
+        self.glossary: dict[str, list[int]] = lookup.get("glossary", {})
+        self.max_term_words = max((len(t.split()) for t in self.glossary), default=1)
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def load(cls, path: str) -> "RuleLookup":
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def _glossary_matches(self, question: str) -> list[list[int]]:
+        words = normalize_term(question).split()
+        matches = []
+        i = 0
+        while i < len(words):
+            # Preferir el término más largo ("first strike" antes que "strike")
+            for n in range(min(self.max_term_words, len(words) - i), 0, -1):
+                ids = self.glossary.get(" ".join(words[i:i + n]))
+                if ids:
+                    matches.append(ids)
+                    i += n
+                    break
+            else:
+                i += 1
+        return matches
+
+    def match(self, question: str, top_k: int = 8) -> list[int] | None:
+        """
+        Returns chunk ids for the rule numbers and glossary terms cited in the
+        question, or None when it cites neither.
+
+        Args:
+            question (str): The user's query.
+            top_k (int): Maximum number of chunk ids.
+
+        Returns:
+            list[int] | None: Chunk ids in citation order.
+        """
+        groups = [self.rules[ref] for ref in RULE_REF_RE.findall(question) if ref in self.rules]
+        groups += self._glossary_matches(question)
+
+        if not groups:
+            self.misses += 1
+            return None
+
+        # Intercalar: el primer chunk de cada término/regla antes que los secundarios
+        ids: list[int] = []
+        depth = 0
+        while len(ids) < top_k and any(depth < len(g) for g in groups):
+            for group in groups:
+                if depth < len(group) and group[depth] not in ids:
+                    ids.append(group[depth])
+            depth += 1
+
+        self.hits += 1
+        return ids[:top_k]
+
+    def stats(self) -> dict:
+        return {
+            "rules": len(self.rules),
+            "glossary_terms": len(self.glossary),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
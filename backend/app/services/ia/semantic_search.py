@@ -1,13 +1,370 @@
+"""
+semantic_search.py
+
+Semantic retrieval over the Magic comprehensive rules.
+
+Nothing heavy happens at import time: the SentenceTransformer model, the FAISS
+index and the chunk list are loaded by `load_resources()`, which the FastAPI
+lifespan runs in the background (or the master process runs before forking
+when RETRIEVAL_PRELOAD=1). Use `is_ready()` to know when searches can be served.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import faiss
-import pickle
+import numpy as np
 from sentence_transformers import SentenceTransformer
 
-# Load model and index
-model = SentenceTransformer("all-MiniLM-L6-v2")
-index = faiss.read_index("../data/embeddings/faiss.index")
+from app.config import (
+    EMBEDDINGS_DIR,
+    INDEX_META_PATH,
+    RULE_LOOKUP_PATH,
+    RULE_LOOKUP_FAST_PATH,
+    BM25_INDEX_PATH,
+    RETRIEVAL_MODE,
+    RRF_K,
+    HYBRID_CANDIDATES,
+    BM25_CONFIDENT_MAX_TERMS,
+    FAISS_INDEX_PATH,
+    FAISS_MMAP,
+    EMBEDDING_MODEL_ID,
+    EMBEDDING_EXECUTOR_WORKERS,
+    EMBEDDING_CACHE_SIZE,
+    EMBEDDING_CACHE_TTL,
+    QUERY_BATCHING_ENABLED,
+    QUERY_BATCH_MAX_SIZE,
+    QUERY_BATCH_MAX_WAIT_MS,
+    RERANK_ENABLED,
+    RERANK_CANDIDATES,
+    RERANK_TOP_K,
+)
+from app.services.metrics import stage
+from app.services.ia.chunk_store import ChunkStore, open_chunk_store
+from app.services.ia.embedding_cache import EmbeddingCache
+from app.services.ia.embedding_index import apply_search_params
+from app.services.ia.lexical_index import BM25Index, reciprocal_rank_fusion
+from app.services.ia.query_batcher import QueryBatcher
+from app.services.ia.reranker import CrossEncoderReranker
+from app.services.ia.rule_lookup import RuleLookup
+
+# Recursos cargados bajo demanda (ver load_resources)
+model: SentenceTransformer | None = None
+index: faiss.Index | None = None
+chunks: ChunkStore | None = None
+index_version: str | None = None
+index_meta: dict = {}
+rule_lookup: RuleLookup | None = None
+bm25: BM25Index | None = None
+reranker: CrossEncoderReranker | None = None
+
+# Contadores de etapas de recuperación
+retrieval_stats = {"rule_lookup": 0, "lexical_only": 0, "hybrid": 0, "vector": 0, "reranked": 0}
+
+# Rutas que embeben la pregunta (el embedding queda en la caché); en
+# "rule_lookup" y "lexical_only" el modelo no llega a ejecutarse
+VECTOR_PATHS = ("hybrid", "vector")
+
+_ready = threading.Event()
+_load_lock = threading.Lock()
+_load_error: str | None = None
+
+embedding_cache = EmbeddingCache(maxsize=EMBEDDING_CACHE_SIZE, ttl=EMBEDDING_CACHE_TTL)
+
+# Pool dedicado al trabajo CPU (encode + búsqueda FAISS); ambos liberan el GIL.
+_executor: ThreadPoolExecutor | None = None
+
+
+def _read_index(path: str, mmap: bool) -> faiss.Index:
+    """
+    Reads a FAISS index, memory-mapped when the index type supports it.
+    """
+    if mmap:
+        # IO_FLAG_MMAP_IFC también mapea los códigos de índices planos (faiss >= 1.9)
+        flags = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+        try:
+            return faiss.read_index(path, flags)
+        except RuntimeError as e:
+            print(f"⚠️ mmap no soportado para este índice ({e}); cargando en memoria.")
+    return faiss.read_index(path)
+
+
+def _compute_index_version(path: str) -> str:
+    stat = os.stat(path)
+    return hashlib.sha1(f"{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()[:12]
+
+
+def _read_index_meta(path: str) -> dict:
+    """
+    Reads index_meta.json written by build_faiss_index. Indexes built before
+    it existed are treated as exact L2 indexes over raw embeddings.
+    """
+    if not os.path.exists(path):
+        return {"index_factory": "Flat", "metric": "l2", "normalize": False}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_resources(mmap: bool = FAISS_MMAP) -> None:
+    """
+    Loads the embedding model, FAISS index and chunks from the paths in app.config.
+
+    Safe to call several times or from several threads: only the first call loads.
+
+    Args:
+        mmap (bool): Open the FAISS index memory-mapped.
+    """
+    global model, index, chunks, index_version, index_meta, rule_lookup, bm25, reranker, _load_error
+
+    with _load_lock:
+        if _ready.is_set():
+            return
+        try:
+            print(f"📦 Cargando índice FAISS desde {FAISS_INDEX_PATH} (mmap={mmap})...")
+            index_meta = _read_index_meta(INDEX_META_PATH)
+            index = _read_index(FAISS_INDEX_PATH, mmap)
+            apply_search_params(index, nprobe=index_meta.get("nprobe"), ef_search=index_meta.get("ef_search"))
+            index_version = index_meta.get("version") or _compute_index_version(FAISS_INDEX_PATH)
+
+            if index_meta.get("model_id", EMBEDDING_MODEL_ID) != EMBEDDING_MODEL_ID:
+                print(f"⚠️ El índice se construyó con {index_meta['model_id']} pero EMBEDDING_MODEL_ID={EMBEDDING_MODEL_ID}.")
+
+            chunks = open_chunk_store(EMBEDDINGS_DIR)
+            if os.path.exists(RULE_LOOKUP_PATH):
+                rule_lookup = RuleLookup.load(RULE_LOOKUP_PATH)
+            if RETRIEVAL_MODE != "vector" and os.path.exists(BM25_INDEX_PATH):
+                bm25 = BM25Index(BM25_INDEX_PATH)
+
+            print(f"🧠 Cargando modelo de embeddings {EMBEDDING_MODEL_ID}...")
+            model = SentenceTransformer(EMBEDDING_MODEL_ID)
+
+            if RERANK_ENABLED:
+                reranker = CrossEncoderReranker()
+                reranker.load()
+        except Exception as e:
+            _load_error = str(e)
+            print(f"❌ Error cargando recursos de búsqueda: {e}")
+            raise
+
+        _load_error = None
+        _ready.set()
+        print(f"✅ Recursos de búsqueda listos ({index.ntotal} vectores, {index_meta.get('index_factory')}, versión {index_version}).")
+
+
+def is_ready() -> bool:
+    """
+    Returns True once the model, index and chunks are loaded.
+    """
+    return _ready.is_set()
+
+
+def get_load_error() -> str | None:
+    """
+    Returns the last loading error, if any.
+    """
+    return _load_error
+
+
+def get_index_version() -> str | None:
+    """
+    Returns an identifier of the loaded rules index (changes on every rebuild).
+    """
+    return index_version
+
+
+def embed_questions(questions: list[str]) -> np.ndarray:
+    """
+    Encodes questions, serving repeated ones from the embedding cache.
+
+    Only cache misses go through the transformer, in a single `encode` call.
+
+    Args:
+        questions (list[str]): Questions to embed.
+
+    Returns:
+        np.ndarray: float32 matrix of shape (len(questions), dim).
+    """
+    vectors: list[np.ndarray | None] = [embedding_cache.get_embedding(q, EMBEDDING_MODEL_ID) for q in questions]
+    missing = [i for i, v in enumerate(vectors) if v is None]
+
+    if missing:
+        with stage("embedding"):
+            encoded = model.encode([questions[i] for i in missing], convert_to_numpy=True)
+        for i, emb in zip(missing, encoded):
+            emb = np.array(emb, dtype=np.float32)
+            emb.setflags(write=False)  # compartido entre peticiones
+            embedding_cache.put_embedding(questions[i], EMBEDDING_MODEL_ID, emb)
+            vectors[i] = emb
+
+    return np.vstack(vectors).astype(np.float32, copy=False)
+
+
+def _lookup_ids(question: str, top_k: int) -> list[int] | None:
+    if not RULE_LOOKUP_FAST_PATH or rule_lookup is None:
+        return None
+    return rule_lookup.match(question, top_k)
+
+
+def _lexical_stage(question: str, top_k: int, depth: int = 0) -> tuple[list[int], bool]:
+    """
+    Runs BM25 for one question. Returns its ranking (at least `depth` deep)
+    and whether the hit is confident enough to skip the vector stage
+    (lexical_first mode only).
+    """
+    if bm25 is None or RETRIEVAL_MODE == "vector":
+        return [], False
+
+    ids, _, coverage = bm25.search(question, max(top_k, HYBRID_CANDIDATES, depth))
+    confident = (
+        RETRIEVAL_MODE == "lexical_first"
+        and len(ids) >= top_k
+        and coverage == 1.0
+        and bm25.num_query_terms(question) <= BM25_CONFIDENT_MAX_TERMS
+    )
+    return ids, confident
+
+
+def retrieval_path(question: str, top_k: int = 8) -> str:
+    """
+    Returns the path `search_context_batch_with_paths` would serve the
+    question from ("rule_lookup", "lexical_only", "hybrid" or "vector"),
+    without running the vector stage. Only the last two are reranked.
+
+    Args:
+        question (str): The user query.
+        top_k (int): Number of results the search would return.
+
+    Returns:
+        str: Retrieval path name.
+    """
+    if _lookup_ids(question, top_k):
+        return "rule_lookup"
+    lexical_ids, confident = _lexical_stage(question, top_k)
+    if confident:
+        return "lexical_only"
+    return "hybrid" if lexical_ids else "vector"
+
+
+def first_stage_candidates(questions: list[str], depth: int, lexical: list[list[int]] | None = None) -> list[list[int]]:
+    """
+    Vector search for several questions (one `encode` call and one
+    multi-query `index.search`), fused with their BM25 rankings by reciprocal
+    rank fusion when available.
+
+    Args:
+        questions (list[str]): The user queries.
+        depth (int): Candidate chunk ids to return per question.
+        lexical (list[list[int]] | None): BM25 ranking per question; computed
+            here when None.
+
+    Returns:
+        list[list[int]]: Candidate chunk ids per question, best first.
+    """
+    if lexical is None:
+        lexical = [_lexical_stage(question, depth, depth)[0] for question in questions]
+
+    search_depth = max(depth, HYBRID_CANDIDATES) if bm25 is not None else depth
+    question_embs = embed_questions(questions)
+    if index_meta.get("normalize"):
+        question_embs = question_embs.copy()
+        faiss.normalize_L2(question_embs)
+    with stage("vector_search"):
+        D, I = index.search(question_embs, search_depth)
+
+    candidates = []
+    for row, lexical_ids in zip(I, lexical):
+        vector_ids = [int(j) for j in row if j >= 0]
+        if lexical_ids:
+            candidates.append(reciprocal_rank_fusion([vector_ids, lexical_ids], k=RRF_K)[:depth])
+        else:
+            candidates.append(vector_ids[:depth])
+    return candidates
+
+
+def search_context_batch_with_paths(questions: list[str], top_k: int = 8) -> list[tuple[list[str], str]]:
+    """
+    Searches the rule chunks for several questions at once and reports which
+    retrieval path served each one.
+
+    Per question, the cheapest stage that can answer wins:
+    1. exact rule lookup for cited rule numbers / glossary terms;
+    2. BM25 alone for keyword-style questions with a confident lexical hit
+       (RETRIEVAL_MODE=lexical_first);
+    3. vector search (one `encode` call and one multi-query `index.search`
+       for the whole batch), fused with the BM25 ranking by reciprocal rank
+       fusion unless RETRIEVAL_MODE=vector. With RERANK_ENABLED, a wider
+       candidate set (RERANK_CANDIDATES) is rescored by the cross-encoder and
+       only the best RERANK_TOP_K chunks are returned.
+
+    Args:
+        questions (list[str]): The user queries.
+        top_k (int): Number of relevant results to return per question.
+
+    Returns:
+        list[tuple[list[str], str]]: Top relevant rule chunks and retrieval path
+        ("rule_lookup", "lexical_only", "hybrid" or "vector") for each question.
+    """
+    if not _ready.is_set():
+        raise RuntimeError("Retrieval resources are not loaded yet")
+
+    depth = max(top_k, RERANK_CANDIDATES) if reranker is not None else top_k
+
+    results: list[tuple[list[str], str] | None] = [None] * len(questions)
+    lexical: dict[int, list[int]] = {}
+    pending = []
+    for i, question in enumerate(questions):
+        ids = _lookup_ids(question, top_k)
+        if ids:
+            results[i] = (chunks.get_many(ids), "rule_lookup")
+            retrieval_stats["rule_lookup"] += 1
+            continue
+
+        with stage("lexical"):
+            lexical_ids, confident = _lexical_stage(question, top_k, depth)
+        if confident:
+            results[i] = (chunks.get_many(lexical_ids[:top_k]), "lexical_only")
+            retrieval_stats["lexical_only"] += 1
+            continue
+
+        lexical[i] = lexical_ids
+        pending.append(i)
+
+    if pending:
+        candidates = first_stage_candidates([questions[i] for i in pending], depth, [lexical[i] for i in pending])
+        paths = {i: "hybrid" if lexical[i] else "vector" for i in pending}
+        for path in paths.values():
+            retrieval_stats[path] += 1
+
+        if reranker is not None:
+            with stage("rerank"):
+                texts = [chunks.get_many(ids) for ids in candidates]
+                candidates = reranker.rerank([questions[i] for i in pending], candidates, texts, min(top_k, RERANK_TOP_K))
+            retrieval_stats["reranked"] += len(pending)
+
+        for i, ids in zip(pending, candidates):
+            results[i] = (chunks.get_many(ids[:top_k]), paths[i])
+
+    return results
+
+
+def search_context_batch(questions: list[str], top_k: int = 8) -> list[list[str]]:
+    """
+    Searches the rule chunks for several questions at once (see
+    `search_context_batch_with_paths`).
+
+    Args:
+        questions (list[str]): The user queries.
+        top_k (int): Number of relevant results to return per question.
+
+    Returns:
+        list[list[str]]: Top relevant rule chunks for each question.
+    """
+    return [context for context, _ in search_context_batch_with_paths(questions, top_k)]
 
-with open("../data/embeddings/chunks.pkl", "rb") as f:
-    chunks = pickle.load(f)
 
 def search_context(question: str, top_k: int = 8) -> list[str]:
     """
@@ -20,6 +377,108 @@ def search_context(question: str, top_k: int = 8) -> list[str]:
     Returns:
         List[str]: Top relevant rule chunks.
     """
-    question_emb = model.encode([question])
-    D, I = index.search(question_emb, top_k)
-    return [chunks[i] for i in I[0]]
+    return search_context_batch([question], top_k)[0]
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """
+    Returns the executor used for CPU-bound retrieval work, creating it on first use.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=EMBEDDING_EXECUTOR_WORKERS, thread_name_prefix="retrieval")
+    return _executor
+
+
+def _trim_result(result: tuple[list[str], str], k: int) -> tuple[list[str], str]:
+    context, path = result
+    return context[:k], path
+
+
+query_batcher = QueryBatcher(
+    search_context_batch_with_paths,
+    get_executor,
+    max_batch_size=QUERY_BATCH_MAX_SIZE,
+    max_wait_ms=QUERY_BATCH_MAX_WAIT_MS,
+    max_concurrent_batches=EMBEDDING_EXECUTOR_WORKERS,
+    trim_fn=_trim_result,
+)
+
+
+def shutdown_executor() -> None:
+    """
+    Stops the retrieval executor. Called at application shutdown.
+    """
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+async def search_context_async(question: str, top_k: int = 8) -> tuple[list[str], str]:
+    """
+    Runs the search for one question off the event loop.
+
+    When the query batcher is running, concurrent calls are merged into one
+    batched encode + search; otherwise the query runs alone in the executor.
+
+    Args:
+        question (str): The user's query.
+        top_k (int): Number of relevant results to return.
+
+    Returns:
+        tuple[list[str], str]: Top relevant rule chunks and the retrieval path
+        that served them (see `search_context_batch_with_paths`).
+    """
+    if query_batcher.running:
+        return await query_batcher.search(question, top_k)
+
+    loop = asyncio.get_running_loop()
+    results = await loop.run_in_executor(get_executor(), search_context_batch_with_paths, [question], top_k)
+    return results[0]
+
+
+async def search_context_batch_async(questions: list[str], top_k: int = 8) -> list[tuple[list[str], str]]:
+    """
+    Runs `search_context_batch_with_paths` for a whole list of questions in the retrieval
+    executor (one encode call and one multi-query index search), bypassing
+    the micro-batcher.
+
+    Args:
+        questions (list[str]): The user queries.
+        top_k (int): Number of relevant results to return per question.
+
+    Returns:
+        list[tuple[list[str], str]]: Top relevant rule chunks and retrieval path for each question.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), search_context_batch_with_paths, questions, top_k)
+
+
+async def start_query_batcher() -> None:
+    """
+    Starts the micro-batching scheduler if enabled. Called at application startup.
+    """
+    if QUERY_BATCHING_ENABLED:
+        await query_batcher.start()
+
+
+async def stop_query_batcher() -> None:
+    """
+    Flushes and stops the micro-batching scheduler. Called at application shutdown.
+    """
+    await query_batcher.stop()
+
+
+async def embed_questions_async(questions: list[str]) -> np.ndarray:
+    """
+    Runs `embed_questions` in the retrieval executor.
+
+    Args:
+        questions (list[str]): Questions to embed.
+
+    Returns:
+        np.ndarray: float32 matrix of shape (len(questions), dim).
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), embed_questions, questions)
@@ -0,0 +1,68 @@
+"""
+single_flight.py
+
+Request coalescing for identical in-flight work.
+
+The first caller for a key (the leader) starts the work; callers arriving
+with the same key while it runs await the same result instead of repeating
+it. The key is forgotten as soon as the work finishes, so this only merges
+concurrent requests; reuse across time is the job of the caches.
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class SingleFlight:
+    """
+    Deduplicates concurrent executions of the same keyed coroutine.
+
+    The work runs in its own task: a caller that is cancelled (e.g. the client
+    disconnected) stops waiting without cancelling the work for the others.
+    """
+
+    def __init__(self):
+        self._inflight: dict[Hashable, asyncio.Task] = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> tuple[Any, bool]:
+        """
+        Runs `fn()` once for all concurrent callers with the same key.
+
+        Args:
+            key (Hashable): Identity of the work.
+            fn (Callable): Zero-argument coroutine function doing the work.
+
+        Returns:
+            tuple[Any, bool]: The shared result and whether this call was
+            coalesced into an execution started by another caller. Exceptions
+            raised by the work propagate to every caller.
+        """
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return await asyncio.shield(task), True
+
+        self.leaders += 1
+        task = asyncio.ensure_future(fn())
+        self._inflight[key] = task
+        task.add_done_callback(lambda t: self._done(key, t))
+        return await asyncio.shield(task), False
+
+    def _done(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled() and task.exception() is not None:
+            self.errors += 1
+
+    def stats(self) -> dict:
+        total = self.leaders + self.coalesced
+        return {
+            "in_flight": len(self._inflight),
+            "executions": self.leaders,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+            "coalesced_ratio": round(self.coalesced / total, 4) if total else 0.0,
+        }
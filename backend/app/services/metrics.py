@@ -0,0 +1,250 @@
+"""
+metrics.py
+
+Lightweight, dependency-free instrumentation for the API.
+
+- `Counter` / `Histogram`: thread-safe metrics with labels, rendered in the
+  Prometheus text exposition format by `render()` (served at /metrics).
+- `register_collector`: exports counters the services already keep (caches,
+  retrieval paths, history writer) at scrape time, without touching the hot path.
+- `stage(name)`: times one pipeline stage into the `aethermind_stage_seconds`
+  histogram and, inside a request, into that request's Server-Timing header.
+- `ServerTimingMiddleware`: per-request timing context, request counters and
+  latency histogram, and the `Server-Timing` response header.
+
+Recording is a dict lookup and a lock-protected add per observation, cheap
+enough to leave on in production.
+"""
+
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable
+
+from app.config import METRICS_ENABLED
+
+# Buckets en segundos: de 1 ms (lookup, BM25) a 60 s (generación lenta)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry: list = []
+_collectors: list[Callable[[], Iterable[tuple]]] = []
+
+# Tiempos por etapa de la petición en curso (None fuera de una petición)
+_request_timings: contextvars.ContextVar[dict | None] = contextvars.ContextVar("request_timings", default=None)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Counter:
+    """
+    Monotonic counter with optional labels.
+
+    Args:
+        name (str): Metric name.
+        help_text (str): HELP line.
+        labelnames (tuple[str, ...]): Label names, in order.
+    """
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, *labels) -> None:
+        """
+        Adds `amount` to the series identified by the label values.
+        """
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    """
+    Cumulative histogram with optional labels.
+
+    Args:
+        name (str): Metric name.
+        help_text (str): HELP line.
+        labelnames (tuple[str, ...]): Label names, in order.
+        buckets (tuple[float, ...]): Upper bounds, ascending (+Inf is implicit).
+    """
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple[str, ...] = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # labels -> [conteos por bucket (no acumulados), suma, total]
+        self._series: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, *labels) -> None:
+        """
+        Records one observation in the series identified by the label values.
+        """
+        if not METRICS_ENABLED:
+            return
+        slot = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][slot] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(labels, (list(s[0]), s[1], s[2])) for labels, s in self._series.items()]
+        names = self.labelnames + ("le",)
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(names, labels + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+def register_collector(fn: Callable[[], Iterable[tuple]]) -> None:
+    """
+    Registers a callback run at scrape time. It yields
+    (name, type, help, labelnames, [(label values, value), ...]) tuples.
+    """
+    _collectors.append(fn)
+
+
+def render() -> str:
+    """
+    Renders every metric in the Prometheus text exposition format (0.0.4).
+    """
+    lines: list[str] = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    for collector in _collectors:
+        try:
+            families = list(collector())
+        except Exception as e:
+            print(f"⚠️ Error en colector de métricas: {e}")
+            continue
+        for name, metric_type, help_text, labelnames, samples in families:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(labelnames, labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+# Métricas del pipeline
+STAGE_SECONDS = Histogram(
+    "aethermind_stage_seconds", "Duration of each pipeline stage", ("stage",)
+)
+REQUEST_SECONDS = Histogram(
+    "aethermind_request_seconds", "HTTP request duration until the response starts", ("path", "method")
+)
+REQUESTS_TOTAL = Counter(
+    "aethermind_requests_total", "HTTP requests", ("path", "method", "status")
+)
+GENERATION_ERRORS = Counter(
+    "aethermind_generation_errors_total", "Failed generation calls", ("backend",)
+)
+GENERATION_TOKENS = Counter(
+    "aethermind_generation_tokens_total", "Prompt and completion tokens", ("backend", "kind")
+)
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Times a pipeline stage.
+
+    The duration goes to `aethermind_stage_seconds{stage=name}` and, when
+    running inside a request, is added to the request's Server-Timing entry
+    for that stage. Work done in executor threads (where the request context
+    is not propagated) is only recorded in the histogram.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, name)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + elapsed
+
+
+def _server_timing(timings: dict, total: float) -> bytes:
+    entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries).encode("latin-1")
+
+
+class ServerTimingMiddleware:
+    """
+    ASGI middleware: opens a timing context per request, adds the
+    `Server-Timing` header when the response starts and records request
+    counters. For streamed responses the header covers the stages finished
+    before the first byte (retrieval, context); later stages still reach
+    the histograms.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        timings: dict[str, float] = {}
+        token = _request_timings.set(timings)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                elapsed = time.perf_counter() - start
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", _server_timing(timings, elapsed)))
+                message = {**message, "headers": headers}
+                # Rutas desconocidas bajo una sola etiqueta: cardinalidad acotada
+                path = scope["path"] if status != 404 else "other"
+                REQUEST_SECONDS.observe(elapsed, path, scope["method"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            path = scope["path"] if status != 404 else "other"
+            REQUESTS_TOTAL.inc(1, path, scope["method"], status)
+            _request_timings.reset(token)
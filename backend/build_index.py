@@ -1,11 +1,30 @@
+import argparse
+import json
 import os
-from app.services.ia.preprocess_rules import split_rules_into_chunks
-from app.services.ia.embedding_index import build_faiss_index
+from app.config import RULES_PATH, EMBEDDINGS_DIR, EMBEDDING_MODEL_ID, RULE_LOOKUP_PATH, BM25_INDEX_PATH
+from app.services.ia.preprocess_rules import split_rules_into_records
+from app.services.ia.embedding_index import build_faiss_index, INDEX_SPEC_ALIASES
+from app.services.ia.lexical_index import build_bm25_index
+from app.services.ia.rule_lookup import build_rule_lookup, save_rule_lookup
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build the FAISS index of the comprehensive rules")
+    parser.add_argument("--max-chars", type=int, default=512, help="Target chunk size in characters")
+    parser.add_argument("--index-spec", default="flat",
+                        help=f"{', '.join(INDEX_SPEC_ALIASES)} or any faiss.index_factory string (e.g. 'IVF256,PQ32')")
+    parser.add_argument("--metric", choices=["l2", "cosine"], default="l2")
+    parser.add_argument("--nprobe", type=int, default=16, help="IVF lists visited per query")
+    parser.add_argument("--ef-search", type=int, default=64, help="HNSW search breadth")
+    parser.add_argument("--full", action="store_true", help="Re-embed every chunk instead of reusing cached vectors")
+    parser.add_argument("--eval-queries", type=int, default=200, help="Queries for the recall@k report (0 = skip)")
+    return parser.parse_args()
 
 def main():
+    args = parse_args()
+
     # Ruta del archivo de reglas
-    rules_path = "../data/rules_raw/MagicCompRules.txt"
-    output_dir = "../data/embeddings"
+    rules_path = RULES_PATH
+    output_dir = EMBEDDINGS_DIR
 
     # Verificar existencia
     if not os.path.exists(rules_path):
@@ -14,14 +33,41 @@ def main():
 
     # Dividir en chunks
     print("📖 Splitting rules into chunks...")
-    chunks = split_rules_into_chunks(rules_path)
+    records = split_rules_into_records(rules_path, max_chars=args.max_chars)
+    chunks = [record["text"] for record in records]
+    metadata = [record["meta"] for record in records]
 
     # Construir índice
-    print(f"🔍 Building FAISS index with {len(chunks)} chunks...")
+    print(f"🔍 Building FAISS index ({args.index_spec}, {args.metric}) with {len(chunks)} chunks...")
     os.makedirs(output_dir, exist_ok=True)
-    build_faiss_index(chunks, output_dir=output_dir)
+    meta = build_faiss_index(
+        chunks,
+        model_id=EMBEDDING_MODEL_ID,
+        output_dir=output_dir,
+        index_spec=args.index_spec,
+        metric=args.metric,
+        nprobe=args.nprobe,
+        ef_search=args.ef_search,
+        eval_queries=args.eval_queries,
+        incremental=not args.full,
+        metadata=metadata,
+    )
+
+    # Índice exacto número de regla / término del glosario → chunk
+    lookup = build_rule_lookup(metadata, chunks)
+    save_rule_lookup(lookup, RULE_LOOKUP_PATH)
+    print(f"📑 Rule lookup: {len(lookup['rules'])} rule numbers, {len(lookup['glossary'])} glossary terms")
+
+    # Índice léxico BM25 sobre los mismos chunks
+    bm25_stats = build_bm25_index(chunks, BM25_INDEX_PATH)
+    print(f"🔤 BM25 index: {bm25_stats['terms']} terms, {bm25_stats['postings']} postings")
 
-    print("✅ Index built successfully!")
+    if meta["evaluation"]:
+        print(json.dumps(meta["evaluation"], indent=2))
+    chunk_stats = meta["chunks"]
+    print(f"🧩 Chunks: {chunk_stats['reused']} reused, {chunk_stats['added']} added, "
+          f"{chunk_stats['removed']} removed ({meta['embed_seconds']:.1f}s embedding)")
+    print(f"✅ Index built successfully! ({meta['index_factory']}, version {meta['version']})")
 
 if __name__ == "__main__":
     main()